@@ -0,0 +1,61 @@
+"""Time coordinate normalization: uncached ``geo._cardinal`` per value,
+the memoized ``geo.cardinal`` per value, and ``geo.cardinal_many`` over
+the whole batch. Checks that all three give the same answers.
+
+Usage::
+
+  python -m benchmarks.geo_cardinal [n_values] [n_distinct]
+
+"""
+
+import sys
+import time
+import random
+
+from envi_sra import geo
+from envi_sra.util import numpy_or_none
+
+
+def coordinates(n, n_distinct, seed=0):
+    rand = random.Random(seed)
+    distinct = list()
+    for i in range(n_distinct):
+        lat, lon = rand.uniform(-90, 90), rand.uniform(-180, 180)
+        form = i % 4
+        if form == 0:
+            distinct.append("%.4f %.4f"%(lat, lon))
+        elif form == 1:
+            distinct.append("%.5f, %.5f"%(lat, lon))
+        elif form == 2:
+            distinct.append("%.2f %s %.2f %s"%(
+                abs(lat), "S" if lat < 0 else "N",
+                abs(lon), "W" if lon < 0 else "E"))
+        else:
+            distinct.append(("%.3f"%(lat), "%.3f"%(lon)))
+    return [ rand.choice(distinct) for _ in range(n) ]
+
+
+def timed(fn):
+    start = time.time()
+    ret = fn()
+    return time.time()-start, ret
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    n_distinct = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    values = coordinates(n, n_distinct)
+    geo.cardinal.cache_clear()
+    t_plain, plain = timed(lambda: map(geo._cardinal, values))
+    t_memo, memo = timed(lambda: map(geo.cardinal, values))
+    t_many, many = timed(lambda: geo.cardinal_many(values))
+    assert plain == memo == many, "outputs differ"
+    print "%i values, %i distinct, numpy: %s"%(
+        n, n_distinct, numpy_or_none() is not None)
+    for name, t in (("_cardinal", t_plain), ("cardinal", t_memo),
+                    ("cardinal_many", t_many)):
+        print "%-14s %8.3f s %10.0f values/s"%(name, t, n/t)
+
+
+if __name__ == "__main__":
+    main()
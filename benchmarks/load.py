@@ -0,0 +1,271 @@
+"""Run serialize, upload and report end to end against the stand-in
+server, with local copies at a simulated bandwidth in place of ascp
+and reports produced after a delay.
+
+Usage::
+
+  python -m benchmarks.load [--samples 2000] [--reads 100]
+                            [--bandwidth 50] [--latency 0.05]
+                            [--max-parallel 4] [--delay 2]
+                            [--studies 1]
+
+With ``--studies`` more than one, that many studies of ``--samples``
+samples each are submitted together in batch mode; see
+:py:mod:`envi_sra.batch`.
+
+Prints how long each task took, the effective transfer rate, SSH round
+trips and report polls. Everything from the run, including
+``metrics.jsonl`` and ``metrics.prom``, is left in ``--work-dir`` if
+one's given.
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import logging
+import tempfile
+import json
+import argparse
+from os.path import join
+
+from envi_sra import ssh
+from envi_sra import batch
+from envi_sra import dedup
+from envi_sra import seqstats
+from envi_sra import validate
+from envi_sra import workflows
+from envi_sra.metrics import Metrics, MB
+
+from .synth import make_study
+from .standin import StandinServer, LocalCopyBackend, ReportProducer
+from .standin import client_key
+
+REMOTE_PATH = "/submit/Load/"
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--samples", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=100,
+                        help="reads per fastq file, about 220 bytes each")
+    parser.add_argument("--bandwidth", type=float, default=50,
+                        help="MB/s shared by all transfers, 0 for unlimited")
+    parser.add_argument("--per-transfer", type=float, default=0,
+                        help="MB/s any one transfer can reach")
+    parser.add_argument("--latency", type=float, default=0.05,
+                        help="seconds for each transfer to start")
+    parser.add_argument("--failure-rate", type=float, default=0)
+    parser.add_argument("--max-parallel", type=int, default=4)
+    parser.add_argument("--fixed", action="store_true",
+                        help="always upload --max-parallel files at once "
+                        "instead of adapting to the throughput")
+    parser.add_argument("--max-rate", type=float, default=0,
+                        help="MB/s all uploads together may use")
+    parser.add_argument("--loss", action="store_true",
+                        help="make the link lossy when asked for more "
+                        "than --bandwidth")
+    parser.add_argument("--delay", type=float, default=2,
+                        help="seconds from submit.ready to the report")
+    parser.add_argument("--mode", default="sftp", choices=("sftp", "shell"),
+                        help="what the stand-in offers SSHConnection")
+    parser.add_argument("--shard-actions", type=int, default=0)
+    parser.add_argument("--compress", default=None,
+                        choices=("gzip", "bgzip"),
+                        help="compress the fastq files before uploading")
+    parser.add_argument("--duplicates", type=float, default=0,
+                        help="fraction of fastq files to make copies of "
+                        "others, to deduplicate before uploading")
+    parser.add_argument("--no-check", action="store_true",
+                        help="skip checking the metadata and fastq files")
+    parser.add_argument("--studies", type=int, default=1,
+                        help="how many studies to submit in one batch")
+    parser.add_argument("--work-dir", default=None)
+    return parser.parse_args(argv)
+
+
+def make_duplicates(fnames, fraction):
+    """Overwrite ``fraction`` of ``fnames`` with copies of the others"""
+    n = int(len(fnames)*fraction)
+    originals = fnames[n:] or fnames
+    for i, fname in enumerate(fnames[:n]):
+        shutil.copyfile(originals[i % len(originals)], fname)
+    return n
+
+
+def run_tasks(tasks):
+    for task in tasks:
+        for action in task['actions']:
+            if action() is False:
+                raise Exception("Task failed: "+task['name'])
+
+
+def run_study(args, study, products_dir, conn, metrics):
+    sub = join(products_dir, "submission.xml")
+    ready = join(products_dir, "submit.ready")
+    sharded = bool(args.shard_actions)
+    seqstats_fname, duplicates_fname = None, None
+    mims_errors_fname = None
+    if not args.no_check:
+        run_tasks(workflows.validate(study['qiime_metadata'],
+                                     study['wgs_metadata'], products_dir,
+                                     metrics=metrics))
+        mims_errors_fname = validate.errors_fname(products_dir)
+        run_tasks(workflows.check(
+            study['qiime_metadata'], study['files_16s'],
+            study['wgs_metadata'], study['files_wgs'], products_dir,
+            metrics=metrics))
+        seqstats_fname = seqstats.table_fname(products_dir)
+    if args.duplicates:
+        run_tasks(workflows.dedup(study['files_16s'], study['files_wgs'],
+                                  products_dir, metrics=metrics))
+        duplicates_fname = dedup.duplicates_fname(products_dir)
+    run_tasks(workflows.serialize(
+        study['study_json'], study['qiime_metadata'],
+        study['seqinfo_16s'], study['files_16s'], study['wgs_metadata'],
+        study['seqinfo_wgs'], study['files_wgs'], sub, ready,
+        products_dir, writer="stream", shard_actions=args.shard_actions,
+        compress=args.compress, seqstats_fname=seqstats_fname,
+        duplicates_fname=duplicates_fname,
+        mims_errors_fname=mims_errors_fname, metrics=metrics))
+    files_16s, files_wgs = study['files_16s'], study['files_wgs']
+    if args.compress:
+        run_tasks(workflows.compress(files_16s, files_wgs, products_dir,
+                                     args.compress, metrics=metrics))
+        files_16s = workflows.compressed_names(files_16s, products_dir)
+        files_wgs = workflows.compressed_names(files_wgs, products_dir)
+    run_tasks(workflows.upload(
+        files_16s, files_wgs, sub, ready,
+        products_dir=products_dir, max_parallel=args.max_parallel,
+        retry_backoff=0.1, sharded=sharded, adaptive=not args.fixed,
+        max_rate=args.max_rate,
+        duplicates_fname=duplicates_fname, **conn))
+    conn = dict(conn)
+    backend = conn.pop('backend')
+    run_tasks(workflows.report(
+        ready+".complete", poll_interval=0.2, poll_max_interval=2,
+        sharded=sharded, backend=backend, **conn))
+
+
+def make_batch(args, work_dir):
+    """Write ``args.studies`` studies and a batch file listing them"""
+    studies = list()
+    for i in range(args.studies):
+        study = make_study(join(work_dir, "study%i"%(i)), args.samples,
+                           n_reports=0, reads=args.reads, seed=i)
+        studies.append(dict(name="Load%i"%(i),
+                            remote_path="Load%i"%(i), **study))
+    batch_fname = join(work_dir, "batch.json")
+    with open(batch_fname, 'w') as f:
+        json.dump(studies, f, indent=2)
+    return batch_fname
+
+
+def run_batch(args, batch_fname, products_dir, conn, metrics):
+    options = {
+        "batch": {"workers": 4},
+        "validate": {"enabled": not args.no_check},
+        "check": {"enabled": not args.no_check, "workers": 4},
+        "dedup": {"enabled": False},
+        "compress": {"format": args.compress, "workers": 4, "level": 6},
+        "serialize": {"writer": "stream", "shard_actions": args.shard_actions,
+                      "shard_bytes": 0, "ids": "digest",
+                      "incremental": False, "workers": 1, "profile": False},
+        "upload": {"keyfile": conn['keyfile'], "remote_srv": "127.0.0.1",
+                   "user": "load", "port": conn['port'],
+                   "max_parallel": args.max_parallel, "retries": 3,
+                   "retry_backoff": 0.1, "hash_workers": 4,
+                   "adaptive": not args.fixed, "max_rate": args.max_rate},
+        "report": {"poll_timeout": 20*60, "poll_interval": 0.2,
+                   "poll_max_interval": 2, "poll_backoff": 1.5,
+                   "fetch": "newest", "accessions": "accessions.json"},
+    }
+    for tasks in batch.configure(batch.load_batch(batch_fname, products_dir),
+                                 products_dir, options, pool=conn['pool'],
+                                 metrics=metrics, backend=conn['backend']):
+        run_tasks(tasks)
+
+
+def summarize(metrics, elapsed, out=sys.stdout):
+    print >> out, "%-60s %9s"%("task", "seconds")
+    for (name, labels), value in sorted(metrics.values.iteritems()):
+        if name == "task_seconds":
+            print >> out, "%-60s %9.3f"%(dict(labels)['task'][:60], value)
+    nbytes = metrics.get("transfer_bytes_total")
+    seconds = metrics.get("transfer_seconds_total")
+    print >> out, "transfers: %i ok, %i failed, %.1f MB"%(
+        metrics.get("transfers_total", status="ok"),
+        metrics.get("transfers_total", status="failed"), nbytes/float(MB))
+    if elapsed:
+        print >> out, "end to end: %.3f s, %.2f MB/s"%(
+            elapsed, nbytes/float(MB)/elapsed)
+    if seconds:
+        print >> out, "per-transfer average: %.2f MB/s"%(
+            nbytes/float(MB)/seconds)
+    for (name, labels), value in sorted(metrics.values.iteritems()):
+        if name == "ssh_rtt_seconds_count":
+            total = metrics.values[("ssh_rtt_seconds_sum", labels)]
+            print >> out, "ssh %-10s %6i round trips, %8.2f ms mean"%(
+                dict(labels)['op'], value, 1000*total/value)
+    print >> out, "uploads at once at the end: %i, each at %.1f MB/s"%(
+        metrics.get("upload_parallel"),
+        metrics.get("upload_rate_bytes")/float(MB))
+    print >> out, "report polls: %i, listings: %i"%(
+        metrics.get("report_polls_total"),
+        metrics.get("report_listings_total"))
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.ERROR)
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="envi_sra_load")
+    root = join(work_dir, "remote")
+    products_dir = join(work_dir, "products")
+    for d in (join(root, "submit"), products_dir):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+
+    print >> sys.stderr, "Writing %i samples to %s"%(
+        args.samples*args.studies, work_dir)
+    if args.studies > 1:
+        batch_fname = make_batch(args, work_dir)
+    else:
+        study = make_study(join(work_dir, "study"), args.samples,
+                           n_reports=0, reads=args.reads)
+        if args.duplicates:
+            make_duplicates(study['files_16s']+study['files_wgs'],
+                            args.duplicates)
+    keyfile = client_key(join(work_dir, "client_key"))
+    server = StandinServer(root, sftp=args.mode == "sftp").start()
+    producer = ReportProducer(root, delay=args.delay).start()
+    backend = LocalCopyBackend(root, bandwidth=args.bandwidth*MB,
+                               per_transfer=args.per_transfer*MB,
+                               latency=args.latency,
+                               failure_rate=args.failure_rate,
+                               loss=args.loss)
+    metrics = Metrics(products_dir)
+    pool = ssh.ConnectionPool()
+    conn = dict(keyfile=keyfile, remote_path=REMOTE_PATH,
+                remote_srv="127.0.0.1", user="load", port=server.port,
+                pool=pool, metrics=metrics, backend=backend)
+
+    start = time.time()
+    try:
+        if args.studies > 1:
+            run_batch(args, batch_fname, products_dir, conn, metrics)
+        else:
+            run_study(args, study, products_dir, conn, metrics)
+    finally:
+        elapsed = time.time()-start
+        metrics.close()
+        producer.stop()
+        server.stop()
+        pool.close()
+    summarize(metrics, elapsed)
+    if not args.work_dir:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
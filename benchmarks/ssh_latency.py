@@ -0,0 +1,69 @@
+"""Time SSHConnection's remote operations against the stand-in server
+in sftp and shell mode.
+
+Usage::
+
+  python -m benchmarks.ssh_latency [n_files] [repeats]
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from envi_sra import ssh
+
+from .standin import StandinServer, client_key
+
+
+def timeit(fn, repeats):
+    times = list()
+    for _ in range(repeats):
+        start = time.time()
+        fn()
+        times.append(time.time()-start)
+    times.sort()
+    return times[len(times)//2], times[0]
+
+
+def bench(mode, port, keyfile, repeats):
+    start = time.time()
+    c = ssh.SSHConnection("bench", "127.0.0.1", keyfile, "/submit/Bench/",
+                          mode=mode, port=port)
+    connect = time.time()-start
+    results = [("connect", connect, connect)]
+    results.append(("files",)+timeit(c.files, repeats))
+    results.append(("fsize",)+timeit(lambda: c.fsize("f0.fastq"), repeats))
+    results.append(("listdir",)+timeit(c.listdir, repeats))
+    results.append(("execute",)+timeit(lambda: c.execute("ls /submit"),
+                                        repeats))
+    c.transport.close()
+    return results
+
+
+def main():
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    tmp = tempfile.mkdtemp()
+    try:
+        study = os.path.join(tmp, "submit", "Bench")
+        os.makedirs(study)
+        for i in range(n_files):
+            with open(os.path.join(study, "f%i.fastq"%(i)), 'w') as f:
+                f.write("@r\nACGT\n+\nIIII\n"*i)
+        keyfile = client_key(os.path.join(tmp, "key"))
+        server = StandinServer(tmp).start()
+        print "%-8s %-8s %10s %10s"%("mode", "op", "median_s", "min_s")
+        for mode in ("sftp", "shell"):
+            for op, median, best in bench(mode, server.port, keyfile,
+                                          repeats):
+                print "%-8s %-8s %10.4f %10.4f"%(mode, op, median, best)
+        server.stop()
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == "__main__":
+    main()
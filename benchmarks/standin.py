@@ -0,0 +1,489 @@
+"""Stand-in for NCBI's submission server.
+
+Serves a local directory over SSH on localhost. The server offers the
+sftp subsystem, exec channels and an interactive shell that mimics
+the ``ls``, ``ls -l``, ``mkdir`` and ``rm`` output the real server
+gives ``envi_sra.ssh.SSHConnection``. Remote paths like
+``/submit/<study>/`` map to ``<root>/submit/<study>/``.
+
+:py:class:`LocalCopyBackend` takes the place of
+``envi_sra.transfer.AsperaBackend``, copying files into the root at a
+simulated bandwidth, and :py:class:`ReportProducer` plays NCBI's part,
+writing ``report.N.xml`` some time after each ``submit.ready`` shows
+up.
+
+"""
+
+import os
+import sys
+import time
+import stat
+import shlex
+import random
+import socket
+import threading
+from os.path import join, basename
+import xml.etree.ElementTree as ET
+
+import paramiko
+from paramiko import SFTPServer, SFTPAttributes, SFTPHandle, SFTP_OK
+from paramiko import SFTPServerInterface
+
+
+def _perms(mode):
+    kind = "d" if stat.S_ISDIR(mode) else "-"
+    bits = ""
+    for who in (6, 3, 0):
+        for shift, c in ((2, "r"), (1, "w"), (0, "x")):
+            bits += c if mode >> (who+shift) & 1 else "-"
+    return kind+bits
+
+
+def ls_long(path, names):
+    lines, total = list(), 0
+    for name in names:
+        st = os.lstat(join(path, name))
+        total += (st.st_size + 1023) // 1024
+        lines.append("%s 1 submit submit %8i %s %s"%(
+            _perms(st.st_mode), st.st_size,
+            time.strftime("%b %d %H:%M", time.localtime(st.st_mtime)),
+            name))
+    return ["total %i"%(total)] + lines
+
+
+class Root(object):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def local(self, path):
+        path = os.path.normpath("/"+path).lstrip("/")
+        return join(self.root, path)
+
+    def run(self, cmdline):
+        """Run one of the commands SSHConnection sends; returns a list
+        of output lines"""
+        argv = shlex.split(cmdline)
+        if not argv:
+            return []
+        cmd, args = argv[0], [a for a in argv[1:] if not a.startswith("-")]
+        flags = [a for a in argv[1:] if a.startswith("-")]
+        try:
+            if cmd == "ls":
+                path = self.local(args[0] if args else "/")
+                if os.path.isdir(path):
+                    names = sorted(os.listdir(path))
+                else:
+                    path, names = os.path.split(path)
+                    os.lstat(join(path, names))
+                    names = [names]
+                return ls_long(path, names) if "-l" in flags else names
+            elif cmd == "mkdir":
+                os.mkdir(self.local(args[0]), 0775)
+            elif cmd == "rm":
+                os.remove(self.local(args[0]))
+            else:
+                return ["%s: command not found"%(cmd)]
+        except (OSError, IndexError) as e:
+            return ["%s: %s"%(cmd, e)]
+        return []
+
+
+class _Handle(SFTPHandle):
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _SFTP(SFTPServerInterface):
+    def __init__(self, server, root, *args, **kwargs):
+        super(_SFTP, self).__init__(server, *args, **kwargs)
+        self.root = root
+
+    def _attrs(self, path, name=None):
+        attr = SFTPAttributes.from_stat(os.lstat(path))
+        attr.filename = name or os.path.basename(path)
+        return attr
+
+    def list_folder(self, path):
+        local = self.root.local(path)
+        try:
+            return [ self._attrs(join(local, n), n)
+                     for n in os.listdir(local) ]
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self.root.local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def open(self, path, flags, attr):
+        local = self.root.local(path)
+        try:
+            fd = os.open(local, flags, 0664)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = "ab" if flags & os.O_APPEND else "wb"
+        elif flags & os.O_RDWR:
+            mode = "a+b" if flags & os.O_APPEND else "r+b"
+        else:
+            mode = "rb"
+        f = os.fdopen(fd, mode)
+        handle = _Handle(flags)
+        handle.filename = local
+        handle.readfile = handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self.root.local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        try:
+            os.rename(self.root.local(oldpath), self.root.local(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def mkdir(self, path, attr):
+        try:
+            os.mkdir(self.root.local(path), 0775)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self.root.local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        return SFTP_OK
+
+
+class _Server(paramiko.ServerInterface):
+    prompt = "submit$ "
+
+    def __init__(self, root, sftp=True):
+        self.root = root
+        self.sftp = sftp
+
+    def get_allowed_auths(self, username):
+        return "publickey"
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        if kind == "session":
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_pty_request(self, *args):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        def _run():
+            out = self.root.run(command)
+            channel.sendall("".join(line+"\n" for line in out))
+            channel.send_exit_status(0)
+            # EOF rather than close: the client is still waiting on
+            # the reply to its exec request and would see a close as
+            # a failure
+            channel.shutdown_write()
+        threading.Thread(target=_run).start()
+        return True
+
+    def check_channel_shell_request(self, channel):
+        def _shell():
+            f = channel.makefile("rb")
+            channel.sendall("Welcome to the stand-in\r\n"+self.prompt)
+            while True:
+                line = f.readline()
+                if not line:
+                    break
+                line = line.rstrip("\r\n")
+                out = [line] + self.root.run(line)
+                channel.sendall("\r\n".join(out)+"\r\n"+self.prompt)
+        threading.Thread(target=_shell).start()
+        return True
+
+    def check_channel_subsystem_request(self, channel, name):
+        if name == "sftp" and not self.sftp:
+            return False
+        return super(_Server, self).check_channel_subsystem_request(
+            channel, name)
+
+
+class StandinServer(object):
+    """SSH server on localhost serving ``root``.
+
+    :keyword sftp: Boolean; set to False to refuse the sftp subsystem,
+    which forces clients onto the interactive shell.
+
+    """
+
+    def __init__(self, root, port=0, sftp=True):
+        self.root = Root(root)
+        self.host_key = paramiko.RSAKey.generate(2048)
+        self.sftp = sftp
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("127.0.0.1", port))
+        self.sock.listen(100)
+        self.port = self.sock.getsockname()[1]
+        self.transports = list()
+        self.thread = None
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            t = paramiko.Transport(conn)
+            t.add_server_key(self.host_key)
+            t.set_subsystem_handler("sftp", SFTPServer, _SFTP, self.root)
+            t.start_server(server=_Server(self.root, self.sftp))
+            self.transports.append(t)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._serve)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.sock.close()
+        for t in self.transports:
+            t.close()
+
+
+class Link(object):
+    """A pipe that carries ``rate`` bytes per second, shared by every
+    transfer sent through it. A rate of 0 is unlimited."""
+
+    def __init__(self, rate=0):
+        self.rate = float(rate)
+        self.free_at = 0
+        self.lock = threading.Lock()
+
+    def send(self, nbytes):
+        """Block for as long as ``nbytes`` takes to go through"""
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.time()
+            start = max(now, self.free_at)
+            self.free_at = start + nbytes/self.rate
+            wait = self.free_at - now
+        time.sleep(wait)
+
+
+class LocalCopyBackend(object):
+    """Copies files in and out of a stand-in server's root instead of
+    running ascp.
+
+    :param root: String; the stand-in's root directory
+
+    :keyword bandwidth: Number; bytes per second shared by all
+    transfers, 0 for unlimited
+
+    :keyword per_transfer: Number; bytes per second any one transfer
+    can reach, 0 for unlimited
+
+    :keyword latency: Number; seconds each transfer takes to start,
+    like ascp's session setup
+
+    :keyword failure_rate: Number; fraction of transfers that fail
+    partway through
+
+    :keyword loss: Boolean; make the shared link lossy when it's asked
+    for more than it carries. While the rates asked of the transfers
+    running add up to more than ``bandwidth``, each byte takes that
+    many times longer to get through, as if resent. A transfer with no
+    ``rate`` asks for all of ``bandwidth``.
+
+    """
+
+    chunk_size = 64*1024
+
+    def __init__(self, root, bandwidth=0, per_transfer=0, latency=0,
+                 failure_rate=0, seed=0, loss=False):
+        self.root = Root(root)
+        self.link = Link(bandwidth)
+        self.per_transfer = per_transfer
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.loss = loss
+        #: bytes per second each transfer aims for, like ascp's -l
+        self.rate = 0
+        self.rand = random.Random(seed)
+        self.lock = threading.Lock()
+        self.transfers = 0
+        self.active = 0
+        self.nbytes = 0
+
+    def _fail(self):
+        with self.lock:
+            return self.rand.random() < self.failure_rate
+
+    def _cost(self, nbytes):
+        if not self.loss or not self.link.rate:
+            return nbytes
+        asked = self.active * (self.rate or self.link.rate)
+        return int(nbytes * max(1.0, asked/self.link.rate))
+
+    def _copy(self, src, dst):
+        time.sleep(self.latency)
+        own = Link(min([ r for r in (self.per_transfer, self.rate) if r ]
+                       or [0]))
+        fail = self._fail()
+        part = dst+".aspx"
+        with self.lock:
+            self.active += 1
+        try:
+            with open(src, 'rb') as f_in, open(part, 'wb') as f_out:
+                for chunk in iter(lambda: f_in.read(self.chunk_size), b''):
+                    self.link.send(self._cost(len(chunk)))
+                    own.send(len(chunk))
+                    if fail:
+                        return False
+                    f_out.write(chunk)
+        finally:
+            with self.lock:
+                self.active -= 1
+        os.rename(part, dst)
+        with self.lock:
+            self.transfers += 1
+            self.nbytes += os.stat(dst).st_size
+        return True
+
+    def upload(self, local_fname, dest):
+        return self._copy(local_fname,
+                          self.root.local(join(dest, basename(local_fname))))
+
+    def download(self, remote_fname, local_dir):
+        return self._copy(self.root.local(remote_fname),
+                          join(local_dir, basename(remote_fname)))
+
+
+def submission_spuids(fname):
+    """(target_db, spuid) for each Action in a submission.xml"""
+    ret = list()
+    for _, el in ET.iterparse(fname):
+        if el.tag != "Action":
+            continue
+        for child in el:
+            spuid = child.find("Identifier/SPUID")
+            if spuid is not None:
+                ret.append((child.get("target_db"), spuid.text))
+        el.clear()
+    return ret
+
+
+class ReportProducer(object):
+    """Writes NCBI-style reports into every directory of the stand-in
+    that gets a ``submit.ready``.
+
+    :keyword delay: Number; seconds between ``submit.ready`` showing
+    up and each report
+
+    :keyword n_reports: Integer; how many reports to write per
+    submission, each covering more of its Actions than the last
+
+    :keyword error_rate: Number; fraction of Actions that fail
+
+    """
+
+    def __init__(self, root, delay=5, n_reports=1, error_rate=0,
+                 scan_interval=0.2, seed=0):
+        self.root = os.path.abspath(root)
+        self.delay = delay
+        self.n_reports = n_reports
+        self.error_rate = error_rate
+        self.scan_interval = scan_interval
+        self.rand = random.Random(seed)
+        self.seen = dict()
+        self.pending = list()
+        self.written = list()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _scan(self):
+        now = time.time()
+        for d, _, files in os.walk(join(self.root, "submit")):
+            if "submit.ready" not in files:
+                continue
+            mtime = os.stat(join(d, "submit.ready")).st_mtime
+            if self.seen.get(d) == mtime:
+                continue
+            self.seen[d] = mtime
+            first = 1 + sum(1 for f in files if f.startswith("report."))
+            for r in range(self.n_reports):
+                self.pending.append((now+self.delay*(r+1), d, first+r, r+1))
+
+    def _write(self, d, num, r):
+        # imported here so the stand-in server doesn't need envi_sra
+        from .synth import write_report
+        sub = join(d, "submission.xml")
+        spuids = submission_spuids(sub) if os.path.exists(sub) else []
+        fname = join(d, "report.%i.xml"%(num))
+        write_report(fname, basename(d), spuids,
+                     len(spuids)*r//self.n_reports, self.rand,
+                     self.error_rate)
+        self.written.append(fname)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self._scan()
+            now = time.time()
+            due = [ p for p in self.pending if p[0] <= now ]
+            self.pending = [ p for p in self.pending if p[0] > now ]
+            for _, d, num, r in sorted(due):
+                self._write(d, num, r)
+            self.stopped.wait(self.scan_interval)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+
+def client_key(fname):
+    """Write a fresh RSA private key to ``fname`` for clients to log
+    in with; the stand-in accepts any key"""
+    paramiko.RSAKey.generate(2048).write_private_key_file(fname)
+    return fname
+
+
+def main():
+    root = sys.argv[1] if len(sys.argv) > 1 else "."
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 2222
+    delay = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+    StandinServer(root, port).start()
+    ReportProducer(root, delay).start()
+    print >> sys.stderr, "Serving %s on 127.0.0.1:%i"%(root, port)
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+"""Time each stage of serialization and report handling on synthetic
+studies, and compare against a stored baseline.
+
+Every stage runs in its own child process so its peak memory isn't
+hidden by whatever an earlier stage left behind. Inputs a stage needs,
+like the sample list ``to_xml`` takes, are built in the child before
+the clock starts; ``setup_kb`` is the peak RSS after that, ``peak_kb``
+the peak RSS once the stage is done.
+
+Usage::
+
+  python -m benchmarks.suite [--sizes 1000,10000] [--out results.json]
+                             [--baseline benchmarks/baseline.json]
+                             [--save-baseline] [--check]
+
+Timings only mean something against a baseline from the same machine,
+with the real dependencies installed, so none is kept in the
+repository. To record one, across the full range of study sizes::
+
+  python -m benchmarks.suite --sizes 1000,10000,100000,1000000 \
+      --save-baseline
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import resource
+import argparse
+import multiprocessing
+from os.path import join, dirname
+
+from .synth import make_study
+
+default_baseline = join(dirname(os.path.abspath(__file__)), "baseline.json")
+
+# seconds below which a slowdown is put down to noise
+NOISE_FLOOR = 0.05
+
+
+def maxrss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss//1024 if sys.platform == "darwin" else rss
+
+
+def _study(study):
+    from envi_sra.workflows import Bag
+    from envi_sra.util import digest
+    with open(study['study_json']) as f:
+        st = json.load(f)
+    ret = Bag()
+    ret.name, ret.description = st['name'], st['description']
+    ret.id = digest(ret.name)
+    return ret
+
+
+def _samples_seqs(study):
+    from envi_sra.workflows import gen_samples_seqs
+    st = _study(study)
+    store = gen_samples_seqs(st, study['qiime_metadata'],
+                             study['seqinfo_16s'], study['files_16s'])
+    return st, gen_samples_seqs(st, study['wgs_metadata'],
+                                study['seqinfo_wgs'], study['files_wgs'],
+                                store=store)
+
+
+def _records(study):
+    from envi_sra.metadata import iter_records
+    return ( list(iter_records(study['qiime_metadata']))
+             + list(iter_records(study['wgs_metadata'])) )
+
+
+def _quiet(fn):
+    stderr = sys.stderr
+    sys.stderr = open(os.devnull, 'w')
+    try:
+        return fn()
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+
+
+def stage_read(study, scratch):
+    return None, lambda _: _records(study)
+
+
+def stage_match(study, scratch):
+    from envi_sra.resolve import SampleResolver
+    ids = [ r['SampleID'] for r in _records(study) ]
+    files = study['files_16s'] + study['files_wgs']
+    return (ids, files), lambda d: SampleResolver(d[1]).resolve(d[0])
+
+
+def stage_find_file(study, scratch):
+    from envi_sra.resolve import find_file
+    ids = [ r['SampleID'] for r in _records(study) ]
+    files = study['files_16s'] + study['files_wgs']
+    return ids, lambda ids: [ find_file(i, files) for i in ids ]
+
+
+def stage_geo(study, scratch):
+    from envi_sra import geo
+    geo.cardinal.cache_clear()
+    values = [ r['lat_lon'] for r in _records(study) ]
+    return values, geo.cardinal_many
+
+
+def stage_validate(study, scratch):
+    from envi_sra.validate import validate
+    return [study['qiime_metadata'], study['wgs_metadata']], validate
+
+
+def stage_to_xml(study, scratch):
+    from envi_sra.serialize import to_xml
+    return _samples_seqs(study), lambda d: to_xml(*d)
+
+
+def stage_indent(study, scratch):
+    from envi_sra.serialize import to_xml, indent
+    return to_xml(*_samples_seqs(study)), indent
+
+
+def stage_write_etree(study, scratch):
+    import xml.etree.ElementTree as ET
+    from envi_sra.serialize import to_xml, indent
+    xml = to_xml(*_samples_seqs(study))
+    indent(xml)
+    fname = join(scratch, "etree.xml")
+    return xml, lambda xml: ET.ElementTree(xml).write(fname)
+
+
+def stage_write_stream(study, scratch):
+    from envi_sra.xmlstream import write_xml
+    fname = join(scratch, "stream.xml")
+    return _samples_seqs(study), lambda d: write_xml(d[0], d[1], fname)
+
+
+def stage_write_parallel(study, scratch):
+    from envi_sra.xmlstream import write_xml
+    fname = join(scratch, "parallel.xml")
+    workers = min(4, multiprocessing.cpu_count())
+    return _samples_seqs(study), lambda d: write_xml(d[0], d[1], fname,
+                                                     workers=workers)
+
+
+def stage_report(study, scratch):
+    from envi_sra.update import print_report
+    fname = study['reports'][-1]
+    return fname, lambda fname: _quiet(lambda: print_report(fname))
+
+
+stages = [
+    ("read", stage_read),
+    ("match", stage_match),
+    ("find_file", stage_find_file),
+    ("geo", stage_geo),
+    ("validate", stage_validate),
+    ("to_xml", stage_to_xml),
+    ("indent", stage_indent),
+    ("write_etree", stage_write_etree),
+    ("write_stream", stage_write_stream),
+    ("write_parallel", stage_write_parallel),
+    ("report", stage_report),
+]
+
+# stages that are quadratic in the number of samples; they're skipped
+# past --legacy-max samples
+legacy_stages = ("find_file",)
+
+
+def _child(stage, study, scratch, conn):
+    try:
+        data, fn = stage(study, scratch)
+        setup_kb = maxrss_kb()
+        start = time.time()
+        fn(data)
+        seconds = time.time()-start
+        conn.send({"seconds": seconds, "setup_kb": setup_kb,
+                   "peak_kb": maxrss_kb()})
+    except Exception as e:
+        conn.send({"error": "%s: %s"%(type(e).__name__, e)})
+    finally:
+        conn.close()
+
+
+def measure(stage, study, scratch):
+    """Run ``stage`` in a child process and return its timing and
+    memory use"""
+    parent, child = multiprocessing.Pipe(duplex=False)
+    p = multiprocessing.Process(target=_child,
+                                args=(stage, study, scratch, child))
+    p.start()
+    child.close()
+    try:
+        ret = parent.recv()
+    except EOFError:
+        ret = {"error": "stage exited with code %s"%(p.exitcode)}
+    p.join()
+    return ret
+
+
+def run(sizes, work_dir, legacy_max=1000, seqs=True, only=None):
+    results = dict()
+    for n in sizes:
+        study_dir = join(work_dir, "study.%i"%(n))
+        start = time.time()
+        study = make_study(study_dir, n, seqs=seqs)
+        res = results[str(n)] = {
+            "generate": {"seconds": time.time()-start,
+                         "peak_kb": maxrss_kb()}
+        }
+        for name, stage in stages:
+            if only and name not in only:
+                continue
+            if name in legacy_stages and n > legacy_max:
+                continue
+            res[name] = measure(stage, study, study_dir)
+            print >> sys.stderr, "%8i %-14s %s"%(n, name, _fmt(res[name]))
+        shutil.rmtree(study_dir)
+    return results
+
+
+def _fmt(r):
+    if "error" in r:
+        return "ERROR "+r['error']
+    return "%9.3f s %9i kB peak"%(r['seconds'], r['peak_kb'])
+
+
+def meta():
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def compare(results, baseline, tolerance=0.25):
+    """List (size, stage, measure, baseline, now, ratio) for every
+    stage that's gotten slower or bigger by more than ``tolerance``"""
+    regressions = list()
+    for size, stages_now in sorted(results.iteritems()):
+        stages_then = baseline.get(size, {})
+        for name, now in sorted(stages_now.iteritems()):
+            then = stages_then.get(name)
+            # generating the study isn't part of the pipeline
+            if name == "generate" or not then \
+               or "error" in then or "error" in now:
+                continue
+            for key, floor in (("seconds", NOISE_FLOOR), ("peak_kb", 1024)):
+                if key not in now or key not in then or not then[key]:
+                    continue
+                ratio = float(now[key])/then[key]
+                if ratio > 1+tolerance and now[key]-then[key] > floor:
+                    regressions.append((size, name, key, then[key],
+                                        now[key], ratio))
+    return regressions
+
+
+def print_comparison(results, baseline, out=sys.stdout):
+    print >> out, "%8s %-14s %10s %10s %7s %10s %10s"%(
+        "samples", "stage", "base s", "now s", "ratio", "base kB", "now kB")
+    for size, stages_now in sorted(results.iteritems(),
+                                   key=lambda i: int(i[0])):
+        for name, _ in [("generate", None)]+stages:
+            now = stages_now.get(name)
+            if not now or "error" in now:
+                continue
+            then = baseline.get(size, {}).get(name, {})
+            t = then.get("seconds")
+            print >> out, "%8s %-14s %10s %10.3f %7s %10s %10i"%(
+                size, name, "%.3f"%(t) if t else "-", now['seconds'],
+                "%.2f"%(now['seconds']/t) if t else "-",
+                then.get("peak_kb", "-"), now['peak_kb'])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="1000,10000",
+                        help="comma-separated study sizes, in samples")
+    parser.add_argument("--stages", default=None,
+                        help="comma-separated stages to run; all by default")
+    parser.add_argument("--out", default=None,
+                        help="write results as JSON here")
+    parser.add_argument("--baseline", default=default_baseline)
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="store these results as the new baseline")
+    parser.add_argument("--check", action="store_true",
+                        help="exit with an error if anything regressed")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--legacy-max", type=int, default=1000,
+                        help="largest study to time find_file on")
+    parser.add_argument("--no-seqs", action="store_true",
+                        help="don't write the dummy fastq files")
+    parser.add_argument("--work-dir", default=None)
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    sizes = [ int(s) for s in args.sizes.split(",") ]
+    only = args.stages.split(",") if args.stages else None
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="envi_sra_bench")
+    results = run(sizes, work_dir, args.legacy_max, not args.no_seqs, only)
+    doc = {"meta": meta(), "results": results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(doc, f, indent=2, sort_keys=True,
+                      separators=(",", ": "))
+
+    baseline = dict()
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    elif args.check and not args.save_baseline:
+        print >> sys.stderr, ("No baseline at %s; record one with "
+                              "--save-baseline")%(args.baseline)
+        sys.exit(1)
+    print_comparison(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(doc, f, indent=2, sort_keys=True,
+                      separators=(",", ": "))
+
+    regressions = compare(results, baseline, args.tolerance)
+    for size, name, key, then, now, ratio in regressions:
+        print >> sys.stderr, "REGRESSION %s samples, %s %s: %s -> %s (%.2fx)"%(
+            size, name, key, then, now, ratio)
+    if args.check and regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+"""Generate synthetic studies shaped like the ones the pipeline submits.
+
+A study directory holds::
+
+  study.json           name and description
+  metadata_16s.json    JSON array, one record per 16S sample, with every
+                       key in ``serialize.reqd_mims_keys``
+  metadata_wgs.tsv     QIIME mapping file for the WGS samples
+  seqinfo_16s.json     sequencing details for each kind of sample
+  seqinfo_wgs.json
+  seqs/                a small dummy fastq file per sample
+  reports/report.N.xml NCBI-style reports, each processing more of the
+                       submission's Actions than the last
+
+Usage::
+
+  python -m benchmarks.synth out_dir n_samples [n_reports]
+
+"""
+
+import os
+import sys
+import json
+import random
+import codecs
+from os.path import join
+from xml.sax.saxutils import escape, quoteattr
+
+from envi_sra.serialize import reqd_mims_keys
+from envi_sra.util import digest
+
+WGS_FRACTION = 0.2
+ERROR_RATE = 0.001
+
+vocab = {
+    "env_biome": ["urban biome", "anthropogenic terrestrial biome"],
+    "env_feature": ["building", "campus"],
+    "env_material": ["dust", "air"],
+    "geo_loc_name": ["USA: Massachusetts, Boston", "USA: Oregon, Eugene"],
+    "building_setting": ["urban", "suburban", "rural"],
+    "build_occup_type": ["office", "residential", "school"],
+    "heat_cool_type": ["forced air system", "radiant system"],
+    "indoor_space": ["bedroom", "office", "hallway"],
+    "filter_type": ["HEPA", "electrostatic"],
+    "light_type": ["natural light", "electric light"],
+    "space_typ_state": ["typically occupied"],
+    "ventilation_type": ["mechanical", "natural"],
+    "typ_occupant_dens": ["0.1", "0.5"],
+}
+
+
+def lat_lon(rand, i):
+    lat, lon = rand.uniform(-90, 90), rand.uniform(-180, 180)
+    if i % 3 == 0:
+        return "%.4f %.4f"%(lat, lon)
+    if i % 3 == 1:
+        return "%.5f, %.5f"%(lat, lon)
+    return "%.2f %s %.2f %s"%(abs(lat), "S" if lat < 0 else "N",
+                              abs(lon), "W" if lon < 0 else "E")
+
+
+def record(rand, sample_id, i):
+    rec = {"SampleID": sample_id}
+    for key in reqd_mims_keys:
+        if key in vocab:
+            rec[key] = rand.choice(vocab[key])
+        elif key == "lat_lon":
+            rec[key] = lat_lon(rand, i)
+        elif key == "collection_date":
+            rec[key] = "2015-%02i-%02i"%(rand.randint(1, 12),
+                                         rand.randint(1, 28))
+        else:
+            rec[key] = "%.1f"%(rand.uniform(0, 100))
+    return rec
+
+
+def sample_ids(n_samples):
+    n_wgs = int(n_samples*WGS_FRACTION)
+    ids_16s = [ "Dust.%i"%(i) for i in range(n_samples-n_wgs) ]
+    ids_wgs = [ "WGS%i"%(i) for i in range(n_wgs) ]
+    return ids_16s, ids_wgs
+
+
+def seq_fname(sample_id):
+    if sample_id.startswith("WGS"):
+        return sample_id+"_R1.fastq"
+    return sample_id+".fastq"
+
+
+def write_metadata(out_dir, ids_16s, ids_wgs, rand):
+    with codecs.open(join(out_dir, "metadata_16s.json"), 'w', "utf-8") as f:
+        f.write("[")
+        for i, sample_id in enumerate(ids_16s):
+            if i:
+                f.write(",\n")
+            json.dump(record(rand, sample_id, i), f)
+        f.write("]\n")
+    with codecs.open(join(out_dir, "metadata_wgs.tsv"), 'w', "utf-8") as f:
+        f.write("#"+"\t".join(["SampleID"]+reqd_mims_keys)+"\n")
+        for i, sample_id in enumerate(ids_wgs):
+            rec = record(rand, sample_id, i)
+            f.write("\t".join(rec[k] for k in ["SampleID"]+reqd_mims_keys))
+            f.write("\n")
+
+
+def write_seqs(seqs_dir, sample_ids, reads=1, rand=None):
+    """Write a fastq file of ``reads`` 100bp reads for each sample"""
+    rand = rand or random.Random(0)
+    if not os.path.isdir(seqs_dir):
+        os.mkdir(seqs_dir)
+    seqs = [ "".join(rand.choice("ACGT") for _ in range(100))
+             for _ in range(min(reads, 1000)) ]
+    paths = list()
+    for sample_id in sample_ids:
+        path = join(seqs_dir, seq_fname(sample_id))
+        with open(path, 'w') as f:
+            for i in range(reads):
+                f.write("@%s.%i\n%s\n+\n%s\n"%(
+                    sample_id, i, seqs[i % len(seqs)], "I"*100))
+        paths.append(path)
+    return paths
+
+
+def _response(kind, spuid, n, rand, error_rate=ERROR_RATE):
+    obj = "<Object target_db=%s spuid_namespace=\"hmp2\" spuid=%s"%(
+        quoteattr(kind), quoteattr(spuid))
+    if rand.random() < error_rate:
+        return ('    <Response status="error">\n'
+                '      <Message status="error">%s</Message>\n'
+                '      %s status="error"/>\n'
+                '    </Response>\n')%(
+                    escape("Invalid attribute value for "+spuid), obj)
+    prefix = "SAMN" if kind == "BioSample" else "SRR"
+    return ('    <Response status="processed-ok">\n'
+            '      %s accession="%s%08i" status="new"/>\n'
+            '    </Response>\n')%(obj, prefix, n)
+
+
+def write_report(fname, study_id, spuids, done, rand, error_rate=ERROR_RATE):
+    """Write a report on the Actions for ``spuids``, a list of
+    (target_db, spuid), where the first ``done`` have been processed
+    and the rest are still waiting"""
+    status = "processed-ok" if done == len(spuids) else "processing"
+    # not named report.N.xml.something, or pollers would pick it up
+    part = os.path.splitext(fname)[0]+".part"
+    with open(part, 'w') as f:
+        f.write("<?xml version='1.0' encoding='utf-8'?>\n"
+                "<SubmissionStatus submission_id=\"SUB%s\" "
+                "status=\"%s\">\n"%(study_id[:8], status))
+        for n, (kind, spuid) in enumerate(spuids):
+            f.write("  <Action action_id=\"SUB%s-%i\" target_db=\"%s\" "
+                    "status=\"%s\">\n"%(
+                        study_id[:8], n, kind,
+                        "processed-ok" if n < done else "submitted"))
+            if n < done:
+                f.write(_response(kind, spuid, n, rand, error_rate))
+            f.write("  </Action>\n")
+        f.write("</SubmissionStatus>\n")
+    os.rename(part, fname)
+
+
+def write_reports(reports_dir, study_id, spuids, n_reports, rand):
+    """Write ``n_reports`` reports; report N covers the first N/n_reports
+    of ``spuids``"""
+    if not os.path.isdir(reports_dir):
+        os.mkdir(reports_dir)
+    for r in range(1, n_reports+1):
+        write_report(join(reports_dir, "report.%i.xml"%(r)), study_id,
+                     spuids, len(spuids)*r//n_reports, rand)
+
+
+def make_study(out_dir, n_samples, n_reports=3, seqs=True, reads=1, seed=0):
+    """Write a synthetic study of ``n_samples`` samples to ``out_dir``,
+    with ``reads`` reads in each sample's fastq file. With ``seqs``
+    False, no fastq files are written, but their paths are still
+    returned.
+
+    Returns a dict of the paths serialize takes.
+
+    """
+    rand = random.Random(seed)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    name = "Synthetic study of %i samples"%(n_samples)
+    with open(join(out_dir, "study.json"), 'w') as f:
+        json.dump({"name": name,
+                   "description": "Dust samples made up for benchmarking"}, f)
+    for kind, seq_model, lib_const in (("16s", "Illumina MiSeq", "AMPLICON"),
+                                       ("wgs", "Illumina HiSeq", "WGS")):
+        with open(join(out_dir, "seqinfo_%s.json"%(kind)), 'w') as f:
+            json.dump({"seq_model": seq_model, "lib_const": lib_const,
+                       "method": "Synthetic "+kind}, f)
+
+    ids_16s, ids_wgs = sample_ids(n_samples)
+    write_metadata(out_dir, ids_16s, ids_wgs, rand)
+    seqs_dir = join(out_dir, "seqs")
+    if seqs:
+        files_16s = write_seqs(seqs_dir, ids_16s, reads, rand)
+        files_wgs = write_seqs(seqs_dir, ids_wgs, reads, rand)
+    else:
+        files_16s = [ join(seqs_dir, seq_fname(s)) for s in ids_16s ]
+        files_wgs = [ join(seqs_dir, seq_fname(s)) for s in ids_wgs ]
+
+    study_id = digest(name)
+    spuids = list()
+    for sample_id in ids_16s+ids_wgs:
+        spuids.append(("BioSample", study_id+":sample:"+digest(sample_id)))
+        spuids.append(("SRA", study_id+":seq:"+digest(seq_fname(sample_id))))
+    write_reports(join(out_dir, "reports"), study_id, spuids, n_reports,
+                  rand)
+
+    return {
+        "study_json": join(out_dir, "study.json"),
+        "qiime_metadata": join(out_dir, "metadata_16s.json"),
+        "seqinfo_16s": join(out_dir, "seqinfo_16s.json"),
+        "files_16s": files_16s,
+        "wgs_metadata": join(out_dir, "metadata_wgs.tsv"),
+        "seqinfo_wgs": join(out_dir, "seqinfo_wgs.json"),
+        "files_wgs": files_wgs,
+        "reports": [ join(out_dir, "reports", "report.%i.xml"%(r))
+                     for r in range(1, n_reports+1) ],
+    }
+
+
+def main():
+    out_dir, n_samples = sys.argv[1], int(sys.argv[2])
+    n_reports = int(sys.argv[3]) if len(sys.argv) > 3 else 3
+    make_study(out_dir, n_samples, n_reports)
+
+
+if __name__ == "__main__":
+    main()
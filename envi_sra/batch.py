@@ -0,0 +1,183 @@
+"""Submit many studies in one run.
+
+Studies are listed in a batch file: a JSON array with an object for
+each study, like::
+
+  [
+    {"name": "StudyA",
+     "study_json": "a/study.json",
+     "qiime_metadata": "a/metadata_16s.json",
+     "seqinfo_16s": "a/seqinfo_16s.json",
+     "wgs_metadata": "a/metadata_wgs.tsv",
+     "seqinfo_wgs": "a/seqinfo_wgs.json",
+     "files_16s": ["a/seqs/16s/*"],
+     "files_wgs": ["a/seqs/wgs/*"],
+     "remote_path": "StudyA",
+     "serialize": {"shard_actions": 5000}}
+  ]
+
+Relative paths are relative to the batch file, and ``files_16s`` and
+``files_wgs`` can be glob patterns. ``serialize`` is optional and
+overrides the serialize options for that study alone.
+
+Each study gets a directory of its own, named after it, in the batch's
+``products_dir``. Studies are serialized side by side, their sequence
+files go through one upload queue that takes from each study in turn,
+and their reports are waited on in one polling loop. The ledger for
+the whole batch is in ``products_dir``.
+
+"""
+
+import os
+import json
+import glob
+from os.path import join
+from os.path import dirname
+from os.path import isabs
+
+from . import seqstats
+from . import validate
+from . import workflows
+from . import dedup as dedup_
+from .xmlstream import shard_index
+from .manifest import manifest_fname
+from .util import submit_path
+
+required = ("name", "study_json", "qiime_metadata", "seqinfo_16s",
+            "wgs_metadata", "seqinfo_wgs", "remote_path")
+
+
+def load_batch(fname, products_dir):
+    """Read the batch file ``fname`` into a list of dicts, one per
+    study, with absolute paths, the files matched by each pattern in
+    ``files_16s`` and ``files_wgs``, and the study's ``products_dir``,
+    ``submission`` and ``ready`` file, and ``serialize`` options. Makes
+    each study's products directory if it isn't there."""
+    base = dirname(os.path.abspath(fname))
+    _path = lambda p: p if isabs(p) else join(base, p)
+    with open(fname) as f:
+        entries = json.load(f)
+    studies, names = list(), set()
+    for i, entry in enumerate(entries):
+        missing = [ k for k in required if not entry.get(k) ]
+        if missing:
+            raise ValueError("Study %i in %s has no %s"%(
+                i, fname, ", ".join(missing)))
+        if entry['name'] in names:
+            raise ValueError("Study %s is in %s twice"%(entry['name'], fname))
+        names.add(entry['name'])
+        study = dict(entry, serialize=dict(entry.get("serialize", {})))
+        for k in required[1:-1]:
+            study[k] = _path(entry[k])
+        for k in ("files_16s", "files_wgs"):
+            study[k] = [ f for pattern in entry.get(k, [])
+                         for f in sorted(glob.glob(_path(pattern)))
+                         if not f.endswith(".complete") ]
+        study['remote_path'] = submit_path(entry['remote_path'])
+        study['products_dir'] = join(os.path.abspath(products_dir),
+                                     entry['name'])
+        if not os.path.isdir(study['products_dir']):
+            os.makedirs(study['products_dir'])
+        study['submission'] = join(study['products_dir'], "submission.xml")
+        study['ready'] = join(study['products_dir'], "submit.ready")
+        studies.append(study)
+    return studies
+
+
+def report_targets(studies):
+    """What :py:func:`envi_sra.workflows.report` waits on for each of
+    ``studies``"""
+    targets = list()
+    for study in studies:
+        if not study['sharded']:
+            targets.append((study['remote_path'], study['products_dir'],
+                            study['submission'], study['products_dir']))
+            continue
+        with open(shard_index(study['submission'])) as f:
+            targets.extend( (join(study['remote_path'], s['name']), s['dir'],
+                             s['submission'], study['products_dir'])
+                            for s in json.load(f) )
+    return targets
+
+
+def _named(study, tasks):
+    # every study has a "check: sequences" task and so on
+    for task in tasks:
+        task['name'] += " ["+study['name']+"]"
+        yield task
+
+
+def configure(studies, products_dir, options, pool=None, metrics=None,
+              backend=None):
+    """Yield the workflows that submit every one of ``studies``.
+
+    :param options: Dict of dicts; the options for each workflow, as
+    in :py:class:`envi_sra.pipeline.ENVISRABatchPipeline`
+
+    :keyword backend: What moves the files; see
+    :py:func:`envi_sra.workflows.upload`
+
+    """
+    workers = options['batch']['workers']
+    check_opts = dict(options['check'])
+    check_enabled = check_opts.pop('enabled')
+    compress = options['compress']['format']
+    ledger = manifest_fname(products_dir)
+    studies_tasks = list()
+    for study in studies:
+        opts = dict(options['serialize'], **study['serialize'])
+        if workers > 1:
+            opts['workers'] = 1
+        study['sharded'] = bool(opts.get('shard_actions')
+                                or opts.get('shard_bytes'))
+        seqstats_fname, duplicates_fname = None, None
+        mims_errors_fname = None
+        if options['validate']['enabled']:
+            yield _named(study, workflows.validate(
+                study['qiime_metadata'], study['wgs_metadata'],
+                study['products_dir'], metrics=metrics))
+            mims_errors_fname = validate.errors_fname(study['products_dir'])
+        if check_enabled:
+            yield _named(study, workflows.check(
+                study['qiime_metadata'], study['files_16s'],
+                study['wgs_metadata'], study['files_wgs'],
+                study['products_dir'], metrics=metrics, **check_opts))
+            seqstats_fname = seqstats.table_fname(study['products_dir'])
+        if options['dedup']['enabled']:
+            yield _named(study, workflows.dedup(
+                study['files_16s'], study['files_wgs'], study['products_dir'],
+                metrics=metrics))
+            duplicates_fname = dedup_.duplicates_fname(study['products_dir'])
+        studies_tasks.append(list(workflows.serialize(
+            study['study_json'], study['qiime_metadata'],
+            study['seqinfo_16s'], study['files_16s'], study['wgs_metadata'],
+            study['seqinfo_wgs'], study['files_wgs'], study['submission'],
+            study['ready'], study['products_dir'], compress=compress,
+            seqstats_fname=seqstats_fname, duplicates_fname=duplicates_fname,
+            mims_errors_fname=mims_errors_fname, ledger=ledger, **opts)))
+        files = study['files_16s'] + study['files_wgs']
+        if compress:
+            yield _named(study, workflows.compress(
+                study['files_16s'], study['files_wgs'],
+                study['products_dir'], metrics=metrics,
+                **options['compress']))
+            files = workflows.compressed_names(files, study['products_dir'])
+        study['files'] = files
+
+    yield workflows.serialize_batch(studies_tasks, workers, metrics=metrics)
+
+    upload_opts = dict(options['upload'])
+    upload_opts.pop('remote_path', None)
+    yield workflows.upload_batch(studies, products_dir, pool=pool,
+                                 metrics=metrics, backend=backend,
+                                 **upload_opts)
+
+    report_opts = dict(options['report'])
+    report_opts.pop('products_dir', None)
+    for k in ("user", "remote_srv", "keyfile", "port"):
+        report_opts[k] = upload_opts[k]
+    yield workflows.report(join(products_dir, "batch.complete"),
+                           remote_path=None, pool=pool, metrics=metrics,
+                           backend=backend,
+                           targets=lambda: report_targets(studies),
+                           **report_opts)
@@ -0,0 +1,147 @@
+"""Compress sequence files before they're uploaded.
+
+Files that are already compressed are left alone. The rest are
+written, gzip or BGZF compressed, to a cache directory, and only
+recompressed when the original is newer than its compressed copy.
+Each directory files come from gets its own directory in the cache,
+so files with the same name from different places don't overwrite
+each other's compressed copies.
+
+"""
+
+import os
+import sys
+import zlib
+import gzip
+import struct
+import hashlib
+from os.path import join, basename, dirname, exists
+from multiprocessing import Pool
+
+CHUNK_SIZE = 1024*1024
+
+compressed_exts = (".gz", ".bgz", ".bz2", ".zip", ".xz")
+magics = ("\x1f\x8b", "BZh", "PK\x03\x04", "\xfd7zXZ")
+
+formats = ("gzip", "bgzip")
+
+
+def is_compressed(fname):
+    if fname.lower().endswith(compressed_exts):
+        return True
+    with open(fname, 'rb') as f:
+        head = f.read(6)
+    return any(head.startswith(m) for m in magics)
+
+
+def cache_dir(products_dir):
+    return join(products_dir, "compressed")
+
+
+def output_name(fname, cache_dir):
+    """Where the compressed copy of ``fname`` goes: under a directory
+    named for the one ``fname`` is in, keeping its name. Both formats
+    get a ``.gz`` extension; BGZF is valid gzip."""
+    src_dir = os.path.abspath(dirname(fname))
+    if isinstance(src_dir, unicode):
+        src_dir = src_dir.encode("utf-8")
+    return join(cache_dir, hashlib.sha1(src_dir).hexdigest()[:16],
+                basename(fname)+".gz")
+
+
+def needs_compressing(fname):
+    return not is_compressed(fname)
+
+
+def fresh(fname, out_fname):
+    return exists(out_fname) \
+        and os.stat(out_fname).st_mtime >= os.stat(fname).st_mtime
+
+
+# BGZF is a series of gzip members of at most 64 KiB each, with the
+# size of each member in a "BC" extra field, then an empty member
+# marking the end of the file
+_bgzf_block = 0xff00
+_bgzf_eof = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00"
+             "\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+
+
+def _bgzf_member(data, level):
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    deflated = c.compress(data) + c.flush()
+    header = struct.pack("<BBBBIBBHBBHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                         ord("B"), ord("C"), 2, len(deflated)+25)
+    trailer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+    return header + deflated + trailer
+
+
+def bgzip_file(fname, out_fname, level=6, name=None):
+    # BGZF headers don't name the file, so ``name`` goes unused
+    with open(fname, 'rb') as f_in, open(out_fname, 'wb') as f_out:
+        for chunk in iter(lambda: f_in.read(_bgzf_block), b''):
+            f_out.write(_bgzf_member(chunk, level))
+        f_out.write(_bgzf_eof)
+
+
+def gzip_file(fname, out_fname, level=6, name=None):
+    """Gzip ``fname`` to ``out_fname``. The header names the file
+    ``name``, less any ``.gz``; ``out_fname``'s name by default."""
+    with open(fname, 'rb') as f_in, open(out_fname, 'wb') as raw:
+        f_out = gzip.GzipFile(name or basename(out_fname), 'wb', level,
+                              raw, mtime=0)
+        try:
+            for chunk in iter(lambda: f_in.read(CHUNK_SIZE), b''):
+                f_out.write(chunk)
+        finally:
+            f_out.close()
+
+
+writers = {
+    "gzip": gzip_file,
+    "bgzip": bgzip_file,
+}
+
+
+def _compress(args):
+    fname, out_fname, fmt, level = args
+    part = out_fname+".part"
+    try:
+        writers[fmt](fname, part, level, name=basename(out_fname))
+        os.rename(part, out_fname)
+    except (IOError, OSError) as e:
+        print >> sys.stderr, "Unable to compress %s: %s"%(fname, e)
+        return False
+    return True
+
+
+def compress_all(fnames, cache_dir, fmt="gzip", workers=4, level=6):
+    """Compress every file in ``fnames`` that isn't compressed already
+    and whose compressed copy in ``cache_dir`` is missing or older than
+    it, ``workers`` files at a time. Returns True if they all
+    succeeded."""
+    jobs = [ (f, output_name(f, cache_dir), fmt, level) for f in fnames
+             if needs_compressing(f)
+             and not fresh(f, output_name(f, cache_dir)) ]
+    if not jobs:
+        return True
+    for d in set( dirname(job[1]) for job in jobs ):
+        if not os.path.isdir(d):
+            os.makedirs(d)
+    if workers < 2 or len(jobs) == 1:
+        return all(map(_compress, jobs))
+    pool = Pool(min(workers, len(jobs)))
+    try:
+        results = pool.map(_compress, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return all(results)
+
+
+def renamer(cache_dir, enabled=True):
+    """A function giving the name each file will be uploaded under"""
+    def _rename(fname):
+        if not enabled or not needs_compressing(fname):
+            return fname
+        return output_name(fname, cache_dir)
+    return _rename
@@ -0,0 +1,133 @@
+"""Find sequence files that hold the same data under different names.
+
+Files are compared as cheaply as possible: by size, then by a hash of
+a few blocks sampled through the file, and only files that still
+collide after that are hashed in full. Symlinks to the same file are
+duplicates without reading anything.
+
+The duplicates found are written to ``duplicates.json`` in
+``products_dir``, mapping each duplicate to the file that's uploaded in
+its place.
+
+"""
+
+import os
+import json
+import hashlib
+from os.path import join
+from collections import defaultdict
+
+from .manifest import md5sum
+from .compress import renamer
+
+BLOCK_SIZE = 64*1024
+N_BLOCKS = 8
+
+
+def duplicates_fname(products_dir):
+    return join(products_dir, "duplicates.json")
+
+
+def sample_hash(fname, size, block_size=BLOCK_SIZE, n_blocks=N_BLOCKS):
+    """sha1 of ``n_blocks`` blocks spread evenly through the file,
+    first and last included"""
+    h = hashlib.sha1(str(size))
+    if size <= block_size*n_blocks:
+        offsets = [0]
+        block_size = size
+    else:
+        step = (size-block_size) // (n_blocks-1)
+        offsets = [ i*step for i in range(n_blocks) ]
+    with open(fname, 'rb') as f:
+        for offset in offsets:
+            f.seek(offset)
+            h.update(f.read(block_size))
+    return h.hexdigest()
+
+
+def _groups(fnames, key):
+    grouped = defaultdict(list)
+    for f in fnames:
+        grouped[key(f)].append(f)
+    return [ g for g in grouped.itervalues() if len(g) > 1 ]
+
+
+def _hash_all(fnames):
+    return [ md5sum(f) for f in fnames ]
+
+
+def find_duplicates(fnames, hash_all=_hash_all):
+    """Map every file in ``fnames`` that holds the same data as one
+    before it to the first such file.
+
+    :keyword hash_all: Callable; given a list of files, returns a list
+    of hashes of their whole contents. Only called, once, with the
+    files whose size and sampled blocks match another's.
+
+    """
+    order = dict()
+    for f in fnames:
+        order.setdefault(f, len(order))
+    dups = dict()
+    def _add(group):
+        group = sorted(group, key=order.get)
+        for f in group[1:]:
+            dups[f] = group[0]
+
+    by_real = defaultdict(list)
+    for f in order:
+        by_real[os.path.realpath(f)].append(f)
+    for group in by_real.itervalues():
+        if len(group) > 1:
+            _add(group)
+    unique = [ min(g, key=order.get) for g in by_real.itervalues() ]
+
+    sizes = dict( (f, os.stat(f).st_size) for f in unique )
+    candidates = [ f for same_size in _groups(unique, sizes.get)
+                   for same_sample in _groups(
+                       same_size, lambda f: sample_hash(f, sizes[f]))
+                   for f in same_sample ]
+    hashes = dict(zip(candidates, hash_all(candidates)))
+    for same in _groups(candidates, hashes.get):
+        _add(same)
+
+    # a file linked to a duplicate is a duplicate of the same file
+    for f, canonical in dups.items():
+        dups[f] = dups.get(canonical, canonical)
+    return dups
+
+
+def load(fname):
+    if not fname or not os.path.exists(fname):
+        return dict()
+    with open(fname) as f:
+        return json.load(f)
+
+
+def dump(dups, fname):
+    with open(fname+".part", 'w') as f:
+        json.dump(dups, f, indent=2, sort_keys=True)
+    os.rename(fname+".part", fname)
+
+
+def mapper(dups):
+    """A function giving the file uploaded in place of each file"""
+    return lambda fname: dups.get(fname, fname)
+
+
+def for_uploads(fnames, dups, cache_dir=None):
+    """Map each of ``fnames`` that's a duplicate to the one of
+    ``fnames`` uploaded in its place. Files are matched by absolute
+    path; with ``cache_dir``, where :py:mod:`envi_sra.compress` puts
+    compressed copies, a duplicate's compressed copy maps to its
+    original's."""
+    by_path = dict( (os.path.abspath(f), f) for f in fnames )
+    rename = renamer(cache_dir, enabled=bool(cache_dir))
+    ret = dict()
+    for d, c in dups.iteritems():
+        for dup, canonical in ((d, c), (rename(d), rename(c))):
+            dup = by_path.get(os.path.abspath(dup))
+            canonical = by_path.get(os.path.abspath(canonical))
+            if dup is not None and canonical is not None:
+                ret[dup] = canonical
+    return ret
@@ -1,10 +1,16 @@
 import re
 import string
 
+from .util import lru_memo
+from .util import numpy_or_none
+from .util import _memo_key
+
+not_float_chars = re.compile(r'[^.^0-9^+^-]')
+
 def float_please(s):
     "s is a string, hopefully containing floats"
     try:
-        thefloat = float(re.sub(r'[^.^0-9^+^-]', '', s))
+        thefloat = float(not_float_chars.sub('', s))
     except ValueError:
         raise ValueError("No numbers found in `%s'"%(s))
     else:
@@ -45,7 +51,7 @@ def reg_cardinal(d):
     lat, lon = parse_str(d)
     return _reg_cardinal(lat, lon)
 
-def cardinal(d):
+def _cardinal(d):
     """d can be string or 2-tuple of string or 2-tuple of float"""
     lat, lon = parse_str(d)
     if _is_cardinal(lat, lon):
@@ -56,4 +62,45 @@ def cardinal(d):
     lon_dir = "W" if lon < 0 else "E"
     return ("%f %s"%(abs(lat), lat_dir),
             "%f %s"%(abs(lon), lon_dir))
-        
+
+cardinal = lru_memo(maxsize=4096)(_cardinal)
+
+
+def _numeric_many(pairs):
+    """Format (lat, lon) string pairs the way :py:func:`cardinal` formats
+    numeric coordinates, parsing all of them in one pass"""
+    strs = [ not_float_chars.sub('', c) for pair in pairs for c in pair ]
+    np = numpy_or_none()
+    if np is not None:
+        arr = np.array(strs, dtype=float)
+        neg, arr = (arr < 0).tolist(), np.abs(arr).tolist()
+    else:
+        arr = map(float, strs)
+        neg, arr = [ x < 0 for x in arr ], map(abs, arr)
+    return [ ("%f %s"%(arr[i], "S" if neg[i] else "N"),
+              "%f %s"%(arr[i+1], "W" if neg[i+1] else "E"))
+             for i in range(0, len(arr), 2) ]
+
+
+def cardinal_many(values):
+    """Same as ``map(cardinal, values)``, but each distinct value is only
+    parsed once and all the numeric coordinates are converted to
+    floats together"""
+    keys = map(_memo_key, values)
+    uniq = list(set(keys))
+    ret = dict()
+    numeric_keys, numeric_pairs = list(), list()
+    try:
+        for key in uniq:
+            lat, lon = parse_str(key)
+            if _is_cardinal(lat, lon):
+                ret[key] = _reg_cardinal(lat, lon)
+            else:
+                numeric_keys.append(key)
+                numeric_pairs.append((lat, lon))
+        ret.update(zip(numeric_keys, _numeric_many(numeric_pairs)))
+    except ValueError:
+        # go one at a time to raise the same error as cardinal() on the
+        # first bad value
+        return map(cardinal, values)
+    return [ ret[key] for key in keys ]
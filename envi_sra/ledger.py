@@ -0,0 +1,199 @@
+"""Show, and reconcile with the submission server, the local ledger of
+uploads and submissions kept in ``upload_manifest.sqlite`` in
+``products_dir``. See :py:class:`envi_sra.manifest.Manifest`.
+
+Runs decide what's left to do from the ledger alone. Reconciling is
+for when it might not match the server: files uploaded before there
+was a ledger, or by hand, or removed from the server since.
+:py:func:`reconcile` lists each remote directory the ledger knows of
+once, then
+
+* marks files that are on the server at their local size as uploaded,
+  including any of ``--files`` the ledger has no record of, in the
+  remote path or one of its shard directories,
+
+* forgets uploads that aren't on the server, or are only partly there,
+  and removes their ``.complete`` markers, so the next run sends them
+  again, and
+
+* sends submissions whose submission.xml isn't on the server back to
+  ``serialized``, removing their markers too.
+
+Usage::
+
+  python -m envi_sra.ledger products
+
+  python -m envi_sra.ledger products --reconcile --remote-path \\
+      /submit/Study/ --keyfile key --files seqs/*
+
+"""
+
+import os
+import sys
+import argparse
+from os.path import join
+from os.path import exists
+from os.path import dirname
+from os.path import basename
+from collections import Counter
+
+from . import ssh
+from .manifest import Manifest
+from .manifest import manifest_fname
+from .util import submit_path
+
+
+def _remove(fnames):
+    for f in fnames:
+        if exists(f):
+            os.remove(f)
+
+
+def reconcile(manifest, conn, remote_path, fnames=()):
+    """Make the ledger ``manifest`` and the ``.complete`` markers next
+    to what it records agree with what's under ``remote_path`` on the
+    server ``conn`` is connected to.
+
+    :param conn: envi_sra.ssh.SSHConnection; used to list remote
+    directories
+
+    :keyword fnames: List of strings; local files that might have been
+    uploaded to ``remote_path``, or a shard directory in it, without
+    the ledger recording it
+
+    Returns a Counter of what was done: ``found`` for uploads newly
+    marked as done, ``missing`` for uploads forgotten and files in
+    ``fnames`` that aren't there locally, and ``resubmit`` for
+    submissions to send again.
+
+    """
+    listings = dict()
+    def _listing(dest):
+        dest = dest.rstrip("/")
+        if dest not in listings:
+            try:
+                listings[dest] = dict( (f.name, f.size)
+                                       for f in conn.listdir(dest)
+                                       if not f.isdir )
+            except IOError:
+                listings[dest] = dict()
+        return listings[dest]
+
+    counts = Counter()
+    products_dir = dirname(manifest.fname)
+    top = remote_path.rstrip("/")
+    submissions = [ s for s in manifest.submissions() if s['dest'] and (
+        s['dest'].rstrip("/") == top or s['dest'].startswith(top+"/")) ]
+    def _markers(path, dest):
+        # sequence files' markers sit next to them, or in the shard
+        # directory of each submission sent to the same place
+        return [path+".complete"] + [
+            join(dirname(s['path']), basename(path)+".complete")
+            for s in submissions if s['dest'] == dest ]
+
+    for path, dest, md5, state, nbytes in manifest.uploads(remote_path):
+        remote_size = _listing(dest).get(basename(path))
+        here = exists(path) and os.stat(path).st_size == nbytes
+        if remote_size is not None and remote_size == nbytes and here:
+            if state != "uploaded":
+                manifest.mark_uploaded(path, dest)
+                counts['found'] += 1
+            continue
+        manifest.forget(path, dest)
+        _remove(_markers(path, dest))
+        counts['missing'] += 1
+
+    # sharded uploads go in a directory for each shard
+    try:
+        shard_dirs = [ join(remote_path, f.name)
+                       for f in conn.listdir(top)
+                       if f.isdir and f.name.startswith("shard.") ]
+    except IOError:
+        shard_dirs = list()
+    dests = [remote_path] + sorted(
+        set(shard_dirs).union(s['dest'] for s in submissions)
+        .difference([remote_path]))
+    for path in fnames:
+        if path.endswith(".complete"):
+            continue
+        if not exists(path):
+            print >> sys.stderr, "Not found locally: "+path
+            counts['missing'] += 1
+            continue
+        if any(manifest.is_uploaded(path, d) for d in dests):
+            continue
+        size = os.stat(path).st_size
+        for d in dests:
+            if _listing(d).get(basename(path)) == size:
+                manifest.mark_uploaded(path, d)
+                counts['found'] += 1
+                break
+
+    for s in submissions:
+        if s['state'] == "serialized" or \
+           "submission.xml" in _listing(s['dest']):
+            continue
+        manifest.record_submission(s['path'], state="serialized",
+                                   submission_id=None, status=None,
+                                   report=None)
+        d = dirname(s['path'])
+        _remove([ join(d, n+".complete")
+                  for n in ("submission.xml", "submit.ready") ])
+        counts['resubmit'] += 1
+
+    if counts['missing'] or counts['resubmit']:
+        _remove([join(products_dir, "shards.json.complete")])
+    return counts
+
+
+def print_ledger(manifest, out=sys.stdout):
+    states = Counter()
+    sizes = Counter()
+    for path, dest, md5, state, nbytes in manifest.uploads():
+        states[state] += 1
+        sizes[state] += nbytes or 0
+    for state in sorted(states):
+        print >> out, "%-10s %6i files, %14i bytes"%(state, states[state],
+                                                      sizes[state])
+    for s in manifest.submissions():
+        print >> out, "%-10s %-16s %-16s %s"%(
+            s['state'], s['submission_id'] or "-", s['status'] or "-",
+            s['path'])
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("products_dir")
+    parser.add_argument("--reconcile", action="store_true")
+    parser.add_argument("--files", nargs="*", default=[])
+    parser.add_argument("--remote-path", default="/submit/Test/")
+    parser.add_argument("--remote-srv", default="upload.ncbi.nlm.nih.gov")
+    parser.add_argument("--user", default="asp-hmp2")
+    parser.add_argument("--keyfile")
+    parser.add_argument("--port", type=int, default=22)
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    remote_path = submit_path(args.remote_path)
+    manifest = Manifest(manifest_fname(os.path.abspath(args.products_dir)))
+    try:
+        if args.reconcile:
+            conn = ssh.pool.connection(args.user, args.remote_srv,
+                                       args.keyfile, remote_path,
+                                       port=args.port)
+            try:
+                counts = reconcile(manifest, conn, remote_path, args.files)
+            finally:
+                ssh.pool.close()
+            print >> sys.stderr, ("%(found)i uploads found, %(missing)i "
+                                  "missing, %(resubmit)i submissions to "
+                                  "send again")%counts
+        print_ledger(manifest)
+    finally:
+        manifest.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import os
+import errno
+import time
+import hashlib
+import sqlite3
+import threading
+from multiprocessing.pool import ThreadPool
+
+CHUNK_SIZE = 1024*1024
+
+
+def md5sum(fname, chunk_size=CHUNK_SIZE):
+    h = hashlib.md5()
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def manifest_fname(products_dir):
+    return os.path.join(products_dir, "upload_manifest.sqlite")
+
+
+#: reports with these statuses are the last NCBI sends for a submission
+final_statuses = ("processed-ok", "processed-error", "failed")
+
+#: the final status of a submission NCBI accepted
+accepted_status = "processed-ok"
+
+
+class Manifest(object):
+    """Local ledger of the size, mtime and md5 of every file we've
+    uploaded, which md5 was uploaded to which remote directory and how
+    that upload went, and how far each submission has got, kept in a
+    sqlite database. Every change is committed as it's made, so a run
+    that's killed can pick up where it stopped without listing the
+    remote directory.
+
+    A file's checksum is only recomputed when its size or mtime no
+    longer match what's recorded, so checking whether a large,
+    unchanged file has been uploaded costs one ``os.stat``.
+
+    An upload is ``uploading`` from when it starts until it's
+    ``uploaded`` or ``failed``. A submission is ``serialized``, then
+    ``uploaded``, ``submitted`` once its submit.ready is up, and
+    ``reported`` once a report's been downloaded for it; the
+    submission ID and status from the latest report are kept with it.
+
+    :param fname: String; path to the sqlite database, created if it
+    doesn't exist.
+
+    :keyword workers: Integer; how many files to hash at once.
+
+    :keyword readonly: Boolean; only read the ledger, which must
+    already exist; raises IOError if it doesn't. Its tables aren't
+    created, and anything that would write to it,
+    including hashing a file, raises ``sqlite3.OperationalError``.
+
+    """
+
+    schema = """
+    CREATE TABLE IF NOT EXISTS files (
+        path TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        mtime REAL NOT NULL,
+        md5 TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS uploads (
+        path TEXT NOT NULL,
+        dest TEXT NOT NULL,
+        md5 TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'uploaded',
+        bytes INTEGER,
+        updated REAL,
+        PRIMARY KEY (path, dest)
+    );
+    CREATE TABLE IF NOT EXISTS submissions (
+        path TEXT PRIMARY KEY,
+        dest TEXT,
+        md5 TEXT,
+        state TEXT NOT NULL,
+        submission_id TEXT,
+        status TEXT,
+        report TEXT,
+        updated REAL
+    );
+    """
+
+    submission_fields = ("path", "dest", "md5", "state", "submission_id",
+                         "status", "report", "updated")
+
+    def __init__(self, fname, workers=4, readonly=False):
+        self.fname = fname
+        self.workers = workers
+        self.lock = threading.RLock()
+        if readonly and not os.path.exists(fname):
+            # sqlite would make an empty one
+            raise IOError(errno.ENOENT, "No ledger at "+fname)
+        self.db = sqlite3.connect(fname, check_same_thread=False)
+        if readonly:
+            self.db.execute("PRAGMA query_only = ON")
+            return
+        # other processes may be opening the same ledger for the first
+        # time; only one at a time creates the tables
+        self.db.executescript("BEGIN IMMEDIATE;"+self.schema+"COMMIT;")
+
+
+    def _row(self, path):
+        with self.lock:
+            return self.db.execute(
+                "SELECT size, mtime, md5 FROM files WHERE path = ?",
+                (path,)).fetchone()
+
+
+    def _fresh(self, path, row):
+        if row is None:
+            return False
+        st = os.stat(path)
+        return row[0] == st.st_size and row[1] == st.st_mtime
+
+
+    def _hash(self, path):
+        st = os.stat(path)
+        return path, st.st_size, st.st_mtime, md5sum(path)
+
+
+    def refresh(self, paths):
+        """Hash every file in ``paths`` whose size or mtime changed
+        since it was last hashed"""
+        paths = [ os.path.abspath(p) for p in paths ]
+        stale = [ p for p in paths if not self._fresh(p, self._row(p)) ]
+        if not stale:
+            return
+        pool = ThreadPool(max(1, min(self.workers, len(stale))))
+        try:
+            hashed = pool.map(self._hash, stale, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime, md5)"
+                " VALUES (?, ?, ?, ?)", hashed)
+            self.db.commit()
+
+
+    def known_md5(self, path):
+        """The md5 recorded for ``path`` if it hasn't changed size or
+        mtime since, otherwise None. Never hashes the file."""
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            return None
+        row = self._row(path)
+        return row[2] if self._fresh(path, row) else None
+
+
+    def md5(self, path):
+        path = os.path.abspath(path)
+        row = self._row(path)
+        if not self._fresh(path, row):
+            self.refresh([path])
+            row = self._row(path)
+        return row[2]
+
+
+    def is_uploaded(self, path, dest):
+        """True if the current contents of ``path`` have been uploaded
+        to the remote directory ``dest``. Doesn't hash the file unless
+        it's changed on disk; a touched but unchanged file still counts
+        as uploaded."""
+        path = os.path.abspath(path)
+        if not os.path.exists(path):
+            return False
+        md5 = self.md5(path)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT md5 FROM uploads WHERE path = ? AND dest = ?"
+                " AND state = 'uploaded'", (path, dest)).fetchone()
+        return row is not None and row[0] == md5
+
+
+    def status(self, path, dest):
+        """``uploaded`` if ``path`` was uploaded to ``dest`` and hasn't
+        changed size or mtime since, ``changed`` if it has, otherwise
+        ``new``. Never hashes the file."""
+        path = os.path.abspath(path)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT f.size, f.mtime, f.md5 = u.md5 FROM uploads u"
+                " JOIN files f ON f.path = u.path"
+                " WHERE u.path = ? AND u.dest = ? AND u.state = 'uploaded'",
+                (path, dest)).fetchone()
+        if row is None:
+            return "new"
+        if row[2] and self._fresh(path, row):
+            return "uploaded"
+        return "changed"
+
+
+    def _mark(self, path, dest, state):
+        path = os.path.abspath(path)
+        md5 = self.md5(path)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO uploads"
+                " (path, dest, md5, state, bytes, updated)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (path, dest, md5, state, os.stat(path).st_size,
+                 time.time()))
+            self.db.commit()
+
+
+    def mark_started(self, path, dest):
+        self._mark(path, dest, "uploading")
+
+
+    def mark_uploaded(self, path, dest):
+        self._mark(path, dest, "uploaded")
+
+
+    def mark_failed(self, path, dest):
+        path = os.path.abspath(path)
+        with self.lock:
+            self.db.execute(
+                "UPDATE uploads SET state = 'failed', updated = ?"
+                " WHERE path = ? AND dest = ?", (time.time(), path, dest))
+            self.db.commit()
+
+
+    def forget(self, path, dest):
+        """Drop the record of ``path``'s upload to ``dest``, so it's sent
+        again"""
+        with self.lock:
+            self.db.execute("DELETE FROM uploads WHERE path = ? AND dest = ?",
+                            (os.path.abspath(path), dest))
+            self.db.commit()
+
+
+    def uploads(self, dest=None):
+        """(path, dest, md5, state, bytes) for every upload recorded,
+        or only those to ``dest``, with or without a trailing slash, and
+        its subdirectories"""
+        query = "SELECT path, dest, md5, state, bytes FROM uploads"
+        args = ()
+        if dest is not None:
+            # not LIKE, which would take _ and % in dest as wildcards
+            # and ignore case
+            top = dest.rstrip("/")
+            if not isinstance(top, unicode):
+                top = top.decode("utf-8")
+            query += " WHERE dest = ? OR substr(dest, 1, ?) = ?"
+            args = (top, len(top)+1, top+"/")
+        with self.lock:
+            return self.db.execute(query+" ORDER BY dest, path",
+                                   args).fetchall()
+
+
+    def submission(self, path):
+        """What's recorded for the submission ``path`` as a dict with a
+        key for each of ``submission_fields``, or None"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT %s FROM submissions WHERE path = ?"%(
+                    ", ".join(self.submission_fields)),
+                (os.path.abspath(path),)).fetchone()
+        return dict(zip(self.submission_fields, row)) if row else None
+
+
+    def submissions(self):
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT %s FROM submissions ORDER BY path"%(
+                    ", ".join(self.submission_fields))).fetchall()
+        return [ dict(zip(self.submission_fields, row)) for row in rows ]
+
+
+    def record_submission(self, path, **fields):
+        """Update what's recorded for the submission ``path`` with
+        ``fields``; anything not given keeps its recorded value"""
+        path = os.path.abspath(path)
+        with self.lock:
+            row = self.submission(path) or dict(path=path)
+            row.update(fields, updated=time.time())
+            self.db.execute(
+                "INSERT OR REPLACE INTO submissions (%s) VALUES (%s)"%(
+                    ", ".join(self.submission_fields),
+                    ", ".join("?" for _ in self.submission_fields)),
+                [ row.get(k) for k in self.submission_fields ])
+            self.db.commit()
+
+
+    def serialized(self, path):
+        """Record that ``path`` holds a new submission, forgetting
+        anything recorded about an earlier one at the same path"""
+        self.record_submission(path, md5=self.md5(path), state="serialized",
+                               submission_id=None, status=None, report=None)
+
+
+    def reported(self, path):
+        """The report recorded as final for the submission now in
+        ``path``, if it's been downloaded, otherwise None"""
+        row = self.submission(path)
+        if not row or row['status'] not in final_statuses \
+           or not row['report'] or not os.path.exists(row['report']):
+            return None
+        if not os.path.exists(path) or row['md5'] != self.md5(path):
+            return None
+        return row['report']
+
+
+    def uptodate(self, paths, dest):
+        """A doit ``uptodate`` callable that's satisfied when every file
+        in ``paths`` has been uploaded to ``dest``"""
+        def _uptodate(task, values):
+            return all(self.is_uploaded(p, dest) for p in paths)
+        return _uptodate
+
+
+    def close(self):
+        with self.lock:
+            self.db.close()
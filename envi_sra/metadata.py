@@ -0,0 +1,126 @@
+"""Read sample metadata one record at a time.
+
+Three formats are understood: a JSON array of objects, JSON Lines (one
+object per line), and QIIME mapping files (tab-separated, with a
+``#SampleID`` header line).
+
+"""
+
+import re
+import json
+import codecs
+from os.path import splitext
+
+CHUNK_SIZE = 64*1024
+
+_ws = re.compile(r'\s*')
+_decoder = json.JSONDecoder()
+_number_chars = frozenset("0123456789.eE+-")
+
+json_lines_exts = (".jsonl", ".ndjson")
+qiime_exts = (".tsv", ".txt", ".map", ".tab")
+
+
+def iter_json_array(f, chunk_size=CHUNK_SIZE):
+    """Yield each element of the JSON array in file object ``f``
+    without reading the whole array into memory"""
+    decode = codecs.getincrementaldecoder("utf-8")().decode
+    def _fill(buf):
+        chunk = f.read(chunk_size)
+        return buf + decode(chunk, final=not chunk), not chunk
+
+    buf, eof = u"", False
+    while not buf.strip() and not eof:
+        buf, eof = _fill(buf)
+    buf = buf.lstrip()
+    if not buf.startswith("["):
+        raise ValueError("Expected a JSON array")
+    idx, sep, first = 1, False, True
+    while True:
+        idx = _ws.match(buf, idx).end()
+        if idx == len(buf):
+            if eof:
+                raise ValueError("Truncated JSON array")
+            buf, eof = _fill(buf[idx:])
+            idx = 0
+            continue
+        if buf[idx] == "]" and (sep or first):
+            return
+        if sep:
+            if buf[idx] != ",":
+                raise ValueError("Expected `,' or `]' in JSON array")
+            idx, sep = idx+1, False
+            continue
+        try:
+            obj, end = _decoder.raw_decode(buf, idx)
+            # a number or literal could be cut off at the end of buf;
+            # after a whole value only whitespace, `,' or `]' can follow
+            if not eof and (end == len(buf) or buf[end] in _number_chars):
+                raise ValueError("Need more input")
+        except ValueError:
+            if eof:
+                raise ValueError("Truncated or malformed JSON array")
+            buf, eof = _fill(buf[idx:])
+            idx = 0
+            continue
+        yield obj
+        idx, sep, first = end, True, False
+
+
+def iter_json_lines(f):
+    for line in f:
+        line = line.strip()
+        if line:
+            yield json.loads(line)
+
+
+def iter_qiime_mapping(f):
+    """Yield a dict for each sample in a QIIME mapping file, keyed by
+    the header's column names with the leading ``#`` dropped from
+    ``#SampleID``"""
+    header = None
+    for line in f:
+        line = line.decode("utf-8").rstrip("\r\n")
+        if not line.strip():
+            continue
+        if line.startswith("#"):
+            if header is None:
+                header = line[1:].split("\t")
+            continue
+        if header is None:
+            raise ValueError("QIIME mapping file has no #SampleID header")
+        yield dict(zip(header, line.split("\t")))
+
+
+def sniff(fname):
+    """Guess the format of ``fname`` from its extension, or failing that,
+    its first non-blank byte. Returns ``json``, ``jsonl`` or ``qiime``."""
+    ext = splitext(fname)[1].lower()
+    if ext in json_lines_exts:
+        return "jsonl"
+    if ext in qiime_exts:
+        return "qiime"
+    with open(fname, 'rb') as f:
+        head = f.read(CHUNK_SIZE).lstrip()
+    if head.startswith("["):
+        return "json"
+    if head.startswith("{"):
+        return "jsonl"
+    if head.startswith("#"):
+        return "qiime"
+    raise ValueError("Unable to tell what format `%s' is in"%(fname))
+
+
+readers = {
+    "json": iter_json_array,
+    "jsonl": iter_json_lines,
+    "qiime": iter_qiime_mapping,
+}
+
+
+def iter_records(fname, fmt=None):
+    """Yield each sample record in ``fname``, one dict at a time"""
+    fmt = fmt or sniff(fname)
+    with open(fname, 'rb') as f:
+        for rec in readers[fmt](f):
+            yield rec
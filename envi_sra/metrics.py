@@ -0,0 +1,172 @@
+"""Timings and counters for a pipeline run.
+
+Every event, like a task finishing or a file being uploaded, is
+appended as one JSON object per line to ``metrics.jsonl`` in
+``products_dir``. Running totals are kept in memory and written out in
+the Prometheus text format to ``metrics.prom`` after every task, for
+node_exporter's textfile collector to pick up.
+
+"""
+
+import os
+import json
+import time
+import cProfile
+import threading
+from os.path import join
+from contextlib import contextmanager
+
+PREFIX = "envi_sra_"
+
+MB = 1024*1024
+
+
+def _label_str(labels):
+    if not labels:
+        return ""
+    return "{%s}"%(",".join(
+        '%s="%s"'%(k, str(v).replace("\\", "\\\\").replace('"', '\\"')
+                   .replace("\n", "\\n"))
+        for k, v in labels))
+
+
+class Metrics(object):
+    """Collects timings and counters for one run.
+
+    :keyword products_dir: String; where to write ``metrics.jsonl``
+    and ``metrics.prom``. If None, nothing is written to disk.
+
+    """
+
+    def __init__(self, products_dir=None):
+        self.products_dir = products_dir
+        self.lock = threading.Lock()
+        self.values = dict()
+        self.types = dict()
+        self._events = None
+        if products_dir:
+            self.jsonl_fname = join(products_dir, "metrics.jsonl")
+            self.prom_fname = join(products_dir, "metrics.prom")
+
+
+    def _add(self, kind, name, value, labels, replace=False):
+        key = (name, tuple(sorted(labels.iteritems())))
+        with self.lock:
+            self.types.setdefault(name, kind)
+            if replace:
+                self.values[key] = value
+            else:
+                self.values[key] = self.values.get(key, 0) + value
+
+
+    def incr(self, name, value=1, **labels):
+        self._add("counter", name, value, labels)
+
+
+    def gauge(self, name, value, **labels):
+        self._add("gauge", name, value, labels, replace=True)
+
+
+    def observe(self, name, value, **labels):
+        """Add ``value`` to the summary ``name``"""
+        self._add("summary", name+"_count", 1, labels)
+        self._add("summary", name+"_sum", value, labels)
+        with self.lock:
+            self.types[name] = "summary"
+
+
+    def get(self, name, **labels):
+        return self.values.get((name, tuple(sorted(labels.iteritems()))), 0)
+
+
+    def event(self, kind, **fields):
+        if not self.products_dir:
+            return
+        fields['event'] = kind
+        fields['time'] = time.time()
+        line = json.dumps(fields, sort_keys=True)+"\n"
+        with self.lock:
+            if self._events is None:
+                self._events = open(self.jsonl_fname, 'a')
+            self._events.write(line)
+            self._events.flush()
+
+
+    @contextmanager
+    def timed(self, name, **labels):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time()-start, **labels)
+
+
+    def transfer(self, fname, dest, nbytes, seconds, ok, attempt=0):
+        """Record one upload or download of ``nbytes`` bytes"""
+        mbps = nbytes/float(MB)/seconds if seconds > 0 else 0
+        status = "ok" if ok else "failed"
+        self.incr("transfers_total", status=status)
+        if ok:
+            self.incr("transfer_bytes_total", nbytes)
+        self.incr("transfer_seconds_total", seconds)
+        self.event("transfer", file=fname, dest=dest, bytes=nbytes,
+                   seconds=seconds, mb_per_s=mbps, ok=bool(ok),
+                   attempt=attempt)
+
+
+    def action(self, task_name, fn, profile_fname=None):
+        """Wrap the doit python-action ``fn`` so its wall time is recorded
+        under ``task_name``. With ``profile_fname``, the action is run
+        under cProfile and the stats are dumped there."""
+        def _action():
+            start = time.time()
+            ret = None
+            try:
+                if profile_fname:
+                    prof = cProfile.Profile()
+                    try:
+                        ret = prof.runcall(fn)
+                    finally:
+                        prof.dump_stats(profile_fname)
+                else:
+                    ret = fn()
+                return ret
+            finally:
+                elapsed = time.time()-start
+                self.gauge("task_seconds", elapsed, task=task_name)
+                self.incr("task_runs_total", task=task_name)
+                self.event("task", task=task_name, seconds=elapsed,
+                           ok=ret is not False)
+                self.write_prom()
+        return _action
+
+
+    def write_prom(self):
+        if not self.products_dir:
+            return
+        with self.lock:
+            items = sorted(self.values.iteritems())
+            types = dict(self.types)
+        lines, typed = list(), set()
+        for (name, labels), value in items:
+            base = name
+            for suffix in ("_count", "_sum"):
+                if name.endswith(suffix) and types.get(name) == "summary":
+                    base = name[:-len(suffix)]
+            if base not in typed:
+                typed.add(base)
+                lines.append("# TYPE %s%s %s"%(PREFIX, base, types[base]))
+            lines.append("%s%s%s %r"%(PREFIX, name, _label_str(labels),
+                                      float(value)))
+        tmp = self.prom_fname+".part"
+        with open(tmp, 'w') as f:
+            f.write("\n".join(lines)+"\n")
+        os.rename(tmp, self.prom_fname)
+
+
+    def close(self):
+        self.write_prom()
+        with self.lock:
+            if self._events is not None:
+                self._events.close()
+                self._events = None
@@ -1,8 +1,20 @@
 import os
+import sys
 
 import anadama.pipelines
 
+from . import ssh
+from . import plan
+from . import batch
+from . import dedup
+from . import ledger
+from . import seqstats
+from . import validate
 from . import workflows
+from .manifest import Manifest
+from .manifest import manifest_fname
+from .metrics import Metrics
+from .util import submit_path
 
 
 class ENVISRAPipeline(anadama.pipelines.Pipeline):
@@ -16,18 +28,33 @@ class ENVISRAPipeline(anadama.pipelines.Pipeline):
     2. For each raw sequence, download the raw sequence file if it's
     not available locally
 
-    3. Serialize all metadata useful for SRA from OSDF into a
+    3. Check every sample's metadata against what NCBI accepts for
+    MIMS BioSamples
+
+    4. Check that every raw sequence file is well-formed FASTQ or
+    FASTA, and count its reads and bases
+
+    5. Optionally find sequence files holding the same data, so each
+    is only uploaded once
+
+    6. Serialize all metadata useful for SRA from OSDF into a
     submission.xml file
 
-    4. Create an empty submit.empty file.
+    7. Create an empty submit.empty file.
+
+    8. Optionally compress raw sequence files that aren't already
 
-    5. Upload raw sequence files to SRA as necessary
+    9. Upload raw sequence files to SRA as necessary
 
-    6. Upload submission.xml and submit.ready file
+    10. Upload submission.xml and submit.ready file
 
     Workflows used:
 
+    * :py:func:`envi_sra.workflows.validate`
+    * :py:func:`envi_sra.workflows.check`
+    * :py:func:`envi_sra.workflows.dedup`
     * :py:func:`envi_sra.workflows.serialize`
+    * :py:func:`envi_sra.workflows.compress`
     * :py:func:`envi_sra.workflows.upload`
     * :py:func:`envi_sra.workflows.report`
 
@@ -47,20 +74,62 @@ class ENVISRAPipeline(anadama.pipelines.Pipeline):
             "seqinfo_16s": None,
             "wgs_metadata": None,
             "seqinfo_wgs": None,
+            "writer": "etree",
+            "shard_actions": 0,
+            "shard_bytes": 0,
+            "ids": "digest",
+            "incremental": False,
+            "workers": 1,
+            "profile": False,
+        },
+        "validate": {
+            "enabled": True,
+        },
+        "check": {
+            "enabled": True,
+            "workers": 4,
+        },
+        "dedup": {
+            "enabled": False,
+        },
+        "compress": {
+            "format": None,
+            "workers": 4,
+            "level": 6,
         },
         "upload": {
             "keyfile": "/home/rschwager/test_data/broad_metadata/dcc_sra/iHMP_SRA_key",
             "remote_path": "/submit/Test/",
             "remote_srv" : "upload.ncbi.nlm.nih.gov",
             "user": "asp-hmp2",
+            "port": 22,
+            "max_parallel": 4,
+            "retries": 3,
+            "retry_backoff": 5,
+            "hash_workers": 4,
+            "adaptive": True,
+            "max_rate": 0,
         },
         "report": {
-            "products_dir": "reports"
+            "products_dir": "reports",
+            "poll_timeout": 20*60,
+            "poll_interval": 0.5,
+            "poll_max_interval": 30,
+            "poll_backoff": 1.5,
+            "fetch": "newest",
+            "accessions": "accessions.json",
         }
     }
 
+    serialize_paths = ("study_json", "qiime_metadata", "seqinfo_16s",
+                       "wgs_metadata", "seqinfo_wgs")
+
     workflows = {
+        "validate": workflows.validate,
+        "check": workflows.check,
+        "dedup": workflows.dedup,
         "serialize": workflows.serialize,
+        "compress": workflows.compress,
         "upload": workflows.upload,
         "report": workflows.report
     }
@@ -90,6 +159,8 @@ class ENVISRAPipeline(anadama.pipelines.Pipeline):
 
         super(ENVISRAPipeline, self).__init__(*args, **kwargs)
 
+        self.pool = ssh.pool
+
         self.options = self.default_options.copy()
         for k in self.options.iterkeys():
             self.options[k].update(workflow_options.get(k,{}))
@@ -99,22 +170,19 @@ class ENVISRAPipeline(anadama.pipelines.Pipeline):
         self.products_dir = os.path.abspath(products_dir)
         if not os.path.isdir(self.products_dir):
             os.mkdir(self.products_dir)
+        self.metrics = Metrics(self.products_dir)
 
-        for k in self.options['serialize']:
+        for k in self.serialize_paths:
             if not self.options['serialize'].get(k, None):
                 prompt = "Enter the path to the {}: ".format(k)
-                self.options['serialize'][k] = raw_input(prompt)
+                self.options['serialize'][k] = self._ask(prompt)
 
         if not self.options['upload'].get('remote_path', None):
             prompt = "Enter the study name to submit: "
-            self.options['upload']['remote_path'] = raw_input(prompt)
+            self.options['upload']['remote_path'] = self._ask(prompt)
 
-        if not self.options['upload']['remote_path'].endswith('/'):
-            self.options['upload']['remote_path'] += '/'
-
-        if not self.options['upload']['remote_path'].startswith('/submit/'):
-            p = self.options['upload']['remote_path']
-            self.options['upload']['remote_path'] = '/submit/' + p
+        self.options['upload']['remote_path'] = submit_path(
+            self.options['upload']['remote_path'])
 
         self.add_products(
             input_wgs_files = input_wgs_files,
@@ -122,10 +190,81 @@ class ENVISRAPipeline(anadama.pipelines.Pipeline):
         )
 
 
+    @staticmethod
+    def _ask(prompt):
+        # don't wait forever on a prompt nobody can answer
+        if not sys.stdin.isatty():
+            raise ValueError("Missing option; "+prompt.rstrip(": "))
+        return raw_input(prompt)
+
+
+    def plan(self, out=sys.stdout):
+        """Print what a run would submit and upload, without connecting
+        to NCBI. See :py:func:`envi_sra.plan.plan`."""
+        opts = self.options['serialize']
+        p = plan.plan(opts['study_json'], opts['qiime_metadata'],
+                      opts['seqinfo_16s'], self.input_16s_files,
+                      opts['wgs_metadata'], opts['seqinfo_wgs'],
+                      self.input_wgs_files, self.products_dir,
+                      self.options['upload']['remote_path'],
+                      ids=opts['ids'], incremental=opts['incremental'],
+                      compress=self.options['compress']['format'],
+                      dedup=self.options['dedup']['enabled'],
+                      workers=opts['workers'],
+                      shard_actions=opts['shard_actions'],
+                      shard_bytes=opts['shard_bytes'])
+        plan.print_plan(p, out)
+        return p
+
+
+    def reconcile(self):
+        """Bring the local ledger of uploads and submissions in line
+        with what's on NCBI's server. See
+        :py:func:`envi_sra.ledger.reconcile`."""
+        files = self.input_16s_files + self.input_wgs_files
+        if self.options['compress']['format']:
+            files = workflows.compressed_names(files, self.products_dir)
+        opts = self._connection_options()
+        conn = self.pool.connection(opts['user'], opts['remote_srv'],
+                                    opts['keyfile'], opts['remote_path'],
+                                    port=opts['port'], metrics=self.metrics)
+        manifest = Manifest(manifest_fname(self.products_dir))
+        try:
+            return ledger.reconcile(manifest, conn, opts['remote_path'],
+                                    files)
+        finally:
+            conn.close()
+            manifest.close()
+
+
     def _configure(self):
         submission_file = os.path.join(self.products_dir, "submission.xml")
         ready_file = os.path.join(self.products_dir, "submit.ready")
         opts = self.options['serialize']
+        sharded = bool(opts.get('shard_actions') or opts.get('shard_bytes'))
+        mims_errors_fname = None
+        if self.options['validate']['enabled']:
+            yield workflows.validate(opts['qiime_metadata'],
+                                     opts['wgs_metadata'],
+                                     self.products_dir,
+                                     metrics=self.metrics)
+            mims_errors_fname = validate.errors_fname(self.products_dir)
+        check_opts = dict(self.options['check'])
+        seqstats_fname = None
+        if check_opts.pop('enabled'):
+            yield workflows.check(opts['qiime_metadata'],
+                                  self.input_16s_files,
+                                  opts['wgs_metadata'],
+                                  self.input_wgs_files,
+                                  self.products_dir,
+                                  metrics=self.metrics,
+                                  **check_opts)
+            seqstats_fname = seqstats.table_fname(self.products_dir)
+        duplicates_fname = None
+        if self.options['dedup']['enabled']:
+            yield workflows.dedup(self.input_16s_files, self.input_wgs_files,
+                                  self.products_dir, metrics=self.metrics)
+            duplicates_fname = dedup.duplicates_fname(self.products_dir)
         yield workflows.serialize(opts.pop('study_json'),
                                   opts.pop('qiime_metadata'),
                                   opts.pop('seqinfo_16s'),
@@ -136,13 +275,134 @@ class ENVISRAPipeline(anadama.pipelines.Pipeline):
                                   submission_file,
                                   ready_file,
                                   self.products_dir,
+                                  compress=self.options['compress']['format'],
+                                  seqstats_fname=seqstats_fname,
+                                  duplicates_fname=duplicates_fname,
+                                  mims_errors_fname=mims_errors_fname,
+                                  metrics=self.metrics,
                                   **self.options['serialize'])
 
-        yield workflows.upload(self.input_16s_files,
-                               self.input_wgs_files,
+        files_16s, files_wgs = self.input_16s_files, self.input_wgs_files
+        if self.options['compress']['format']:
+            yield workflows.compress(files_16s, files_wgs, self.products_dir,
+                                     metrics=self.metrics,
+                                     **self.options['compress'])
+            files_16s = workflows.compressed_names(files_16s,
+                                                   self.products_dir)
+            files_wgs = workflows.compressed_names(files_wgs,
+                                                   self.products_dir)
+
+        yield workflows.upload(files_16s, files_wgs,
                                submission_file, ready_file,
                                products_dir=self.products_dir,
+                               sharded=sharded, pool=self.pool,
+                               metrics=self.metrics,
+                               duplicates_fname=duplicates_fname,
                                **self.options['upload'])
 
-        yield workflows.report(ready_file+".complete",
-                               **self.options['upload'])
+        report_opts = dict(self.options['report'])
+        report_opts.pop('products_dir', None)
+        report_opts.update(self._connection_options())
+        yield workflows.report(ready_file+".complete", sharded=sharded,
+                               pool=self.pool, metrics=self.metrics,
+                               **report_opts)
+
+    def _connection_options(self):
+        keys = ("user", "remote_srv", "remote_path", "keyfile", "port")
+        return dict( (k, self.options['upload'][k]) for k in keys )
+
+
+def _batch_options():
+    opts = dict( (k, dict(v))
+                 for k, v in ENVISRAPipeline.default_options.iteritems() )
+    for k in ENVISRAPipeline.serialize_paths:
+        del opts['serialize'][k]
+    del opts['upload']['remote_path']
+    opts['batch'] = {
+        "file": None,
+        "workers": 4,
+    }
+    return opts
+
+
+class ENVISRABatchPipeline(anadama.pipelines.Pipeline):
+    """Pipeline for submitting many studies to NCBI's SRA in one run,
+    sharing one upload queue and one SSH connection between them.
+
+    Studies are listed in the batch file given by the ``batch.file``
+    option; see :py:mod:`envi_sra.batch`. Each study goes through the
+    same steps as in :py:class:`ENVISRAPipeline`, except that:
+
+    * ``batch.workers`` studies are serialized at a time, each in a
+      process of its own
+
+    * sequence files from every study go through one upload queue,
+      which takes a file from each study in turn
+
+    * reports for every study are waited on in one polling loop
+
+    Workflows used:
+
+    * :py:func:`envi_sra.workflows.validate`
+    * :py:func:`envi_sra.workflows.check`
+    * :py:func:`envi_sra.workflows.dedup`
+    * :py:func:`envi_sra.workflows.serialize_batch`
+    * :py:func:`envi_sra.workflows.compress`
+    * :py:func:`envi_sra.workflows.upload_batch`
+    * :py:func:`envi_sra.workflows.report`
+
+    """
+
+    name = "ENVISRABatch"
+    products = dict()
+
+    default_options = _batch_options()
+
+    workflows = {
+        "validate": workflows.validate,
+        "check": workflows.check,
+        "dedup": workflows.dedup,
+        "serialize": workflows.serialize_batch,
+        "compress": workflows.compress,
+        "upload": workflows.upload_batch,
+        "report": workflows.report
+    }
+
+    def __init__(self, products_dir=str(), workflow_options=dict(),
+                 *args, **kwargs):
+        """Initialize the pipeline.
+
+        :keyword products_dir: String; Directory path for where outputs
+                               will be saved, a directory per study.
+
+        :keyword workflow_options: Dictionary; **opts to be fed into the
+                                   respective workflow functions.
+
+        """
+
+        super(ENVISRABatchPipeline, self).__init__(*args, **kwargs)
+
+        self.pool = ssh.pool
+
+        self.options = dict( (k, dict(v))
+                             for k, v in self.default_options.iteritems() )
+        for k in self.options.iterkeys():
+            self.options[k].update(workflow_options.get(k,{}))
+
+        if not products_dir:
+            products_dir = self.options['report']['products_dir']
+        self.products_dir = os.path.abspath(products_dir)
+        if not os.path.isdir(self.products_dir):
+            os.mkdir(self.products_dir)
+        self.metrics = Metrics(self.products_dir)
+
+        if not self.options['batch'].get('file', None):
+            prompt = "Enter the path to the batch file: "
+            self.options['batch']['file'] = ENVISRAPipeline._ask(prompt)
+
+
+    def _configure(self):
+        studies = batch.load_batch(self.options['batch']['file'],
+                                   self.products_dir)
+        return batch.configure(studies, self.products_dir, self.options,
+                               pool=self.pool, metrics=self.metrics)
@@ -0,0 +1,231 @@
+"""Work out what a run would submit and upload, without connecting to
+anything.
+
+:py:func:`plan` matches every sample to its sequence file, writes the
+submission a run would upload to ``plan.xml`` in ``products_dir``, and
+works out which sequence files still need uploading from what's on
+local disk: ``.complete`` markers, the upload manifest and the stats
+table :py:func:`envi_sra.workflows.check` writes.
+
+Usage::
+
+  python -m envi_sra.plan study.json metadata_16s.json seqinfo_16s.json \\
+      metadata_wgs.tsv seqinfo_wgs.json --products-dir products \\
+      --remote-path /submit/Study/ --files-16s seqs/Dust* \\
+      --files-wgs seqs/WGS*
+
+"""
+
+import os
+import sys
+import json
+import argparse
+import itertools
+from os.path import join
+from os.path import exists
+from os.path import basename
+from collections import namedtuple
+
+from . import seqstats
+from . import dedup as dedup_
+from .workflows import Bag
+from .workflows import id_schemes
+from .workflows import iter_samples_seqs
+from .xmlstream import write_xml
+from .xmlstream import write_shards
+from .xmlstream import shard_index
+from .xmlstream import referenced_files
+from .xmlstream import Changes
+from .xmlstream import submitted_fname
+from .xmlstream import load_fingerprints
+from .manifest import Manifest
+from .manifest import manifest_fname
+from .compress import renamer
+from .compress import cache_dir as compress_cache_dir
+from .metrics import MB
+from .util import submit_path
+
+Plan = namedtuple("Plan", "submission n_samples files shards")
+PlanEntry = namedtuple("PlanEntry", "path upload_name size status dest")
+
+
+def _status(upload_name, manifest, remote_path):
+    status = "new"
+    if manifest is not None:
+        status = manifest.status(upload_name, remote_path)
+    if status == "new" and exists(upload_name+".complete"):
+        # uploaded before there was a manifest entry for it
+        status = "uploaded"
+    return "pending" if status == "new" else status
+
+
+def plan(study_json, qiime_metadata, seqinfo_16s, files_16s, wgs_metadata,
+         seqinfo_wgs, files_wgs, products_dir, remote_path, ids="digest",
+         incremental=False, compress=None, dedup=False, workers=1,
+         shard_actions=0, shard_bytes=0):
+    """Write the submission :py:func:`envi_sra.workflows.serialize`
+    would, to ``plan.xml`` in ``products_dir``, and list every sequence
+    file it refers to with the size and status of its upload to
+    ``remote_path``: ``uploaded``, ``changed`` since it was uploaded,
+    ``pending`` or ``bad``, if :py:func:`envi_sra.workflows.check`
+    found it malformed.
+
+    Opens no network connections, hashes no files and only reads the
+    upload ledger.
+
+    :keyword ids: String; how to make SPUIDs, as for serialize
+
+    :keyword incremental: Boolean; only write what's new or changed
+    since the last accepted submission, as for serialize
+
+    :keyword compress: String; if set, plan to upload the compressed
+    copies of sequence files
+
+    :keyword dedup: Boolean; refer to duplicates by the files uploaded
+    in their place, as found by the last
+    :py:func:`envi_sra.workflows.dedup`
+
+    :keyword workers: Integer; how many processes to render the
+    submission in
+
+    :keyword shard_actions: Integer; split the submission into shards
+    as serialize would, writing them to ``plan/shard.N`` in
+    ``products_dir``, with the list of them as the plan's submission.
+    Each shard's files go to its own directory under ``remote_path``,
+    as upload would send them.
+
+    :keyword shard_bytes: Integer; as for ``shard_actions``
+
+    Returns a :py:class:`Plan`.
+
+    """
+    files_16s, files_wgs = [
+        [ f for f in files if not f.endswith(".complete") ]
+        for files in (files_16s, files_wgs) ]
+    id_func = id_schemes[ids]
+    rename = renamer(compress_cache_dir(products_dir), bool(compress))
+    dups = dedup_.load(dedup_.duplicates_fname(products_dir)) if dedup \
+           else dict()
+    path_func = lambda path: rename(dups.get(path, path))
+    with open(study_json) as f:
+        st = json.load(f)
+    study = Bag()
+    study.name = st['name']
+    study.description = st['description']
+    study.id = id_func(study.name)
+
+    seqs = list()
+    def _collect(samples_seqs):
+        for sample, seq in samples_seqs:
+            seqs.append(seq.path)
+            seq.path = path_func(seq.path)
+            yield sample, seq
+
+    samples_seqs = itertools.chain(
+        iter_samples_seqs(study, qiime_metadata, seqinfo_16s, files_16s,
+                          cache_dir=products_dir, id_func=id_func),
+        iter_samples_seqs(study, wgs_metadata, seqinfo_wgs, files_wgs,
+                          cache_dir=products_dir, id_func=id_func)
+    )
+    ledger = manifest_fname(products_dir)
+    manifest = Manifest(ledger, readonly=True) if exists(ledger) else None
+    changes = None
+    if incremental:
+        # a file that's changed since it was hashed has no md5, so it
+        # counts as changed, as it most likely is
+        md5 = manifest.known_md5 if manifest is not None else None
+        changes = Changes(load_fingerprints(submitted_fname(products_dir)),
+                          md5)
+    shards = list()
+    if shard_actions or shard_bytes:
+        plan_dir = join(products_dir, "plan")
+        if not os.path.isdir(plan_dir):
+            os.mkdir(plan_dir)
+        shards = write_shards(study, _collect(samples_seqs), plan_dir,
+                              shard_actions, shard_bytes, changes, workers)
+        submission = shard_index(join(plan_dir, "submission.xml"))
+        with open(submission, 'w') as f:
+            json.dump(shards, f, indent=2)
+        dests = dict( (basename(path), join(remote_path, s['name']))
+                      for s in shards for path in s['files'] )
+        referenced = set(dests)
+    else:
+        submission = join(products_dir, "plan.xml")
+        write_xml(study, _collect(samples_seqs), submission, changes,
+                  workers)
+        with open(submission) as f:
+            referenced = referenced_files(f.read())
+        dests = dict.fromkeys(referenced, remote_path)
+
+    table = seqstats.table_fname(products_dir)
+    bad = dict(seqstats.bad_uploads(seqs, table))
+    entries, seen = list(), set()
+    for path in seqs:
+        upload_name = path_func(path)
+        if upload_name in seen or basename(upload_name) not in referenced:
+            continue
+        seen.add(upload_name)
+        size = os.stat(upload_name if exists(upload_name) else path).st_size
+        dest = dests[basename(upload_name)]
+        if path in bad:
+            status = "bad"
+        else:
+            status = _status(upload_name, manifest, dest)
+        entries.append(PlanEntry(path, upload_name, size, status, dest))
+    if manifest is not None:
+        manifest.close()
+    return Plan(submission, len(seqs), entries, shards)
+
+
+def print_plan(p, out=sys.stdout):
+    for e in p.files:
+        print >> out, "%-8s %12i  %s"%(e.status, e.size, e.upload_name)
+    totals = dict()
+    for e in p.files:
+        n, size = totals.get(e.status, (0, 0))
+        totals[e.status] = (n+1, size+e.size)
+    submissions = [ s['submission'] for s in p.shards ] or [p.submission]
+    print >> out, "%i samples; submission: %s, %i bytes%s"%(
+        p.n_samples, p.submission,
+        sum(os.stat(f).st_size for f in submissions),
+        " in %i shards"%(len(p.shards)) if p.shards else "")
+    for status in ("pending", "changed", "uploaded", "bad"):
+        n, size = totals.get(status, (0, 0))
+        print >> out, "%-8s %6i files, %10.1f MB"%(status, n,
+                                                   size/float(MB))
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    for name in ("study_json", "qiime_metadata", "seqinfo_16s",
+                 "wgs_metadata", "seqinfo_wgs"):
+        parser.add_argument(name)
+    parser.add_argument("--files-16s", nargs="*", default=[])
+    parser.add_argument("--files-wgs", nargs="*", default=[])
+    parser.add_argument("--products-dir", default="reports")
+    parser.add_argument("--remote-path", default="/submit/Test/")
+    parser.add_argument("--ids", default="digest", choices=sorted(id_schemes))
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--compress", default=None,
+                        choices=("gzip", "bgzip"))
+    parser.add_argument("--dedup", action="store_true")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--shard-actions", type=int, default=0)
+    parser.add_argument("--shard-bytes", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    if not os.path.isdir(args.products_dir):
+        os.mkdir(args.products_dir)
+    print_plan(plan(args.study_json, args.qiime_metadata, args.seqinfo_16s,
+                    args.files_16s, args.wgs_metadata, args.seqinfo_wgs,
+                    args.files_wgs, os.path.abspath(args.products_dir),
+                    submit_path(args.remote_path), args.ids,
+                    args.incremental, args.compress, args.dedup, args.workers,
+                    args.shard_actions, args.shard_bytes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+import os
+import re
+import sys
+import json
+import hashlib
+from os.path import join
+from os.path import exists
+from os.path import basename
+from collections import Counter
+from collections import defaultdict
+
+
+def find_file(n, h):
+    from anadama.util import matcher
+    return matcher.find_match(n,h, kmer_lengths=(2,3))
+
+
+seq_exts = set(["gz", "bz2", "zip", "fastq", "fq", "fasta", "fa", "fna",
+                "fsa", "sff", "bam", "sra"])
+token_sep = re.compile(r'[._-]')
+
+
+def stem(fname):
+    """Basename of ``fname`` with sequence and compression extensions
+    removed: ``/x/Dust.1_R1.fastq.gz`` -> ``Dust.1_R1``"""
+    name = basename(fname)
+    while True:
+        head, dot, ext = name.rpartition(".")
+        if not dot or ext.lower() not in seq_exts:
+            return name
+        name = head
+
+
+def prefixes(s):
+    """Every prefix of ``s`` that ends on a token boundary, s included"""
+    ret = [ s[:m.start()] for m in token_sep.finditer(s) if m.start() ]
+    ret.append(s)
+    return ret
+
+
+def kmers(s, k):
+    s = s.lower()
+    return set( s[i:i+k] for i in range(len(s)-k+1) )
+
+
+class ResolveError(ValueError):
+    pass
+
+
+class Resolution(object):
+    def __init__(self, mapping, ambiguous, unmatched):
+        self.mapping = mapping
+        self.ambiguous = ambiguous
+        self.unmatched = unmatched
+
+    def report(self, out=sys.stderr):
+        if self.ambiguous:
+            print >> out, "%i samples matched more than one file:"%(
+                len(self.ambiguous))
+            for sample_id, candidates in sorted(self.ambiguous.iteritems()):
+                print >> out, "  %s -> %s (from %s)"%(
+                    sample_id, basename(self.mapping[sample_id]),
+                    ", ".join(map(basename, candidates)))
+        if self.unmatched:
+            print >> out, "%i samples matched no file:"%(len(self.unmatched))
+            for sample_id in self.unmatched:
+                print >> out, "  "+sample_id
+
+    def to_dict(self):
+        return {"mapping": self.mapping, "ambiguous": self.ambiguous,
+                "unmatched": self.unmatched}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['mapping'], d['ambiguous'], d['unmatched'])
+
+
+class SampleResolver(object):
+    """Index over a list of sequence files for matching sample IDs to
+    files in bulk.
+
+    Sample IDs are first looked up in a map from file stems and their
+    token-boundary prefixes; only the samples left over after that
+    are scored against an inverted k-mer index, and then only the
+    files sharing the most k-mers with the sample ID are handed to
+    :py:func:`find_file`. A match is ambiguous if more than one file
+    shares the most k-mers. Sample IDs too short to have a k-mer are
+    matched to the files whose stems contain them.
+
+    """
+
+    def __init__(self, files, k=3, max_candidates=25):
+        self.files = list(files)
+        self.k = k
+        self.max_candidates = max_candidates
+        self.exact = defaultdict(list)
+        self.prefix = defaultdict(list)
+        self.kmer_index = defaultdict(list)
+        for i, f in enumerate(self.files):
+            s = stem(f)
+            self.exact[s].append(i)
+            for p in prefixes(s)[:-1]:
+                self.prefix[p].append(i)
+            for kmer in kmers(s, k):
+                self.kmer_index[kmer].append(i)
+
+    def _candidates(self, sample_id):
+        """Returns the indexes of candidate files, best first, how many
+        of them are equally good, and whether they were found by name
+        rather than scored"""
+        hits = self.exact.get(sample_id) or self.prefix.get(sample_id)
+        if hits:
+            return hits, len(hits), True
+        if len(sample_id) < self.k:
+            needle = sample_id.lower()
+            hits = [ i for i, f in enumerate(self.files)
+                     if needle in stem(f).lower() ]
+            return hits, len(hits), True
+        counts = Counter()
+        for kmer in kmers(sample_id, self.k):
+            counts.update(self.kmer_index.get(kmer, ()))
+        best = counts.most_common(self.max_candidates)
+        tied = sum(1 for _, n in best if n == best[0][1]) if best else 0
+        return [i for i, _ in best], tied, False
+
+    def resolve_one(self, sample_id):
+        """Returns a tuple of (matched file or None, list of
+        candidates if the match was ambiguous)"""
+        idxs, tied, named = self._candidates(sample_id)
+        candidates = [ self.files[i] for i in idxs ]
+        if not candidates:
+            return None, []
+        if len(candidates) == 1 and named:
+            return candidates[0], []
+        match = find_file(sample_id, candidates)
+        return match, candidates[:tied] if tied > 1 else []
+
+    def resolve(self, sample_ids):
+        mapping, ambiguous, unmatched = dict(), dict(), list()
+        for sample_id in sample_ids:
+            if sample_id in mapping:
+                continue
+            match, candidates = self.resolve_one(sample_id)
+            if match is None:
+                unmatched.append(sample_id)
+                continue
+            mapping[sample_id] = match
+            if candidates:
+                ambiguous[sample_id] = candidates
+        return Resolution(mapping, ambiguous, unmatched)
+
+
+def digest(sample_ids, files):
+    h = hashlib.sha1()
+    for sample_id in sample_ids:
+        h.update(sample_id.encode("utf-8")+"\0")
+    h.update("\1")
+    for f in files:
+        h.update(f.encode("utf-8")+"\0")
+    return h.hexdigest()
+
+
+def _load_cache(cache_fname, d):
+    if not exists(cache_fname):
+        return None
+    with open(cache_fname) as f:
+        cached = json.load(f)
+    if cached.get("digest") != d:
+        return None
+    return Resolution.from_dict(cached)
+
+
+def resolve(sample_ids, files, cache_dir=None, key=None):
+    """Match every sample ID to one of ``files``, raising
+    :py:class:`ResolveError` listing every sample that didn't
+    match. When ``cache_dir`` is given, the result is stored there
+    and reused on the next run with the same inputs.
+
+    :keyword key: String; what the sample IDs are from, e.g. their
+    metadata file. The cached result for the same ``key`` is replaced
+    when the inputs change, rather than kept alongside. Without it,
+    results are cached under a digest of the sample IDs and file list.
+
+    """
+    sample_ids, files = list(sample_ids), list(files)
+    d = digest(sample_ids, files)
+    cache_fname = res = None
+    if cache_dir:
+        if key:
+            if isinstance(key, unicode):
+                key = key.encode("utf-8")
+            name = hashlib.sha1(key).hexdigest()
+        else:
+            name = d
+        cache_fname = join(cache_dir, "sample_files.%s.json"%(name))
+        res = _load_cache(cache_fname, d)
+    if res is None:
+        res = SampleResolver(files).resolve(sample_ids)
+        if cache_fname and not res.unmatched:
+            tmp = cache_fname+".tmp"
+            with open(tmp, 'w') as f:
+                json.dump(dict(res.to_dict(), digest=d), f)
+            os.rename(tmp, cache_fname)
+
+    res.report()
+    if res.unmatched:
+        raise ResolveError("Unable to find files for %i samples: %s"%(
+            len(res.unmatched), ", ".join(res.unmatched)))
+    return res.mapping
@@ -0,0 +1,229 @@
+"""Read counts, base counts, read length distributions and format
+checks for FASTQ and FASTA files.
+
+Each file is read once, front to back, with a large buffer. Results are
+kept in a TSV table and only recomputed for files whose size or mtime
+changed since they were last scanned.
+
+"""
+
+import io
+import os
+import bz2
+import sys
+import gzip
+from zlib import error as zlib_error
+from collections import Counter
+from multiprocessing import Pool
+
+from . import compress
+
+BUFFER_SIZE = 4*1024*1024
+
+valid_bases = "ACGTNacgtnRYKMSWBDHVrykmswbdhv.-"
+
+fields = ("path", "size", "mtime", "format", "reads", "bases", "min_len",
+          "max_len", "lengths", "error")
+
+
+def table_fname(products_dir):
+    return os.path.join(products_dir, "seqstats.tsv")
+
+
+def _open(fname):
+    lower = fname.lower()
+    if lower.endswith(".gz") or lower.endswith(".bgz"):
+        return io.BufferedReader(gzip.open(fname, 'rb'), BUFFER_SIZE)
+    if lower.endswith(".bz2"):
+        return bz2.BZ2File(fname, 'rb', BUFFER_SIZE)
+    return open(fname, 'rb', BUFFER_SIZE)
+
+
+class FormatError(ValueError):
+    pass
+
+
+def _fastq(f, first, lengths):
+    it = iter(f)
+    n = 0
+    header = first
+    while header:
+        n += 1
+        if not header.startswith("@"):
+            raise FormatError("read %i: header doesn't start with @"%(n))
+        seq, plus, qual = next(it, ""), next(it, ""), next(it, "")
+        if not qual:
+            raise FormatError("read %i: truncated record"%(n))
+        if not plus.startswith("+"):
+            raise FormatError("read %i: no + separator line"%(n))
+        seq, qual = seq.rstrip("\r\n"), qual.rstrip("\r\n")
+        if len(seq) != len(qual):
+            raise FormatError("read %i: %i bases but %i quality scores"%(
+                n, len(seq), len(qual)))
+        if seq.translate(None, valid_bases):
+            raise FormatError("read %i: invalid bases"%(n))
+        lengths[len(seq)] += 1
+        header = next(it, "")
+        while header in ("\n", "\r\n"):
+            header = next(it, "")
+
+
+def _fasta(f, first, lengths):
+    n, length = 0, None
+    for line in _chain(first, f):
+        if line.startswith(">"):
+            if length is not None:
+                if not length:
+                    raise FormatError("record %i: no sequence"%(n))
+                lengths[length] += 1
+            n += 1
+            length = 0
+            continue
+        line = line.rstrip("\r\n")
+        if line.translate(None, valid_bases):
+            raise FormatError("record %i: invalid bases"%(n))
+        length += len(line)
+    if length is not None:
+        if not length:
+            raise FormatError("record %i: no sequence"%(n))
+        lengths[length] += 1
+
+
+def _chain(first, f):
+    yield first
+    for line in f:
+        yield line
+
+
+def scan(fname):
+    """Stats for one sequence file as a dict with a key for each of
+    ``fields``. ``error`` describes what's wrong with the file, or is
+    empty if nothing is."""
+    st = os.stat(fname)
+    ret = dict(path=fname, size=st.st_size, mtime=st.st_mtime, format="",
+               reads=0, bases=0, min_len=0, max_len=0, lengths="", error="")
+    lengths = Counter()
+    try:
+        with _open(fname) as f:
+            first = f.readline()
+            while first in ("\n", "\r\n"):
+                first = f.readline()
+            if first.startswith("@"):
+                ret['format'] = "fastq"
+                _fastq(f, first, lengths)
+            elif first.startswith(">"):
+                ret['format'] = "fasta"
+                _fasta(f, first, lengths)
+            elif not first:
+                raise FormatError("empty file")
+            else:
+                raise FormatError("neither FASTQ nor FASTA")
+    except (FormatError, IOError, EOFError, zlib_error) as e:
+        ret['error'] = str(e) or type(e).__name__
+    if lengths:
+        ret['reads'] = sum(lengths.itervalues())
+        ret['bases'] = sum(l*c for l, c in lengths.iteritems())
+        ret['min_len'], ret['max_len'] = min(lengths), max(lengths)
+        ret['lengths'] = ",".join("%i:%i"%(l, lengths[l])
+                                  for l in sorted(lengths))
+    return ret
+
+
+def _scan(fname):
+    try:
+        return scan(fname)
+    except OSError as e:
+        return dict(path=fname, size=0, mtime=0, format="", reads=0,
+                    bases=0, min_len=0, max_len=0, lengths="", error=str(e))
+
+
+def _parse_row(line):
+    row = dict(zip(fields, line.rstrip("\n").split("\t")))
+    for k in ("size", "reads", "bases", "min_len", "max_len"):
+        row[k] = int(row[k])
+    row['mtime'] = float(row['mtime'])
+    return row
+
+
+def load_table(fname):
+    """Read a stats table into a dict of path -> stats"""
+    if not os.path.exists(fname):
+        return dict()
+    with open(fname) as f:
+        f.readline()
+        rows = ( _parse_row(line) for line in f if line.strip() )
+        return dict( (row['path'], row) for row in rows )
+
+
+def write_table(stats, fname):
+    with open(fname+".part", 'w') as f:
+        f.write("\t".join(fields)+"\n")
+        for path in sorted(stats):
+            row = stats[path]
+            f.write("\t".join(repr(row[k]) if k == "mtime"
+                              else str(row[k]).replace("\t", " ")
+                              for k in fields)+"\n")
+    os.rename(fname+".part", fname)
+
+
+def _fresh(row, fname):
+    try:
+        st = os.stat(fname)
+    except OSError:
+        return False
+    return row['size'] == st.st_size and row['mtime'] == st.st_mtime
+
+
+def scan_all(fnames, table, workers=4):
+    """Scan every file in ``fnames`` that isn't already in the stats
+    table ``table`` with the same size and mtime, ``workers`` at a
+    time, largest first. The table is updated and the stats for
+    ``fnames`` returned as a dict of path -> stats."""
+    stats = load_table(table)
+    stale = [ f for f in set(fnames)
+              if f not in stats or not _fresh(stats[f], f) ]
+    stale.sort(key=lambda f: os.stat(f).st_size if os.path.exists(f) else 0,
+               reverse=True)
+    if len(stale) > 1 and workers > 1:
+        pool = Pool(min(workers, len(stale)))
+        try:
+            results = pool.imap_unordered(_scan, stale)
+            for row in results:
+                stats[row['path']] = row
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for row in map(_scan, stale):
+            stats[row['path']] = row
+    if stale or not os.path.exists(table):
+        write_table(stats, table)
+    return dict( (f, stats[f]) for f in fnames )
+
+
+def bad_files(stats):
+    return sorted( (path, row['error']) for path, row in stats.iteritems()
+                   if row['error'] )
+
+
+def report_bad(bad, out=sys.stderr):
+    for path, error in bad:
+        print >> out, "Bad sequence file %s: %s"%(path, error)
+
+
+def bad_uploads(fnames, table):
+    """Those of ``fnames`` the stats table ``table`` has as bad, as
+    (path, error) pairs. A file matches a bad one by its absolute path,
+    or by the path of its compressed copy in the products directory
+    ``table`` is in."""
+    cache_dir = compress.cache_dir(os.path.dirname(os.path.abspath(table)))
+    bad = dict()
+    for p, e in bad_files(load_table(table)):
+        bad[os.path.abspath(p)] = e
+        bad[os.path.abspath(compress.output_name(p, cache_dir))] = e
+    ret = list()
+    for f in fnames:
+        path = os.path.abspath(f)
+        if path in bad:
+            ret.append((f, bad[path]))
+    return ret
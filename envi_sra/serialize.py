@@ -69,8 +69,20 @@ def indent(elem, level=0):
 def reg_text(t):
     return " ".join(t.split())
 
-def reg_sample(s):
-    s['lat_lon'] = " ".join(geo.cardinal(s['lat_lon']))
+#: what NCBI takes in place of a value it doesn't have
+missing_values = frozenset(["missing", "not applicable", "not collected",
+                            "not provided", "restricted access"])
+
+def is_missing(v):
+    return isinstance(v, basestring) and v.strip().lower() in missing_values
+
+def reg_sample(s, lat_lon=None):
+    if is_missing(s['lat_lon']):
+        # NCBI takes its own missing values as they are
+        return s
+    if lat_lon is None:
+        lat_lon = geo.cardinal(s['lat_lon'])
+    s['lat_lon'] = " ".join(lat_lon)
     return s
 
 
@@ -132,8 +144,8 @@ reqd_mims_keys = ['rel_air_humidity', 'organism_count',
                   'light_type']
 
 
-def _add_biosample(root, st, sample):
-    sample = reg_sample(sample)
+def _add_biosample(root, st, sample, lat_lon=None):
+    sample = reg_sample(sample, lat_lon)
     ret = hier_sub(root, "Action", children=[
         eld("AddData", attrs={"target_db":"BioSample"}, children=[
             eld("Data", attrs={"content_type":"xml"}, children=[
@@ -189,8 +201,14 @@ def to_xml(st, samples_seqs):
     root = ET.Element('Submission')
     root = _add_description(root, st)
     root = _add_bioproject(root, st)
-    for sample, seq in samples_seqs:
-        root = _add_biosample(root, st, sample)
+    # read twice: once for the coordinates, then for the actions
+    samples_seqs = list(samples_seqs)
+    values = [ s['lat_lon'] for s, _ in samples_seqs ]
+    parsed = iter(geo.cardinal_many([ v for v in values
+                                      if not is_missing(v) ]))
+    lat_lons = [ None if is_missing(v) else next(parsed) for v in values ]
+    for (sample, seq), lat_lon in zip(samples_seqs, lat_lons):
+        root = _add_biosample(root, st, sample, lat_lon)
         root = _add_sra(root, st, sample, seq)
     return root
 
@@ -1,69 +1,275 @@
 import os
+import re
 import time
+import stat
 import pipes
 import socket
-import string
 import operator
+import functools
+import threading
 from os.path import join, basename
-
-import paramiko
+from collections import namedtuple
 
 
 last = operator.itemgetter(-1)
 
+RemoteFile = namedtuple("RemoteFile", "name size mtime isdir")
+
+ls_line = re.compile(r'^[-dlbcps][-rwxsStTl]{9}')
+
+def parse_ls(output):
+    """Parse the output of ``ls -l`` into a list of RemoteFile. Lines
+    that don't look like a listing entry, like the echoed command,
+    the ``total`` line or the shell prompt, are skipped."""
+    ret = list()
+    for line in output.splitlines():
+        line = line.strip()
+        if not ls_line.match(line):
+            continue
+        fields = line.split(None, 8)
+        if len(fields) < 9:
+            continue
+        try:
+            size = int(fields[4])
+        except ValueError:
+            continue
+        name = fields[8]
+        if fields[0].startswith("l"):
+            name = name.split(" -> ")[0]
+        ret.append(RemoteFile(basename(name), size, None,
+                              fields[0].startswith("d")))
+    return ret
+
+
+def timed(op):
+    """Record the wall time of each call as one round trip in the
+    connection's metrics, if it has any"""
+    def _decorator(fn):
+        @functools.wraps(fn)
+        def _timed(self, *args, **kwargs):
+            if self.metrics is None:
+                return fn(self, *args, **kwargs)
+            with self.metrics.timed("ssh_rtt_seconds", op=op,
+                                    mode=self.mode):
+                return fn(self, *args, **kwargs)
+        return _timed
+    return _decorator
+
+
+def connect(user, host, keyfile, port=22):
+    """Open and authenticate a transport to ``host``"""
+    import paramiko
+    key = paramiko.RSAKey.from_private_key_file(keyfile)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.connect((host, port))
+    transport = paramiko.Transport(sock)
+    transport.start_client()
+    transport.auth_publickey(user, key)
+    return transport
+
+
+def healthy(transport):
+    import paramiko
+    if not transport.is_active() or not transport.is_authenticated():
+        return False
+    try:
+        transport.send_ignore()
+    except (EOFError, socket.error, paramiko.SSHException):
+        return False
+    return True
+
+
+class ConnectionPool(object):
+    """Authenticated transports shared by every SSHConnection in the
+    process, one per (user, host, keyfile, port). A transport that's
+    gone away is replaced the next time it's asked for.
+
+    Connections on the same transport also share one SFTP session, so
+    however many remote directories are in use at once, they don't run
+    into the server's limit on sessions per connection (10 by default
+    for OpenSSH).
+
+    :keyword keepalive: Integer; seconds between keepalive packets on
+    idle transports, 0 to disable.
+
+    """
+
+    def __init__(self, keepalive=30):
+        self.keepalive = keepalive
+        self.transports = dict()
+        self.sftps = dict()
+        self.lock = threading.Lock()
+
+
+    def transport(self, user, host, keyfile, port=22):
+        key = (user, host, keyfile, port)
+        with self.lock:
+            t = self.transports.get(key)
+            if t is not None and not healthy(t):
+                self.sftps.pop(t, None)
+                t.close()
+                t = None
+            if t is None:
+                t = connect(user, host, keyfile, port)
+                if self.keepalive:
+                    t.set_keepalive(self.keepalive)
+                self.transports[key] = t
+            return t
+
+
+    def sftp(self, transport):
+        """The SFTP session shared by every connection on ``transport``,
+        opened the first time it's asked for"""
+        import paramiko
+        with self.lock:
+            s = self.sftps.get(transport)
+            if s is None or s.get_channel().closed:
+                s = paramiko.SFTPClient.from_transport(transport)
+                self.sftps[transport] = s
+            return s
+
+
+    def connection(self, user, host, keyfile, remote_path, mode="auto",
+                   port=22, metrics=None):
+        """An SSHConnection for ``remote_path`` on a pooled transport"""
+        return SSHConnection(user, host, keyfile, remote_path, mode=mode,
+                             port=port, pool=self, metrics=metrics)
+
+
+    def close(self):
+        with self.lock:
+            for t in self.transports.itervalues():
+                t.close()
+            self.transports.clear()
+            self.sftps.clear()
+
+
+pool = ConnectionPool()
+
+
 class SSHConnection(object):
-    def __init__(self, user, host, keyfile, remote_path):
-        self.remote_path = remote_path
-        self.key = paramiko.RSAKey.from_private_key_file(keyfile)
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.connect((host, 22))
-        self.transport = paramiko.Transport(self.sock)
-        self.transport.start_client()
-        self.transport.auth_publickey(user, self.key)
-        self.chan = self.transport.open_session()
-        self.chan.get_pty()
-        self.chan.invoke_shell()
-        self._recvall()
-        self._path_check()
-        self.file_cache = self._build_file_cache()
+    """Connection to NCBI's submission server.
+
+    :keyword mode: String; ``sftp`` to list and stat files over SFTP
+    and run commands with one exec channel per command, ``shell`` to
+    drive an interactive shell, or ``auto`` to use sftp and fall back
+    to shell if the server doesn't offer the sftp subsystem.
+
+    :keyword pool: ConnectionPool; take the transport, and the SFTP
+    session, from this pool instead of opening new ones. Closing the
+    connection leaves both open for others.
+
+    :keyword metrics: envi_sra.metrics.Metrics; record the latency of
+    every round trip to the server here.
+
+    The remote path isn't looked at until it's first used; see
+    :py:meth:`ensure_path`.
+
+    """
+
+    def __init__(self, user, host, keyfile, remote_path, mode="auto",
+                 port=22, pool=None, metrics=None):
+        self.remote_path = remote_path.rstrip('/')
+        self.pool = pool
+        self.metrics = metrics
+        self.mode = None
+        self._args = (user, host, keyfile, port)
+        self._checked = False
+        self._file_cache = None
+        self._open(mode)
+
+    def _open(self, mode):
+        import paramiko
+        if self.pool is not None:
+            self.transport = self.pool.transport(*self._args)
+        else:
+            self.transport = connect(*self._args)
+        self.sftp, self.chan = None, None
+        if mode in ("auto", "sftp"):
+            try:
+                if self.pool is not None:
+                    self.sftp = self.pool.sftp(self.transport)
+                else:
+                    self.sftp = paramiko.SFTPClient.from_transport(
+                        self.transport)
+            except (paramiko.SSHException, EOFError):
+                if mode == "sftp":
+                    raise
+        self.mode = "sftp" if self.sftp else "shell"
+        if self.mode == "shell":
+            self.chan = self.transport.open_session()
+            self.chan.get_pty()
+            self.chan.invoke_shell()
+            self._recvall()
+
+    def ensure_active(self):
+        """Reconnect if the transport has dropped since the last call"""
+        if not healthy(self.transport):
+            self.close()
+            self._open(self.mode)
+
+    def _close_channels(self):
+        import paramiko
+        # a pooled SFTP session is shared with other connections
+        own = (self.chan,) if self.pool is not None \
+              else (self.sftp, self.chan)
+        for c in own:
+            if c is None:
+                continue
+            try:
+                c.close()
+            except (EOFError, socket.error, paramiko.SSHException):
+                pass
+        self.sftp, self.chan = None, None
+
+    def close(self):
+        self._close_channels()
+        if self.pool is None:
+            self.transport.close()
+
+    def ensure_path(self):
+        """Make the remote path a directory if it isn't one. Only looks
+        the first time it's called, which every method that works in
+        the remote path does."""
+        if not self._checked:
+            self._path_check()
+            self._checked = True
+
+    @property
+    def file_cache(self):
+        """Remote path -> size of each file in the remote path, as
+        first listed"""
+        if self._file_cache is None:
+            self._file_cache = self._build_file_cache()
+        return self._file_cache
 
     def _path_check(self):
-        self.remote_path = self.remote_path.rstrip('/')
         head, tail = os.path.split(self.remote_path)
-        ret = self.execute("ls -l "+head)
-        fields = map(string.split, ret.strip().split('\r\n')[2:-1])
-        names = dict(  zip(map(last, fields), fields) )
+        names = dict( (f.name, f) for f in self.listdir(head) )
         if tail not in names:
-            self.execute("mkdir --mode=0775 "+self.remote_path)
+            self.mkdir(self.remote_path)
             return
-        if tail in names and not names[tail][0].startswith("d"):
-            self.execute("rm "+self.remote_path)
-            self.execute("mkdir --mode=0775 "+self.remote_path)
+        if tail in names and not names[tail].isdir:
+            self.remove(self.remote_path)
+            self.mkdir(self.remote_path)
             return
 
 
     def _build_file_cache(self):
-        cache = dict()
-        output = self.execute("ls -l "+self.remote_path).strip()
-        for line in output.split('\r\n')[2:-1]:
-            fields = line.split(None, 8)
-            name = os.path.join(self.remote_path, fields[-1])
-            try:
-                size = int(fields[4])
-            except ValueError:
-                continue
-            cache[name] = size
-        return cache
-            
+        return dict( (join(self.remote_path, f.name), f.size)
+                     for f in self.listdir() if not f.isdir )
+
 
     def _wait(self, tries=5):
         for i in range(tries):
             time.sleep(0.125)
+            if self.metrics is not None:
+                self.metrics.incr("ssh_shell_wait_seconds_total", 0.125)
             if self.chan.recv_ready():
                 return True
         return False
 
-        
+
     def _recvall(self):
         ret = str()
         while True:
@@ -75,24 +281,105 @@ class SSHConnection(object):
         return ret
 
 
+    def _exec(self, cmd):
+        chan = self.transport.open_session()
+        try:
+            chan.exec_command(cmd)
+            ret = chan.makefile('rb').read()
+            chan.recv_exit_status()
+        finally:
+            chan.close()
+        return ret
+
+
+    @timed("execute")
     def execute(self, cmd, verbose=False):
-        if not cmd.endswith("\n"):
-            cmd += "\n"
         if verbose:
             print "sending `%s'"%(cmd)
+        return self._run(cmd)
+
+
+    def _run(self, cmd):
+        if self.mode == "sftp":
+            return self._exec(cmd.rstrip("\n"))
+        if not cmd.endswith("\n"):
+            cmd += "\n"
         self.chan.send(cmd)
         return self._recvall()
 
 
+    @timed("listdir")
+    def listdir(self, path=None):
+        """List the contents of ``path``, the remote path by default,
+        as a list of RemoteFile"""
+        if not path:
+            self.ensure_path()
+        path = path or self.remote_path
+        if self.mode == "sftp":
+            return [ RemoteFile(a.filename, a.st_size, a.st_mtime,
+                                stat.S_ISDIR(a.st_mode))
+                     for a in self.sftp.listdir_attr(path) ]
+        return parse_ls(self._run("ls -l "+pipes.quote(path)))
+
+
+    @timed("mkdir")
+    def mkdir(self, path):
+        if self.mode == "sftp":
+            return self.sftp.mkdir(path, 0775)
+        self._run("mkdir --mode=0775 "+pipes.quote(path))
+
+
+    @timed("remove")
+    def remove(self, path):
+        if self.mode == "sftp":
+            return self.sftp.remove(path)
+        self._run("rm "+pipes.quote(path))
+
+
+    @timed("fsize")
     def fsize(self, fname):
-        quoted = pipes.quote(join(self.remote_path, fname))
-        output = self.execute("ls -l "+quoted).split("\n")[1].strip()
-        try:
-            return int(output.split(None, 8)[4])
-        except ValueError:
-            return None
-        except IndexError:
+        self.ensure_path()
+        path = join(self.remote_path, fname)
+        if self.mode == "sftp":
+            try:
+                return self.sftp.stat(path).st_size
+            except IOError as e:
+                raise OSError(str(e))
+        output = self._run("ls -l "+pipes.quote(path))
+        entries = parse_ls(output)
+        if not entries:
             raise OSError(output)
+        return entries[0].size
+
+
+    def mtime(self, path=None):
+        """Modification time of ``path``, the remote path by default.
+        Returns None in shell mode, where there's no cheap way to get
+        it."""
+        if self.mode != "sftp":
+            return None
+        if not path:
+            self.ensure_path()
+        return self._stat(path or self.remote_path).st_mtime
+
+    @timed("stat")
+    def _stat(self, path):
+        return self.sftp.stat(path)
+
+
+    def get(self, fnames, local_dir):
+        """Download ``fnames`` from the remote path into ``local_dir``
+        over the open SFTP session. Each file is renamed into place
+        once it's complete."""
+        self.ensure_path()
+        for fname in fnames:
+            local = join(local_dir, basename(fname))
+            start = time.time()
+            self.sftp.get(join(self.remote_path, fname), local+".part")
+            os.rename(local+".part", local)
+            if self.metrics is not None:
+                self.metrics.transfer(fname, local_dir, os.stat(local).st_size,
+                                      time.time()-start, True)
 
 
     def uptodate(self, task, values):
@@ -100,9 +387,9 @@ class SSHConnection(object):
             if not os.path.exists(fname):
                 return False
             remote_fname = join(self.remote_path, basename(fname))
-            if remote_fname not in self.file_cache:
+            if self.file_cache.get(remote_fname) != os.stat(fname).st_size:
                 return False
-            return self.file_cache[remote_fname] == os.stat(fname).st_size
+        return True
 
     def files(self):
-        return self.execute("ls "+self.remote_path).strip().split('\r\n')[1:-1]
+        return [ f.name for f in self.listdir() ]
@@ -0,0 +1,158 @@
+"""Compact records of samples and their sequence files.
+
+Serialize makes a (sample, seq) pair for every record in a study's
+metadata, and studies run to millions of records. A dict for every
+sample and an object with an instance dict for every sequence file
+cost far more than the values in them, so instead:
+
+* :py:class:`Seq` keeps its fields in slots, sharing the seqinfo
+  strings with every other sequence file described by the same
+  seqinfo file
+
+* :py:class:`Sample` reads like the dict its record was read from,
+  but keeps only a list of values, sharing the column names with
+  every other sample that has the same columns
+
+* :py:class:`SampleStore` holds the pairs for a whole study, keeping
+  one copy of values repeated from sample to sample, like most MIMS
+  attributes, and finds pairs by SPUID
+
+"""
+
+import itertools
+
+
+class Seq(object):
+    """A sequence file, as submitted to SRA"""
+    __slots__ = ("path", "seq_model", "lib_const", "method", "id")
+
+    def __init__(self, path, seq_model, lib_const, method, id=None):
+        self.path = path
+        self.seq_model = seq_model
+        self.lib_const = lib_const
+        self.method = method
+        self.id = id
+
+
+class Sample(object):
+    """A sample's metadata record. Reads and writes like a dict.
+
+    :param columns: Dict; column name -> index in ``values``. Shared
+    by every sample with the same columns; see :py:class:`Layouts`.
+
+    :param values: List; the record's values, in column order
+
+    """
+    __slots__ = ("columns", "values", "id")
+
+    def __init__(self, columns, values, id=None):
+        self.columns = columns
+        self.values = values
+        self.id = id
+
+    def get(self, key, default=None):
+        i = self.columns.get(key)
+        return default if i is None else self.values[i]
+
+    def __getitem__(self, key):
+        return self.values[self.columns[key]]
+
+    def __setitem__(self, key, value):
+        i = self.columns.get(key)
+        if i is None:
+            # don't change the columns of every other sample
+            self.columns = dict(self.columns)
+            i = self.columns[key] = len(self.values)
+            self.values.append(value)
+        self.values[i] = value
+
+    def __contains__(self, key):
+        return key in self.columns
+
+    def __len__(self):
+        return len(self.columns)
+
+    def keys(self):
+        return sorted(self.columns, key=self.columns.get)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [ (k, self.values[self.columns[k]]) for k in self.keys() ]
+
+    def __repr__(self):
+        return "Sample(%r, %r)"%(self.id, dict(self.items()))
+
+
+class Layouts(object):
+    """Hands out one columns dict for each distinct list of column
+    names"""
+
+    def __init__(self):
+        self.layouts = dict()
+
+    def __call__(self, keys):
+        keys = tuple(keys)
+        columns = self.layouts.get(keys)
+        if columns is None:
+            columns = dict( (k, i) for i, k in enumerate(keys) )
+            self.layouts[keys] = columns
+        return columns
+
+    def sample(self, rec, id=None, intern=None):
+        """Make a :py:class:`Sample` of the dict ``rec``, passing each
+        value through ``intern``, if given"""
+        keys = rec.keys()
+        values = [ rec[k] for k in keys ]
+        if intern is not None:
+            values = map(intern, values)
+        return Sample(self(keys), values, id)
+
+
+class SampleStore(object):
+    """The (sample, seq) pairs of a study, in the order they were
+    added. Iterates over the pairs; ``store[i]`` is the ``i``th pair
+    and ``store.lookup(spuid)`` is the pair with that sample or
+    sequence SPUID.
+
+    """
+
+    def __init__(self):
+        self.samples = list()
+        self.seqs = list()
+        self.index = dict()
+        self.layouts = Layouts()
+        self.strings = dict()
+
+    def intern(self, value):
+        """One copy of each distinct string value. Other values are
+        returned as they are."""
+        if isinstance(value, basestring):
+            return self.strings.setdefault(value, value)
+        return value
+
+    def add(self, sample, seq):
+        row = len(self.samples)
+        self.samples.append(sample)
+        self.seqs.append(seq)
+        for obj in (sample, seq):
+            if obj.id is not None:
+                self.index[obj.id] = row
+
+    def extend(self, samples_seqs):
+        for sample, seq in samples_seqs:
+            self.add(sample, seq)
+        return self
+
+    def lookup(self, spuid):
+        return self[self.index[spuid]]
+
+    def __getitem__(self, row):
+        return self.samples[row], self.seqs[row]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __iter__(self):
+        return itertools.izip(self.samples, self.seqs)
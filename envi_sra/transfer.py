@@ -0,0 +1,387 @@
+import os
+import sys
+import time
+import itertools
+import threading
+import subprocess
+from os.path import join
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+from .metrics import MB
+
+
+def fsize(fname):
+    return os.stat(fname).st_size
+
+
+def touch(fname):
+    open(fname, 'w').close()
+
+
+def fair_order(jobs, group):
+    """``jobs`` reordered to take one from each group in turn, as given
+    by calling ``group`` on each job, keeping their order within each
+    group"""
+    queues = OrderedDict()
+    for job in jobs:
+        queues.setdefault(group(job), list()).append(job)
+    return [ job for turn in itertools.izip_longest(*queues.values())
+             for job in turn if job is not None ]
+
+
+class AsperaBackend(object):
+    """Moves files to and from NCBI's submission server with ascp.
+
+    Anything with the same ``upload`` and ``download`` methods, and a
+    ``rate`` attribute, can stand in for it, e.g. to test against a
+    local server.
+
+    :keyword ascp: String; the ascp to run when uploading at a set rate
+
+    """
+
+    def __init__(self, remote_srv, user, keyfile, ascp="ascp"):
+        self.remote_srv = remote_srv
+        self.user = user
+        self.keyfile = keyfile
+        self.ascp = ascp
+        #: bytes per second each upload aims for; 0 leaves it to ascp
+        self.rate = 0
+
+    def upload(self, local_fname, dest):
+        """Put ``local_fname`` in the remote directory ``dest``; returns
+        True on success"""
+        if self.rate:
+            return self._ascp(local_fname, dest, self.rate)
+        from cutlass.aspera import aspera as asp
+        return asp.upload_file(self.remote_srv, self.user, None,
+                               local_fname, dest, keyfile=self.keyfile)
+
+    def command(self, local_fname, dest, rate):
+        """The ascp command line that uploads ``local_fname`` to ``dest``
+        at ``rate`` bytes per second: the same as cutlass runs, with
+        the target rate set. Transfers stay encrypted."""
+        return [self.ascp, "-d", "-k", "1", "-i", self.keyfile,
+                "-l", "%iK"%(max(1, rate*8/1000)), local_fname,
+                "%s@%s:%s"%(self.user, self.remote_srv, dest)]
+
+    def _ascp(self, local_fname, dest, rate):
+        # cutlass always runs ascp at its default target rate
+        proc = subprocess.Popen(self.command(local_fname, dest, rate),
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            print >> sys.stderr, "ascp failed uploading %s:\n%s"%(
+                local_fname, output)
+            return False
+        return True
+
+    def download(self, remote_fname, local_dir):
+        from cutlass.aspera import aspera as asp
+        return asp.download_file(self.remote_srv, self.user, None,
+                                 remote_fname, local_dir,
+                                 keyfile=self.keyfile)
+
+
+class RateController(object):
+    """Decides how many uploads run at once, and how fast each is asked
+    to go, from the throughput they actually get.
+
+    Uploads are measured in rounds of as many as are running at once,
+    the first from when :py:meth:`start` is called. Each round that
+    moves more bytes per second than the best round so far, by more
+    than ``gain``, adds one to the uploads allowed at once; a round
+    that doesn't takes the last one back away, and the number then
+    holds, trying one more again every ``probe_rounds`` rounds. A
+    failed upload, or a round ``drop`` slower than the best, cuts the
+    number by ``decrease``.
+
+    With a ``ceiling``, each upload is asked to go at the ceiling split
+    between the uploads allowed at once, so together they never go
+    over it and don't push the site's link into loss. Uploads aren't
+    added once a round's reached the ceiling. Without one, only the
+    number of uploads at once adapts; each goes at ascp's own target
+    rate.
+
+    :keyword max_parallel: Integer; the most uploads to run at once
+
+    :keyword ceiling: Number; bytes per second all uploads together
+    may use, 0 for no limit
+
+    :keyword adaptive: Boolean; if False, always run ``max_parallel``
+    uploads at once, only measuring them
+
+    :keyword start: Integer; how many uploads to run at once at first
+
+    :keyword backend: If given, its ``rate`` is kept at the rate each
+    upload should aim for
+
+    """
+
+    def __init__(self, max_parallel=4, ceiling=0, adaptive=True, start=2,
+                 backend=None, gain=0.1, drop=0.25, decrease=0.5,
+                 probe_rounds=5):
+        self.max_parallel = max(1, int(max_parallel))
+        self.ceiling = float(ceiling)
+        self.adaptive = adaptive
+        self.parallel = min(max(1, start), self.max_parallel) \
+                        if adaptive else self.max_parallel
+        self.backend = backend
+        self.gain, self.drop, self.decrease = gain, drop, decrease
+        self.probe_rounds = probe_rounds
+        self.cond = threading.Condition()
+        self.active = 0
+        self.best = 0
+        self.throughput = 0
+        self.grew = False
+        self.held = 0
+        self.round_start = None
+        self.round_bytes = 0
+        self.round_done = 0
+        self._set_rate()
+
+
+    def rate(self):
+        """Bytes per second each upload should aim for, 0 for as fast
+        as it can"""
+        if not self.ceiling:
+            return 0
+        return self.ceiling / self.parallel
+
+
+    def _set_rate(self):
+        if self.backend is not None:
+            self.backend.rate = self.rate()
+
+
+    def _new_round(self):
+        self.round_start = time.time()
+        self.round_bytes = 0
+        self.round_done = 0
+
+
+    def start(self):
+        """Start a new round, as uploads are about to be sent; time
+        spent before then isn't counted against them"""
+        with self.cond:
+            self._new_round()
+
+
+    def _resize(self, parallel):
+        self.parallel = min(max(1, parallel), self.max_parallel)
+        self._set_rate()
+
+
+    def _end_round(self):
+        elapsed = time.time() - self.round_start
+        self.throughput = self.round_bytes / elapsed if elapsed > 0 else 0
+        self._new_round()
+        if not self.adaptive:
+            return
+        at_ceiling = self.ceiling and self.throughput >= 0.9*self.ceiling
+        if self.throughput > self.best*(1+self.gain):
+            self.best = self.throughput
+            self.held = 0
+            self.grew = not at_ceiling and self.parallel < self.max_parallel
+            if self.grew:
+                self._resize(self.parallel+1)
+        elif self.throughput < self.best*(1-self.drop):
+            self._cut()
+        elif self.grew:
+            # the last one added didn't help
+            self.grew = False
+            self._resize(self.parallel-1)
+        else:
+            self.held += 1
+            if self.held >= self.probe_rounds and not at_ceiling:
+                self.held = 0
+                self.grew = self.parallel < self.max_parallel
+                self._resize(self.parallel+1)
+
+
+    def _cut(self):
+        self._resize(int(self.parallel*self.decrease))
+        self.best = self.throughput
+        self.grew = False
+        self.held = 0
+
+
+    def acquire(self):
+        """Wait for a turn to upload"""
+        with self.cond:
+            if self.round_start is None:
+                self._new_round()
+            while self.active >= self.parallel:
+                self.cond.wait()
+            self.active += 1
+
+
+    def release(self, nbytes, ok):
+        """Finish a turn that moved ``nbytes``, successfully or not"""
+        with self.cond:
+            self.active -= 1
+            if not ok:
+                if self.adaptive:
+                    self._cut()
+            else:
+                self.round_bytes += nbytes
+                self.round_done += 1
+                if self.round_done >= self.parallel:
+                    self._end_round()
+            self.cond.notify_all()
+
+
+class UploadScheduler(object):
+    """Upload files over a bounded pool of worker threads.
+
+    Files are started largest first so a big WGS file doesn't end up
+    as the only transfer running at the end of the queue. Failed
+    uploads are retried with exponential backoff; each file that
+    uploads successfully gets its ``.complete`` marker written right
+    away.
+
+    :param send: Callable; given a local filename and the remote
+    directory to put it in, uploads it and returns True on success.
+
+    :keyword max_parallel: Integer; the number of uploads to run at
+    once.
+
+    :keyword retries: Integer; how many times to retry a failed upload.
+
+    :keyword backoff: Number; seconds to wait before the first retry,
+    doubled for every retry after that.
+
+    :keyword done: Callable; called with the local filename and remote
+    directory after each successful upload.
+
+    :keyword failed: Callable; called with the local filename and
+    remote directory when an upload's given up on.
+
+    :keyword metrics: envi_sra.metrics.Metrics; record the size, time
+    taken and outcome of every attempt here, and the bytes left to
+    upload, the estimated time to upload them, how many uploads are
+    running at once and the rate they're asked for.
+
+    :keyword controller: RateController; decides how many uploads run
+    at once. Defaults to ``max_parallel``, always.
+
+    :keyword progress_interval: Number; seconds between progress lines
+    on stderr, 0 for none
+
+    """
+
+    def __init__(self, send, max_parallel=4, retries=3, backoff=5,
+                 done=None, metrics=None, failed=None, controller=None,
+                 progress_interval=30):
+        self.send = send
+        self.done = done
+        self.failed = failed
+        self.metrics = metrics
+        self.max_parallel = max(1, int(max_parallel))
+        self.retries = retries
+        self.backoff = backoff
+        self.controller = controller or RateController(self.max_parallel,
+                                                       adaptive=False)
+        self.progress_interval = progress_interval
+        self.lock = threading.Lock()
+        self.remaining = 0
+        self.left = 0
+        self.last_progress = 0
+
+
+    def eta(self):
+        """Seconds until every file queued is uploaded at the
+        throughput measured so far, or None before there's any"""
+        if not self.controller.throughput:
+            return None
+        return self.remaining / self.controller.throughput
+
+
+    def _progress(self, nbytes):
+        with self.lock:
+            self.remaining -= nbytes
+            self.left -= 1
+            eta = self.eta()
+            c = self.controller
+            if self.metrics is not None:
+                self.metrics.gauge("upload_bytes_remaining", self.remaining)
+                self.metrics.gauge("upload_parallel", c.parallel)
+                self.metrics.gauge("upload_rate_bytes", c.rate())
+                if eta is not None:
+                    self.metrics.gauge("upload_eta_seconds", eta)
+            now = time.time()
+            if not self.progress_interval or eta is None or \
+               now - self.last_progress < self.progress_interval:
+                return
+            self.last_progress = now
+        print >> sys.stderr, ("%i files, %.1f MB left to upload at "
+                              "%.1f MB/s, %i at once; about %i s to go")%(
+            self.left, self.remaining/float(MB), c.throughput/float(MB),
+            c.parallel, eta)
+
+
+    def _attempt(self, local_fname, dest, attempt=0):
+        nbytes = fsize(local_fname)
+        self.controller.acquire()
+        start = time.time()
+        try:
+            ret = self.send(local_fname, dest)
+        except Exception as e:
+            print >> sys.stderr, "Upload of %s failed: %s"%(local_fname, e)
+            ret = False
+        self.controller.release(nbytes, ret)
+        if self.metrics is not None:
+            self.metrics.transfer(local_fname, dest, nbytes,
+                                  time.time()-start, ret, attempt)
+        return ret
+
+
+    def _run_one(self, job):
+        local_fname, complete_fname, dest = job
+        for attempt in range(self.retries+1):
+            if attempt:
+                time.sleep(self.backoff * 2**(attempt-1))
+            if self._attempt(local_fname, dest, attempt):
+                if self.done:
+                    self.done(local_fname, dest)
+                touch(complete_fname)
+                self._progress(fsize(local_fname))
+                return True
+        print >> sys.stderr, "Giving up on %s after %i tries"%(
+            local_fname, self.retries+1)
+        if self.failed:
+            self.failed(local_fname, dest)
+        self._progress(fsize(local_fname))
+        return False
+
+
+    def run(self, jobs, group=None):
+        """Upload every (local filename, complete filename, remote
+        directory) tuple in ``jobs``. Returns True if every upload
+        succeeded.
+
+        :keyword group: Callable; given a job, the group it belongs to,
+        e.g. its study. Uploads are started from each group in turn, so
+        one group with many files doesn't hold up the rest.
+
+        """
+        jobs = sorted(jobs, key=lambda j: fsize(j[0]), reverse=True)
+        if group is not None:
+            jobs = fair_order(jobs, group)
+        if not jobs:
+            return True
+        with self.lock:
+            self.remaining += sum(fsize(j[0]) for j in jobs)
+            self.left += len(jobs)
+        self.controller.start()
+        # enough threads for the most uploads the controller might
+        # allow; it decides how many of them go at once
+        pool = ThreadPool(min(self.controller.max_parallel, len(jobs)))
+        try:
+            results = pool.map(self._run_one, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return all(results)
@@ -1,5 +1,14 @@
+import os
+import re
 import sys
-import xml.etree.ElementTree as ET
+import json
+import codecs
+from os.path import splitext
+from collections import namedtuple
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
 
 def handle_error(r):
     obj_id = r.iter("Object").next().get("spuid")
@@ -17,24 +26,147 @@ def handle_ok(r):
     return " ".join(spuids)
 
 
-def print_report(report_fname):
-    resps = ET.parse(report_fname).getroot().iter("Response")
-    oks, errors = list(), list()
-    for resp in resps:
-        if 'status' not in resp.attrib:
+def is_ok(status):
+    return 'ok' in status or 'continue' in status
+
+
+Accession = namedtuple("Accession",
+                       "spuid status accession target_db messages")
+
+
+def iter_responses(report_fname):
+    """Yield each Response element in ``report_fname`` that has a
+    status. Elements are cleared once the caller's done with them, so
+    memory use doesn't grow with the size of the report."""
+    context = iter(ET.iterparse(report_fname, events=("start", "end")))
+    _, root = next(context)
+    for event, el in context:
+        if event != "end":
             continue
-        s = resp.attrib['status']
-        if 'ok' in s or 'continue' in s:
-            oks.append(handle_ok(resp))
+        if el.tag == "Response":
+            if 'status' in el.attrib:
+                yield el
+            el.clear()
+        elif el.tag == "Action":
+            root.clear()
+
+
+def report_status(report_fname):
+    """The submission ID and overall status ``report_fname`` gives, from
+    its root element, without reading the rest of it"""
+    _, root = next(iter(ET.iterparse(report_fname, events=("start",))))
+    return root.get("submission_id"), root.get("status")
+
+
+def accessions(resp):
+    """An Accession for each Object in Response ``resp``"""
+    status = resp.attrib['status']
+    messages = [ m.text.strip() for m in resp.iter("Message")
+                 if m.text and m.text.strip() ]
+    for obj in resp.iter("Object"):
+        yield Accession(obj.get("spuid"), status, obj.get("accession", ""),
+                        obj.get("target_db", ""), messages)
+
+
+def _tsv_field(s):
+    return s.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n")
+
+
+_tsv_escapes = {"n": "\n", "t": "\t", "\\": "\\"}
+_tsv_escape = re.compile(r"\\([nt\\])")
+
+def _from_tsv_field(s):
+    # in one pass, so an escaped backslash before an n stays one
+    return _tsv_escape.sub(lambda m: _tsv_escapes[m.group(1)], s)
+
+
+class IndexWriter(object):
+    """Write Accessions out as they're found, either as a JSON object
+    keyed by spuid or as TSV with a header line; ``fname``'s extension
+    decides which. In TSV, an Accession's messages are a JSON list,
+    since they can hold any character. A spuid that shows up twice
+    keeps its last entry when read back with :py:func:`load_index`."""
+
+    tsv_fields = Accession._fields
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.tsv = splitext(fname)[1].lower() in (".tsv", ".txt")
+        self.f = codecs.open(fname+".part", 'w', "utf-8")
+        self.n = 0
+        if self.tsv:
+            self.f.write("\t".join(self.tsv_fields)+"\n")
         else:
-            errors.append(handle_error(resp))
+            self.f.write("{")
+
+    def write(self, acc):
+        if self.tsv:
+            row = acc[:-1] + (json.dumps(list(acc.messages)),)
+            self.f.write("\t".join(_tsv_field(v or "") for v in row)+"\n")
+        else:
+            self.f.write(",\n" if self.n else "\n")
+            self.f.write(json.dumps(acc.spuid)+": ")
+            self.f.write(json.dumps(dict(zip(acc._fields[1:], acc[1:]))))
+        self.n += 1
+
+    def close(self):
+        if not self.tsv:
+            self.f.write("\n}\n")
+        self.f.close()
+        os.rename(self.fname+".part", self.fname)
 
-    for ok in oks:
-        print >> sys.stderr, "OK --  "+ ok
-        print >> sys.stderr, "-------"
 
-    if errors:
+def load_index(fname):
+    """Read an index written by :py:func:`index_report` into a dict of
+    spuid -> Accession"""
+    ret = dict()
+    with codecs.open(fname, 'r', "utf-8") as f:
+        if splitext(fname)[1].lower() not in (".tsv", ".txt"):
+            for spuid, d in json.load(f).iteritems():
+                ret[spuid] = Accession(spuid=spuid, **d)
+            return ret
+        f.readline()
+        for line in f:
+            row = [ _from_tsv_field(v) for v in line.rstrip("\n").split("\t") ]
+            ret[row[0]] = Accession(*(row[:-1]+[json.loads(row[-1])]))
+    return ret
+
+
+def index_report(report_fname, index_fname=None, out=None):
+    """Read ``report_fname`` one Response at a time. Writes an
+    Accession for each Object to ``index_fname`` if given, and
+    describes each Response on ``out`` if given, the way
+    :py:func:`print_report` does: OKs as they're read, then errors.
+
+    Returns True if no Response had an error.
+
+    """
+    writer = IndexWriter(index_fname) if index_fname else None
+    errors = list()
+    try:
+        for resp in iter_responses(report_fname):
+            if is_ok(resp.attrib['status']):
+                if out:
+                    print >> out, "OK --  "+ handle_ok(resp)
+                    print >> out, "-------"
+            else:
+                errors.append(handle_error(resp))
+            if writer:
+                for acc in accessions(resp):
+                    writer.write(acc)
+    finally:
+        if writer:
+            writer.close()
+    if out:
         for error in errors:
-            print >> sys.stderr, "ERROR --  "+error
-            print >> sys.stderr, "----------"
+            print >> out, "ERROR --  "+error
+            print >> out, "----------"
+    return not errors
+
+
+def print_report(report_fname, index_fname=None):
+    """Print every OK and error in ``report_fname`` to stderr, and
+    optionally write the spuid index to ``index_fname``; see
+    :py:func:`index_report`. Returns False if there were errors."""
+    if not index_report(report_fname, index_fname, out=sys.stderr):
         return False
@@ -1,4 +1,7 @@
 import re
+import hashlib
+from functools import wraps
+from collections import OrderedDict
 
 def reportnum(fname):
     x = re.sub(r'\D+', '', fname)
@@ -6,3 +9,74 @@ def reportnum(fname):
         return int(x)
     else:
         return 0
+
+
+def submit_path(path):
+    """``path`` as a directory under NCBI's ``/submit/``"""
+    if not path.endswith('/'):
+        path += '/'
+    if not path.startswith('/submit/'):
+        path = '/submit/' + path
+    return path
+
+
+def digest(v, length=20):
+    """Hex digest of the string ``v`` that's the same in every
+    interpreter, unlike the builtin hash()"""
+    if isinstance(v, unicode):
+        v = v.encode("utf-8")
+    return hashlib.sha1(v).hexdigest()[:length]
+
+
+def numpy_or_none():
+    """numpy, or None if it isn't installed. Imported the first time
+    it's needed, so importing envi_sra doesn't load it."""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _memo_key(arg):
+    if isinstance(arg, list):
+        return tuple(arg)
+    return arg
+
+
+def lru_memo(maxsize=4096):
+    """Memoize a function of one argument, keeping at least the
+    ``maxsize`` most recently used results and never more than twice
+    that. Lists are looked up as tuples; arguments that can't be
+    hashed skip the cache.
+
+    Results are kept in two generations instead of a strict LRU list
+    so a cache hit costs a single dict lookup: when the current
+    generation fills up it becomes the old one, and old results are
+    promoted back into the current generation when they're used.
+
+    """
+    missing = object()
+    def decorator(fn):
+        gens = [dict(), dict()] # current, old
+        @wraps(fn)
+        def wrapped(arg):
+            key = _memo_key(arg)
+            current = gens[0]
+            try:
+                ret = current.get(key, missing)
+            except TypeError:
+                return fn(arg)
+            if ret is not missing:
+                return ret
+            ret = gens[1].get(key, missing)
+            if ret is missing:
+                ret = fn(arg)
+            if len(current) >= maxsize:
+                gens[:] = [dict(), current]
+            gens[0][key] = ret
+            return ret
+        wrapped.cache_clear = lambda: gens.__setitem__(
+            slice(None), [dict(), dict()])
+        return wrapped
+    return decorator
@@ -0,0 +1,363 @@
+"""Check sample metadata against what NCBI accepts for MIMS
+BioSamples, before anything's serialized or uploaded.
+
+Every record in the metadata files is checked for:
+
+* every one of ``serialize.reqd_mims_keys``, and a SampleID, with a
+  value; NCBI's own ``missing``, ``not collected`` and so on count
+
+* no SampleID used twice
+
+* a ``lat_lon`` :py:func:`envi_sra.geo.cardinal` can read, within
+  +/-90 degrees of latitude and +/-180 of longitude
+
+* a ``collection_date`` in one of the formats NCBI takes:
+  ``2015``, ``2015-03``, ``2015-03-21``, ``2015-03-21T10:30Z``,
+  ``21-Mar-2015``, ``Mar-2015``, or a range of two of them joined by
+  ``/``
+
+* a value from the MIxS vocabulary for the attributes in
+  :py:data:`vocabularies`, and a leading number for those in
+  :py:data:`numeric_keys`
+
+Records are read ``CHUNK_SIZE`` at a time into a column for each
+attribute. Each distinct value in a column is only checked once, so
+the cost of a check goes with the number of distinct values, not the
+number of samples.
+
+Every error found goes in a table, ``mims_errors.tsv`` in
+``products_dir``, with a row for each bad value.
+
+Usage::
+
+  python -m envi_sra.validate metadata_16s.json metadata_wgs.tsv \\
+      --products-dir products
+
+"""
+
+import os
+import re
+import sys
+import argparse
+import operator
+import itertools
+from datetime import datetime
+from collections import Counter
+
+from . import geo
+from .serialize import reqd_mims_keys
+from .serialize import is_missing
+from .metadata import iter_records
+from .util import _memo_key
+from .util import numpy_or_none
+
+CHUNK_SIZE = 64*1024
+
+fields = ("file", "record", "sample_id", "attribute", "value", "error")
+
+vocabularies = {
+    "building_setting": ["urban", "suburban", "exurban", "rural"],
+    "build_occup_type": ["office", "market", "restaurant", "residence",
+                         "school", "residential", "commercial", "low rise",
+                         "high rise", "wood framed", "health care",
+                         "airport", "sports complex"],
+    "filter_type": ["particulate air filter", "chemical air filter",
+                    "low-MERV pleated media", "HEPA", "electrostatic",
+                    "gas-phase or ultraviolet air treatments"],
+    "heat_cool_type": ["radiant system", "heat pump", "forced air system",
+                       "steam forced heat", "wood stove"],
+    "indoor_space": ["bedroom", "office", "bathroom", "foyer", "kitchen",
+                     "locker room", "hallway", "elevator"],
+    "light_type": ["natural light", "electric light", "no light"],
+    "space_typ_state": ["typically occupied", "typically unoccupied"],
+}
+
+numeric_keys = ("rel_air_humidity", "abs_air_humidity", "air_temp",
+                "carb_dioxide", "occup_samp", "occupant_dens_samp",
+                "typ_occupant_dens")
+
+_number = re.compile(r'\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?')
+
+_coords_pattern = (r'[ \t]*([-+]?\d+(?:\.\d+)?)[ \t]*([NSns]?)[, \t]+'
+                   r'([-+]?\d+(?:\.\d+)?)[ \t]*([EWew]?)[ \t]*')
+_coords = re.compile(_coords_pattern+r'\Z')
+_coords_lines = re.compile(r'^(%s)$'%(_coords_pattern), re.M)
+_signed = "`%s' has a negative coordinate and a direction"
+_out_of_range = "coordinates out of range"
+
+_month = r'(?:0[1-9]|1[0-2])'
+_day = r'(?:0[1-9]|[12]\d|3[01])'
+_iso = (r'\d{4}(?:-%s(?:-%s(?:T(?:[01]\d|2[0-3])(?::[0-5]\d){1,2}'
+        r'(?:\.\d+)?(?:Z|[+-]\d\d:?\d\d)?)?)?)?')%(_month, _day)
+_dmy = (r'(?:(?:0?[1-9]|[12]\d|3[01])-)?'
+        r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)-\d{4}')
+_one_date = r'(?:%s|%s)'%(_iso, _dmy)
+_date = re.compile(r'(%s)(?:/(%s))?\Z'%(_one_date, _one_date))
+
+
+def errors_fname(products_dir):
+    return os.path.join(products_dir, "mims_errors.tsv")
+
+
+def _text(value):
+    if isinstance(value, basestring):
+        return value
+    if isinstance(value, (list, tuple)):
+        return u" ".join(map(unicode, value))
+    return unicode(value)
+
+
+def _real_date(d):
+    # the pattern allows the 31st of every month
+    try:
+        if d[4:5] == "-":
+            datetime.strptime(d[:10], "%Y-%m-%d")
+        else:
+            datetime.strptime(d, "%d-%b-%Y")
+    except ValueError:
+        return False
+    return True
+
+
+def check_date(value):
+    m = _date.match(_text(value).strip())
+    if not m:
+        return "not a date NCBI accepts, like 2015-03-21"
+    for d in m.groups():
+        if not d:
+            continue
+        has_day = len(d) >= 10 if d[4:5] == "-" else d.count("-") == 2
+        if has_day and not _real_date(d):
+            return "no such day"
+    return None
+
+
+def _coords_of(value):
+    m = _coords.match(value) if isinstance(value, basestring) else None
+    if m and bool(m.group(2)) == bool(m.group(4)):
+        lat, ns, lon, ew = m.groups()
+        lat, lon = float(lat), float(lon)
+        if ns and (lat < 0 or lon < 0):
+            raise ValueError(_signed%(value))
+        return lat, lon
+    lat, lon = geo.cardinal(value)
+    return geo.float_please(lat), geo.float_please(lon)
+
+
+def check_lat_lon(value):
+    try:
+        lat, lon = _coords_of(value)
+    except ValueError as e:
+        return str(e)
+    if abs(lat) > 90 or abs(lon) > 180:
+        return _out_of_range
+    return None
+
+
+def _floats(strs, np):
+    if np is not None:
+        return np.array(strs, dtype=float)
+    return map(float, strs)
+
+
+def check_lat_lons(values):
+    """Same as :py:func:`check_lat_lon` for each of ``values``, but
+    returns a dict of bad value -> error. Values in the usual forms
+    are picked out with one regular expression run over all of them,
+    and their numbers converted and range-checked together; only the
+    rest are read one at a time."""
+    text = "\n".join( v for v in values
+                      if isinstance(v, basestring) and "\n" not in v )
+    matched = [ m for m in _coords_lines.findall(text)
+                if bool(m[2]) == bool(m[4]) ]
+    np = numpy_or_none()
+    lats = _floats([ m[1] for m in matched ], np)
+    lons = _floats([ m[3] for m in matched ], np)
+    directed = [ bool(m[2]) for m in matched ]
+    if np is not None:
+        directed = np.array(directed, dtype=bool)
+        signed = directed & ((lats < 0) | (lons < 0))
+        out = (np.abs(lats) > 90) | (np.abs(lons) > 180)
+        bad_rows = np.flatnonzero(signed | out).tolist()
+        signed = signed.tolist()
+    else:
+        signed = [ d and (lat < 0 or lon < 0)
+                   for d, lat, lon in itertools.izip(directed, lats, lons) ]
+        bad_rows = [ i for i, (s, lat, lon)
+                     in enumerate(itertools.izip(signed, lats, lons))
+                     if s or abs(lat) > 90 or abs(lon) > 180 ]
+    bad = dict( (matched[i][0], _signed%(matched[i][0]) if signed[i]
+                 else _out_of_range) for i in bad_rows )
+    rest = set(values).difference(m[0] for m in matched)
+    errors = ( (v, check_lat_lon(v)) for v in rest )
+    bad.update( (v, e) for v, e in errors if e )
+    return bad
+
+
+def _vocabulary_check(words):
+    allowed = frozenset(w.lower() for w in words)
+    def _check(value):
+        if _text(value).strip().lower() not in allowed:
+            return "not one of: "+", ".join(words)
+    return _check
+
+
+def check_number(value):
+    if not _number.match(_text(value)):
+        return "doesn't start with a number"
+    return None
+
+
+checks = dict(
+    [("lat_lon", check_lat_lon), ("collection_date", check_date)]
+    + [ (k, _vocabulary_check(v)) for k, v in vocabularies.iteritems() ]
+    + [ (k, check_number) for k in numeric_keys ]
+)
+
+required = ["SampleID"] + list(reqd_mims_keys)
+
+
+bulk_checks = {
+    "lat_lon": check_lat_lons,
+}
+
+
+def _bad_values(key, values):
+    """The errors in ``values``, a set of the distinct values of the
+    attribute ``key``, as a dict of bad value -> error"""
+    bad = dict( (v, "missing") for v in values if v is None
+                or isinstance(v, basestring) and not v.strip() )
+    if key not in checks:
+        return bad
+    values = [ v for v in values if v not in bad and not is_missing(v) ]
+    if key in bulk_checks:
+        bad.update(bulk_checks[key](values))
+    else:
+        check = checks[key]
+        errors = ( (v, check(v)) for v in values )
+        bad.update( (v, e) for v, e in errors if e )
+    return bad
+
+
+def check_columns(columns):
+    """Check a chunk of records, given as a dict of attribute ->
+    sequence of values, one for each record, with ``None`` where a record
+    doesn't have it. Yields (record index, attribute, value, error)
+    for each bad value, record by record."""
+    found = list()
+    for col, key in enumerate(required):
+        values = columns[key]
+        try:
+            distinct = set(values)
+        except TypeError:
+            # lists, from JSON arrays
+            values = map(_memo_key, values)
+            distinct = set(values)
+        bad = _bad_values(key, distinct)
+        if bad:
+            found.extend( (i, col, v, bad[v])
+                          for i, v in enumerate(values) if v in bad )
+    found.sort()
+    for i, col, value, error in found:
+        yield i, required[col], value, error
+
+
+_row = operator.itemgetter(*required)
+
+def _chunks(records, chunk_size):
+    def _get(rec):
+        try:
+            return _row(rec)
+        except KeyError:
+            return tuple( rec.get(k) for k in required )
+
+    records = iter(records)
+    while True:
+        rows = map(_get, itertools.islice(records, chunk_size))
+        if not rows:
+            return
+        yield dict(zip(required, zip(*rows)))
+
+
+def _repeated(ids, seen):
+    # the index of every ID in ids that's in seen or earlier in ids
+    distinct = set(ids)
+    if len(distinct) == len(ids) and seen.isdisjoint(distinct):
+        return []
+    ret, here = list(), set()
+    for i, sample_id in enumerate(ids):
+        if sample_id is not None and (sample_id in seen
+                                      or sample_id in here):
+            ret.append(i)
+        here.add(sample_id)
+    return ret
+
+
+def validate(fnames, chunk_size=CHUNK_SIZE):
+    """Check every record in each of the metadata files ``fnames``.
+    Returns a list of errors, one for each bad value, as tuples of
+    :py:data:`fields`; records are numbered from 1 in each file."""
+    errors = list()
+    seen = set()
+    for fname in fnames:
+        start = 0
+        for columns in _chunks(iter_records(fname), chunk_size):
+            ids = columns['SampleID']
+            found = list(check_columns(columns))
+            found.extend( (i, "SampleID", ids[i], "used by another sample")
+                          for i in _repeated(ids, seen) )
+            found.sort(key=lambda e: e[0])
+            errors.extend( (fname, start+i+1, ids[i] or "", attribute,
+                            value, error)
+                           for i, attribute, value, error in found )
+            seen.update(ids)
+            seen.discard(None)
+            start += len(ids)
+    return errors
+
+
+def write_errors(errors, fname):
+    with open(fname+".part", 'w') as f:
+        f.write("\t".join(fields)+"\n")
+        for row in errors:
+            f.write("\t".join(_text("" if v is None else v)
+                              .encode("utf-8").replace("\t", " ")
+                              .replace("\n", " ")
+                              for v in row)+"\n")
+    os.rename(fname+".part", fname)
+
+
+def report_errors(errors, out=sys.stderr, n_shown=10):
+    """Print the first ``n_shown`` of ``errors`` and how many there are
+    of each"""
+    for fname, record, sample_id, attribute, value, error \
+            in errors[:n_shown]:
+        print >> out, (u"Bad metadata in %s, record %i (%s): %s=%s: %s"%(
+            fname, record, sample_id, attribute,
+            _text("" if value is None else value), error)).encode("utf-8")
+    if len(errors) > n_shown:
+        print >> out, "... and %i more"%(len(errors)-n_shown)
+    counts = Counter( (row[3], row[5]) for row in errors )
+    for (attribute, error), n in sorted(counts.iteritems()):
+        print >> out, "%8i %s: %s"%(n, attribute, error)
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("metadata", nargs="+")
+    parser.add_argument("--products-dir", default="reports")
+    return parser.parse_args(argv)
+
+
+def main(argv=sys.argv[1:]):
+    args = parse_args(argv)
+    if not os.path.isdir(args.products_dir):
+        os.mkdir(args.products_dir)
+    errors = validate(args.metadata)
+    write_errors(errors, errors_fname(args.products_dir))
+    report_errors(errors)
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == "__main__":
+    main()
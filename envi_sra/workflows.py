@@ -3,23 +3,50 @@ import re
 import sys
 import json
 import time
+import itertools
 from os.path import join
 from os.path import dirname
 from os.path import basename
 from os.path import exists
 from urlparse import urlparse
 from collections import defaultdict
+from multiprocessing import Pool
 import xml.etree.ElementTree as ET
 
-from anadama.util import new_file
-from anadama.util import matcher
-from cutlass.aspera import aspera as asp
-
 from . import ssh
+from . import resolve
+from . import transfer
 from .serialize import indent
 from .serialize import to_xml
+from .xmlstream import write_xml
+from .xmlstream import write_shards
+from .xmlstream import shard_index
+from .xmlstream import Changes
+from .xmlstream import fingerprints_fname
+from .xmlstream import submitted_fname
+from .xmlstream import load_fingerprints
+from .xmlstream import dump_fingerprints
+from .xmlstream import promote
+from .xmlstream import referenced_files
+from .util import digest
 from .util import reportnum
+from .manifest import Manifest
+from .manifest import manifest_fname
+from .manifest import accepted_status
+from .metadata import iter_records
+from .store import Seq
+from .store import Layouts
+from .store import SampleStore
+from .metrics import Metrics
+from .metrics import MB
+from .compress import compress_all
+from .compress import renamer
+from .compress import cache_dir as compress_cache_dir
 from .update import print_report
+from .update import report_status
+from . import seqstats
+from . import dedup as dedup_
+from . import validate as validate_
 
 def fsize(fname):
     return os.stat(fname).st_size
@@ -48,68 +75,590 @@ def _sequences(sample_records):
 class Bag(object):
     pass
 
-find_file = lambda n, h:  matcher.find_match(n,h, kmer_lengths=(2,3))
+
+def instrumented(metrics, task, profile_fname=None):
+    """Time each of ``task``'s actions with ``metrics``. Actions after
+    the first are timed, and profiled, on their own: under the task's
+    name with the action's added, and to ``profile_fname`` with the
+    action's name before the extension."""
+    def _wrap(i, action):
+        if i == 0:
+            return metrics.action(task['name'], action, profile_fname)
+        name = getattr(action, "__name__", str(i)).strip("_<>")
+        prof = None
+        if profile_fname:
+            base, ext = os.path.splitext(profile_fname)
+            prof = base+"."+name+ext
+        return metrics.action(task['name']+" ("+name+")", action, prof)
+    task['actions'] = [ _wrap(i, a) for i, a in enumerate(task['actions']) ]
+    return task
+
+find_file = resolve.find_file
 _hash = lambda v: "{}{}".format(0 if v < 0 else 1, abs(hash(v)))
 
-class MyDict(dict):
-    id = None
+id_schemes = {
+    "digest": digest,
+    "hash": _hash, # the IDs studies submitted before "digest" got
+}
 
-def gen_samples_seqs(study, metadata, seqinfo, files):
-    with open(metadata, 'r') as f:
-        recs = json.load(f)
+def iter_samples_seqs(study, metadata, seqinfo, files, cache_dir=None,
+                      id_func=digest, path_func=identity, layouts=None,
+                      intern=None):
+    """Yield a (sample, seq) pair for each record in the ``metadata``
+    file, reading it one record at a time. The file is read twice:
+    once to match every SampleID to a sequence file, then again to
+    build the pairs. ``path_func`` gives the name each matched file
+    will be uploaded under.
+
+    Samples are :py:class:`envi_sra.store.Sample` and seqs
+    :py:class:`envi_sra.store.Seq`. ``layouts`` and ``intern`` are
+    for sharing column names and values between samples; see
+    :py:class:`envi_sra.store.SampleStore`."""
     with open(seqinfo, 'r') as f:
         seqinfo = json.load(f)
-    samples_seqs = list()
-    for rec in recs:
-        seq = Bag()
-        seq.path = os.path.abspath(find_file(rec['SampleID'], files))
-        seq.seq_model = seqinfo['seq_model']
-        seq.lib_const = seqinfo['lib_const']
-        seq.method = seqinfo['method']
-        seq.id = study.id+":seq:"+_hash(basename(seq.path))
-        sample = MyDict(rec)
-        sample.id = study.id+":sample:"+_hash(rec['SampleID'])
-        samples_seqs.append((sample, seq))
-    return samples_seqs
-        
+    layouts = layouts or Layouts()
+    sample_ids = ( rec['SampleID'] for rec in iter_records(metadata) )
+    paths = resolve.resolve(sample_ids, files, cache_dir=cache_dir,
+                            key=os.path.abspath(metadata))
+    for rec in iter_records(metadata):
+        path = os.path.abspath(paths[rec['SampleID']])
+        seq = Seq(path_func(path), seqinfo['seq_model'],
+                  seqinfo['lib_const'], seqinfo['method'],
+                  study.id+":seq:"+id_func(basename(path)))
+        sample = layouts.sample(
+            rec, study.id+":sample:"+id_func(rec['SampleID']), intern)
+        yield sample, seq
+
+
+def gen_samples_seqs(study, metadata, seqinfo, files, cache_dir=None,
+                     id_func=digest, path_func=identity, store=None):
+    """Add the pairs :py:func:`iter_samples_seqs` yields to ``store``,
+    a new :py:class:`envi_sra.store.SampleStore` if not given, and
+    return it"""
+    store = store if store is not None else SampleStore()
+    return store.extend(iter_samples_seqs(
+        study, metadata, seqinfo, files, cache_dir=cache_dir,
+        id_func=id_func, path_func=path_func, layouts=store.layouts,
+        intern=store.intern))
+
 
 def serialize(study_json, qiime_metadata, seqinfo_16s, files_16s,
               wgs_metadata, seqinfo_wgs, files_wgs, submission_fname,
-              ready_fname, products_dir):
+              ready_fname, products_dir, writer="etree", shard_actions=0,
+              shard_bytes=0, ids="digest", incremental=False, profile=False,
+              compress=None, seqstats_fname=None, duplicates_fname=None,
+              mims_errors_fname=None, workers=1, metrics=None, ledger=None):
+    """Serialize study, sample, and sequence metadata into
+    submission.xml
+
+    ``qiime_metadata`` and ``wgs_metadata`` can be JSON arrays, JSON
+    Lines or QIIME mapping files; see :py:mod:`envi_sra.metadata`.
+
+    :keyword writer: String; ``etree`` to build the whole document
+    with ElementTree before writing it out, ``stream`` to write each
+    Action as it's rendered, so memory use doesn't grow with the
+    number of samples. Both produce the same bytes.
+
+    :keyword shard_actions: Integer; if set, split the submission into
+    shards of at most this many Actions each. Each shard is written to
+    its own ``shard.N`` directory in ``products_dir`` with its own
+    submit.ready, and the list of shards to ``shards.json``.
+
+    :keyword shard_bytes: Integer; if set, split the submission into
+    shards of at most this many bytes of XML each.
+
+    :keyword ids: String; how to make study, sample and sequence
+    SPUIDs. ``digest`` gives the same IDs on every run; ``hash`` gives
+    the IDs older versions used, which depend on the interpreter.
+
+    :keyword incremental: Boolean; only write Actions for samples and
+    sequences that are new or have changed since they were last
+    accepted by NCBI, as recorded in ``submitted.json`` in
+    ``products_dir``. A sequence is changed if its file's contents
+    have, even if its name hasn't. Implies the ``stream`` writer. If
+    nothing's new or changed, no submission is written and the task
+    fails, so nothing's uploaded.
+
+    :keyword workers: Integer; render Actions in this many processes
+    at once. Implies the ``stream`` writer; the output's the same as
+    with one.
+
+    :keyword profile: Boolean; run serialization under cProfile and
+    save the stats to ``serialize.prof`` in ``products_dir``.
+
+    :keyword compress: String; if set, refer to uncompressed sequence
+    files by the names :py:func:`compress` gives their compressed
+    copies.
+
+    :keyword seqstats_fname: String; the stats table :py:func:`check`
+    writes. If set, serialization waits on it, so nothing's serialized
+    once a sequence file turns out to be bad.
+
+    :keyword duplicates_fname: String; the duplicates :py:func:`dedup`
+    found. If set, each SRA action for a duplicate refers to the file
+    uploaded in its place.
+
+    :keyword mims_errors_fname: String; the error table
+    :py:func:`validate` writes. If set, serialization waits on it, so
+    nothing's serialized while the metadata has errors.
+
+    :keyword metrics: envi_sra.metrics.Metrics; record how long each
+    task takes here.
+
+    :keyword ledger: String; the ledger to record the new submission
+    in. Defaults to the one in ``products_dir``.
+
+    """
+    sharded = bool(shard_actions or shard_bytes)
+    index_fname = shard_index(submission_fname)
+    id_func = id_schemes[ids]
+    submitted = submitted_fname(products_dir)
+    metrics = metrics or Metrics()
+    profile_fname = join(products_dir, "serialize.prof") if profile else None
+    rename = renamer(compress_cache_dir(products_dir), bool(compress))
 
     def _write_xml():
+        if not incremental:
+            return _write(None)
+        # fingerprint each SRA action with the md5 of the file it
+        # uploads, as well as the name it uploads it under
+        manifest = Manifest(ledger or manifest_fname(products_dir))
+        try:
+            manifest.refresh([ f for f in files_16s+files_wgs
+                               if exists(f) ])
+            return _write(manifest)
+        finally:
+            manifest.close()
+
+    def _write(manifest):
+        canonical = dedup_.mapper(dedup_.load(duplicates_fname))
+        sources = dict()
+        def path_func(path):
+            src = canonical(path)
+            dst = rename(src)
+            sources[dst] = src
+            return dst
         with open(study_json) as f:
             st = json.load(f)
         study = Bag()
         study.name = st['name']
         study.description = st['description']
-        study.id = _hash(study.name)
-        samples_seqs = gen_samples_seqs(study, qiime_metadata,
-                                        seqinfo_16s, files_16s)
-        samples_seqs += gen_samples_seqs(study, wgs_metadata,
-                                         seqinfo_wgs, files_wgs)
-        xml = to_xml(study, samples_seqs)
+        study.id = id_func(study.name)
+        inputs = ((qiime_metadata, seqinfo_16s, files_16s),
+                  (wgs_metadata, seqinfo_wgs, files_wgs))
+        samples_seqs = itertools.chain.from_iterable(
+            iter_samples_seqs(study, metadata, seqinfo, files,
+                              cache_dir=products_dir, id_func=id_func,
+                              path_func=path_func)
+            for metadata, seqinfo, files in inputs )
+        changes = None
+        if incremental:
+            def md5(path):
+                src = sources.get(path, path)
+                return manifest.md5(src) if exists(src) else None
+            changes = Changes(load_fingerprints(submitted), md5)
+        if sharded:
+            shards = write_shards(study, samples_seqs, products_dir,
+                                  shard_actions, shard_bytes, changes,
+                                  workers)
+            if not shards:
+                return _unchanged()
+            with open(index_fname, 'w') as f:
+                json.dump(shards, f, indent=2)
+            return
+        if writer == "stream" or incremental or workers > 1:
+            part = submission_fname+".part"
+            write_xml(study, samples_seqs, part, changes, workers)
+            if changes:
+                pending = changes.take()
+                if not pending:
+                    os.remove(part)
+                    return _unchanged()
+                dump_fingerprints(pending,
+                                  fingerprints_fname(submission_fname))
+            os.rename(part, submission_fname)
+            return
+        store = SampleStore()
+        for metadata, seqinfo, files in inputs:
+            gen_samples_seqs(study, metadata, seqinfo, files,
+                             cache_dir=products_dir, id_func=id_func,
+                             path_func=path_func, store=store)
+        xml = to_xml(study, store)
         indent(xml)
         et = ET.ElementTree(xml)
         et.write(submission_fname)
 
-    yield {
+    def _unchanged():
+        # an empty submission is still a submission; don't send one
+        print >> sys.stderr, ("Nothing new or changed since the last "
+                              "submission; not submitting")
+        return False
+
+    def _record():
+        # whatever the ledger had on the last submission written to the
+        # same path no longer applies
+        if sharded:
+            with open(index_fname) as f:
+                fnames = [ s['submission'] for s in json.load(f) ]
+        else:
+            fnames = [submission_fname]
+        manifest = Manifest(ledger or manifest_fname(products_dir))
+        try:
+            for f in fnames:
+                manifest.serialized(f)
+        finally:
+            manifest.close()
+
+    file_dep = [qiime_metadata, wgs_metadata]
+    if incremental and exists(submitted):
+        file_dep.append(submitted)
+    if seqstats_fname:
+        file_dep.append(seqstats_fname)
+    if duplicates_fname:
+        file_dep.append(duplicates_fname)
+    if mims_errors_fname:
+        file_dep.append(mims_errors_fname)
+
+    if sharded:
+        yield instrumented(metrics, {
+            "name": "serialize:shards: "+index_fname,
+            "actions": [_write_xml, _record],
+            "file_dep": file_dep,
+            "targets": [index_fname]
+        }, profile_fname)
+        return
+
+    yield instrumented(metrics, {
         "name": "serialize:xml: "+submission_fname,
-        "actions": [_write_xml],
-        "file_dep": [qiime_metadata, wgs_metadata],
+        "actions": [_write_xml, _record],
+        "file_dep": file_dep,
         "targets": [submission_fname]
-    }
+    }, profile_fname)
 
-    yield {
+    yield instrumented(metrics, {
         "name": "serialize:ready_file: "+ready_fname,
         "actions": [lambda *a, **kw: open(ready_fname, 'w').close()],
         "file_dep": [],
         "targets": [ready_fname]
-    }
+    })
+
+
+# the tasks of the studies being serialized by serialize_batch, set
+# before its worker processes are forked so they inherit them
+_batch = list()
+
+
+def _serialize_study(i):
+    try:
+        for task in _batch[i]:
+            for action in task['actions']:
+                if action() is False:
+                    return False
+    except Exception as e:
+        print >> sys.stderr, "%s failed: %s"%(_batch[i][0]['name'], e)
+        return False
+    return True
+
+
+def _stale(task):
+    if not all(exists(f) for f in task['targets']+task['file_dep']):
+        return True
+    newest = max([0]+[ os.stat(f).st_mtime for f in task['file_dep'] ])
+    return any(os.stat(f).st_mtime < newest for f in task['targets'])
+
+
+def serialize_batch(studies_tasks, workers=4, metrics=None):
+    """Run the :py:func:`serialize` tasks of many studies as one task,
+    ``workers`` studies at a time, each in a process of its own. Only
+    studies with a target that's missing, or older than what it's made
+    from, are serialized again.
+
+    :param studies_tasks: List of lists; the tasks serialize gave for
+    each study. Give serialize ``workers=1`` if ``workers`` is more
+    than one; processes here can't start processes of their own.
+
+    :keyword metrics: envi_sra.metrics.Metrics; record how long
+    serializing the batch takes here.
+
+    """
+    metrics = metrics or Metrics()
+
+    def _serialize_all():
+        _batch[:] = [ tasks for tasks in studies_tasks
+                      if any(_stale(t) for t in tasks) ]
+        metrics.gauge("batch_studies_serialized", len(_batch))
+        try:
+            if len(_batch) > 1 and workers > 1:
+                pool = Pool(min(workers, len(_batch)))
+                try:
+                    results = pool.map(_serialize_study, range(len(_batch)),
+                                       chunksize=1)
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                results = map(_serialize_study, range(len(_batch)))
+        finally:
+            del _batch[:]
+        return all(results)
+
+    tasks = [ t for ts in studies_tasks for t in ts ]
+    yield instrumented(metrics, {
+        "name": "serialize: batch",
+        "actions": [_serialize_all],
+        "file_dep": sorted(set(f for t in tasks for f in t['file_dep'])),
+        "targets": [ f for t in tasks for f in t['targets'] ]
+    })
+
+
+def check(qiime_metadata, files_16s, wgs_metadata, files_wgs, products_dir,
+          workers=4, metrics=None):
+    """Count the reads and bases in, and check the format of, every
+    sequence file a sample in ``qiime_metadata`` or ``wgs_metadata``
+    matches, ``workers`` files at a time. The stats go to
+    ``seqstats.tsv`` in ``products_dir``; a file is only read again
+    once its size or mtime changes. The task fails, before anything's
+    serialized or uploaded, if any file is empty, truncated or not
+    FASTQ or FASTA.
+
+    :keyword workers: Integer; how many processes to read files with
+
+    :keyword metrics: envi_sra.metrics.Metrics; record how long the
+    check takes here.
+
+    """
+    table = seqstats.table_fname(products_dir)
+    fnames = [ f for f in list(files_16s)+list(files_wgs)
+               if not f.endswith(".complete") ]
+    metrics = metrics or Metrics()
+
+    def _check():
+        matched = list()
+        for metadata, files in ((qiime_metadata, files_16s),
+                                (wgs_metadata, files_wgs)):
+            sample_ids = ( rec['SampleID'] for rec in iter_records(metadata) )
+            paths = resolve.resolve(sample_ids, files, cache_dir=products_dir,
+                                    key=os.path.abspath(metadata))
+            matched.extend(os.path.abspath(p) for p in paths.itervalues())
+        stats = seqstats.scan_all(matched, table, workers)
+        for row in stats.itervalues():
+            metrics.incr("seq_reads_total", row['reads'])
+            metrics.incr("seq_bases_total", row['bases'])
+        bad = seqstats.bad_files(stats)
+        seqstats.report_bad(bad)
+        metrics.gauge("seq_files_bad", len(bad))
+        return not bad
+
+    yield instrumented(metrics, {
+        "name": "check: sequences",
+        "actions": [_check],
+        "file_dep": [qiime_metadata, wgs_metadata]+fnames,
+        "targets": [table]
+    })
+
+
+def validate(qiime_metadata, wgs_metadata, products_dir, metrics=None):
+    """Check every sample in ``qiime_metadata`` and ``wgs_metadata``
+    against what NCBI accepts for MIMS BioSamples: required attributes,
+    coordinates, dates and vocabularies. See
+    :py:mod:`envi_sra.validate`. Every error goes to
+    ``mims_errors.tsv`` in ``products_dir``; the task fails, before
+    anything's serialized or uploaded, if there are any.
+
+    :keyword metrics: envi_sra.metrics.Metrics; record how long
+    validation takes here.
+
+    """
+    table = validate_.errors_fname(products_dir)
+    metrics = metrics or Metrics()
+
+    def _validate():
+        errors = validate_.validate([qiime_metadata, wgs_metadata])
+        validate_.write_errors(errors, table)
+        validate_.report_errors(errors)
+        metrics.gauge("mims_errors", len(errors))
+        return not errors
+
+    yield instrumented(metrics, {
+        "name": "validate: metadata",
+        "actions": [_validate],
+        "file_dep": [qiime_metadata, wgs_metadata],
+        "targets": [table]
+    })
+
+
+def dedup(files_16s, files_wgs, products_dir, metrics=None):
+    """Find sequence files holding the same data as another, whether
+    symlinked, copied or delivered twice under different names, so
+    each is only uploaded once. See :py:mod:`envi_sra.dedup`.
+
+    Whole files are only hashed when their size and sampled blocks
+    match another file's; those hashes are kept in the upload
+    manifest, so they aren't repeated when the files are uploaded.
+
+    :keyword metrics: envi_sra.metrics.Metrics; record how long
+    deduplication takes here.
+
+    """
+    fnames = [ os.path.abspath(f) for f in list(files_16s)+list(files_wgs)
+               if not f.endswith(".complete") ]
+    out_fname = dedup_.duplicates_fname(products_dir)
+    metrics = metrics or Metrics()
+
+    def _dedup():
+        manifest = Manifest(manifest_fname(products_dir))
+        def _hash_all(paths):
+            manifest.refresh(paths)
+            return [ manifest.md5(p) for p in paths ]
+        try:
+            dups = dedup_.find_duplicates(fnames, hash_all=_hash_all)
+        finally:
+            manifest.close()
+        metrics.gauge("seq_files_duplicate", len(dups))
+        metrics.gauge("seq_bytes_duplicate",
+                      sum(fsize(f) for f in dups))
+        dedup_.dump(dups, out_fname)
+
+    yield instrumented(metrics, {
+        "name": "dedup: sequences",
+        "actions": [_dedup],
+        "file_dep": fnames,
+        "targets": [out_fname]
+    })
+
+
+def compressed_names(fnames, products_dir):
+    """The names :py:func:`compress` gives ``fnames``"""
+    rename = renamer(compress_cache_dir(products_dir))
+    return [ rename(f) for f in fnames if not f.endswith(".complete") ]
+
+
+def compress(files_16s, files_wgs, products_dir, format="gzip", workers=4,
+             level=6, metrics=None):
+    """Compress sequence files that aren't compressed already into
+    ``compressed/`` under ``products_dir``, so less goes over the
+    wire. A file is only compressed again once it's newer than its
+    compressed copy.
+
+    :keyword format: String; ``gzip``, or ``bgzip`` for BGZF, which
+    is gzip that can be read from any block
+
+    :keyword workers: Integer; how many processes to compress with
+
+    :keyword level: Integer; compression level, 1 to 9
+
+    :keyword metrics: envi_sra.metrics.Metrics; record how long
+    compression takes here.
+
+    """
+    fnames = [ f for f in list(files_16s)+list(files_wgs)
+               if not f.endswith(".complete") ]
+    metrics = metrics or Metrics()
+    out_dir = compress_cache_dir(products_dir)
+    targets = [ c for f, c in zip(fnames, compressed_names(fnames,
+                                                           products_dir))
+                if c != f ]
+
+    def _compress():
+        return compress_all(fnames, out_dir, format, workers, level)
+
+    yield instrumented(metrics, {
+        "name": "compress: sequences",
+        "actions": [_compress],
+        "file_dep": fnames,
+        "targets": targets
+    })
+
+
+def _sent(manifest, local_fname, complete_fname, dest):
+    # decided from the ledger alone; files uploaded before it recorded
+    # them are picked up by envi_sra.ledger's reconcile
+    if not manifest.is_uploaded(local_fname, dest):
+        return False
+    if not exists(complete_fname):
+        open(complete_fname, 'w').close()
+    return True
+
+
+def _bad(fnames, stats_table):
+    # files that failed check() are never sent, even if it wasn't run
+    # in the same pipeline as this upload
+    bad = seqstats.bad_uploads(fnames, stats_table)
+    seqstats.report_bad(bad)
+    return bad
+
+
+def send_units(units, manifest, scheduler, connect):
+    """Upload the sequence files of every unit in ``units`` in one queue,
+    then each unit's submission.xml once all its sequence files are up,
+    and its submit.ready once its submission.xml is.
+
+    :param units: List of dicts, one per submission, with its ``files``,
+    ``submission`` and ``ready`` file; ``dir``, the local directory for
+    the ``.complete`` markers of its sequence files; ``dest``, the
+    remote directory it goes in, made in ``parent`` if they differ;
+    ``stats``, the :py:func:`check` table for its files; and ``group``.
+    Uploads from different groups take turns.
+
+    :param manifest: envi_sra.manifest.Manifest; the ledger
+
+    :param scheduler: envi_sra.transfer.UploadScheduler
+
+    :param connect: Callable; given a remote directory, an
+    envi_sra.ssh.SSHConnection to it. Only called for units the ledger
+    hasn't seen a directory made for.
+
+    Returns True if every unit's submit.ready is up.
+
+    """
+    listings = dict()
+    for u in units:
+        recorded = manifest.submission(u['submission'])
+        if recorded and recorded['dest'] == u['dest']:
+            continue
+        conn = connect(u['parent'])
+        conn.ensure_path()
+        if u['dest'] != u['parent']:
+            if u['parent'] not in listings:
+                listings[u['parent']] = set(conn.files())
+            name = basename(u['dest'].rstrip("/"))
+            if name not in listings[u['parent']]:
+                conn.mkdir(join(conn.remote_path, name))
+        manifest.record_submission(u['submission'], dest=u['dest'])
+
+    seq_jobs = [ [ (f, join(u['dir'], basename(f)+".complete"), u['dest'])
+                   for f in u['files'] ] for u in units ]
+    bad = list()
+    for u in units:
+        bad.extend(_bad(u['files'], u['stats']))
+    if bad:
+        return False
+    manifest.refresh(set(f for u in units for f in u['files']))
+    groups = dict( (u['dest'], u['group']) for u in units )
+    group = lambda job: groups[job[2]]
+    scheduler.run([ job for jobs in seq_jobs for job in jobs
+                    if not _sent(manifest, *job) ], group)
+    # a unit's submission.xml only goes up once all its sequence files
+    # have, and its submit.ready once its submission.xml has
+    done = [ u for u, jobs in zip(units, seq_jobs)
+             if all(exists(c) for _, c, _ in jobs) ]
+    for key, state in (('submission', "uploaded"), ('ready', "submitted")):
+        jobs = [ (u[key], u[key]+".complete", u['dest']) for u in done ]
+        todo = [ job for job in jobs if not exists(job[1]) ]
+        scheduler.run(todo, group)
+        sent = set( job[0] for job in todo if exists(job[1]) )
+        done = [ u for u, job in zip(done, jobs) if exists(job[1]) ]
+        for u in done:
+            if u[key] in sent:
+                manifest.record_submission(u['submission'], state=state)
+    return len(done) == len(units)
 
 
 def upload(files_16s, files_wgs, sub_fname, ready_fname, keyfile,
-           remote_path, remote_srv, user, products_dir):
+           remote_path, remote_srv, user, products_dir, max_parallel=4,
+           retries=3, retry_backoff=5, hash_workers=4, sharded=False,
+           pool=None, metrics=None, port=22, backend=None,
+           duplicates_fname=None, adaptive=True, max_rate=0):
     """Upload raw sequence files and xml.
 
     :param keyfile: String; absolute filepath to private SSH keyfile for
@@ -123,12 +672,69 @@ def upload(files_16s, files_wgs, sub_fname, ready_fname, keyfile,
 
     :param user: String; username used to access NCBI's submission server
 
+    :keyword max_parallel: Integer; how many sequence files to upload
+    at once. Files are uploaded largest first.
+
+    :keyword retries: Integer; how many times to retry a failed upload
+
+    :keyword retry_backoff: Number; seconds to wait before retrying a
+    failed upload, doubled on each retry.
+
+    :keyword hash_workers: Integer; how many files to checksum at once
+    when updating the upload manifest
+
+    :keyword sharded: Boolean; upload the shards listed in
+    ``shards.json`` next to ``sub_fname`` instead of a single
+    submission. Each shard goes into its own directory under
+    ``remote_path``; all their sequence files share one upload queue.
+
+    :keyword pool: ssh.ConnectionPool; where to get the SSH connection
+    from. Defaults to the process-wide pool.
+
+    :keyword metrics: envi_sra.metrics.Metrics; record task times,
+    transfer rates and SSH round trips here.
+
+    :keyword port: Integer; the submission server's SSH port
+
+    :keyword backend: What moves the files; defaults to a
+    :py:class:`envi_sra.transfer.AsperaBackend`.
+
+    :keyword duplicates_fname: String; the duplicates :py:func:`dedup`
+    found. A duplicate isn't uploaded; it's marked complete once the
+    file uploaded in its place is.
+
+    :keyword adaptive: Boolean; find how many sequence files to upload
+    at once, up to ``max_parallel``, from the throughput they get. See
+    :py:class:`envi_sra.transfer.RateController`.
+
+    :keyword max_rate: Number; the most MB/s to upload at, all files
+    together, e.g. the site's share of its link. 0 for no limit.
+
     """
 
     to_upload = [ f for f in list(files_16s)+list(files_wgs)
                   if not f.endswith(".complete") ]
-    ssh_session = ssh.SSHConnection(user, remote_srv, keyfile, remote_path)
-    uptodate = [ssh_session.uptodate]
+    pool = pool or ssh.pool
+    metrics = metrics or Metrics()
+    session = list()
+    def ssh_session():
+        # connect when a task first needs to, not while tasks are
+        # being generated
+        if not session:
+            session.append(pool.connection(user, remote_srv, keyfile,
+                                           remote_path, port=port,
+                                           metrics=metrics))
+        return session[0]
+    def _close_session():
+        while session:
+            session.pop().close()
+    backend = backend or transfer.AsperaBackend(remote_srv, user, keyfile)
+    manifest = Manifest(manifest_fname(products_dir), workers=hash_workers)
+    stats_table = seqstats.table_fname(products_dir)
+
+    def _send(local_fname, dest):
+        manifest.mark_started(local_fname, dest)
+        return backend.upload(local_fname, dest)
 
     def _upload(local_fname, complete_fname, blithely=False):
         def _u():
@@ -137,70 +743,388 @@ def upload(files_16s, files_wgs, sub_fname, ready_fname, keyfile,
                 if b not in ("submission.xml", "submit.ready") \
                    and b not in f.read():
                     return
-            ret = asp.upload_file(remote_srv, user, None, local_fname,
-                                  remote_path, keyfile=keyfile)
+            start = time.time()
+            ret = _send(local_fname, remote_path)
+            metrics.transfer(local_fname, remote_path, fsize(local_fname),
+                             time.time()-start, ret)
+            if ret:
+                manifest.mark_uploaded(local_fname, remote_path)
+            else:
+                manifest.mark_failed(local_fname, remote_path)
             if blithely or ret:
                 open(complete_fname, 'w').close()
+                state = "submitted" if local_fname == ready_fname \
+                        else "uploaded"
+                manifest.record_submission(sub_fname, dest=remote_path,
+                                           state=state)
             return blithely or ret # return True if blithely is True
         return _u
 
+    def _duplicates():
+        return dedup_.for_uploads(to_upload, dedup_.load(duplicates_fname),
+                                  compress_cache_dir(products_dir))
+
+    def _uptodate(task, values):
+        dups = _duplicates()
+        paths = [ f for f in to_upload if f not in dups ]
+        return manifest.uptodate(paths, remote_path)(task, values)
+
+    controller = transfer.RateController(max_parallel, max_rate*MB,
+                                         adaptive, backend=backend)
+    scheduler = transfer.UploadScheduler(_send, max_parallel, retries,
+                                         retry_backoff,
+                                         done=manifest.mark_uploaded,
+                                         metrics=metrics,
+                                         failed=manifest.mark_failed,
+                                         controller=controller)
+    def _upload_seqs():
+        with open(sub_fname, 'r') as f:
+            submission = referenced_files(f.read())
+        referenced = [ (f, c, remote_path)
+                       for f, c in zip(to_upload, complete_fnames)
+                       if basename(f) in submission ]
+        if _bad([f for f, _, _ in referenced], stats_table):
+            return False
+        manifest.refresh([f for f, _, _ in referenced])
+        jobs = [ job for job in referenced if not _sent(manifest, *job) ]
+        recorded = manifest.submission(sub_fname)
+        if jobs and (not recorded or recorded['dest'] != remote_path):
+            # make the remote directory if it isn't there; once the
+            # ledger has that, later runs needn't connect
+            try:
+                ssh_session().ensure_path()
+            finally:
+                _close_session()
+            manifest.record_submission(sub_fname, dest=remote_path)
+        ok = scheduler.run(jobs)
+        # a duplicate's data is up once the file sent in its place is
+        for f, canonical in _duplicates().iteritems():
+            if exists(canonical+".complete"):
+                open(f+".complete", 'w').close()
+        return ok
+
+    def _upload_shards():
+        with open(index_fname) as f:
+            shards = json.load(f)
+        for shard in shards:
+            shard.update(dest=join(remote_path, shard['name']),
+                         parent=remote_path, stats=stats_table,
+                         group=remote_path)
+        try:
+            sent = send_units(shards, manifest, scheduler,
+                              lambda d: ssh_session())
+        finally:
+            _close_session()
+        if not sent:
+            return False
+        open(index_fname+".complete", 'w').close()
+
+    if sharded:
+        index_fname = shard_index(sub_fname)
+        yield instrumented(metrics, {
+            "name": "upload: shards",
+            "actions": [_upload_shards],
+            "file_dep": to_upload+[index_fname],
+            "targets": [index_fname+".complete"]
+        })
+        return
+
     complete_fnames = [f+".complete" for f in to_upload
                        if not f.endswith(".complete")]
-    for f, complete_fname in zip(to_upload, complete_fnames):
-        yield {
-            "name": "upload: "+basename(f),
-            "actions": [_upload(f, complete_fname)],
-            "file_dep": [f],
-            "uptodate": uptodate,
-            "targets": [complete_fname]
-        }
-
-    yield {
+    yield instrumented(metrics, {
+        "name": "upload: sequences",
+        "actions": [_upload_seqs],
+        "file_dep": to_upload+[sub_fname],
+        "uptodate": [_uptodate],
+        "targets": complete_fnames
+    })
+
+    yield instrumented(metrics, {
         "name": "upload: "+basename(sub_fname),
         "actions": [_upload(sub_fname, sub_fname+".complete")],
         "file_dep": complete_fnames,
         "targets": [sub_fname+".complete"]
-    }
+    })
 
-    yield {
+    yield instrumented(metrics, {
         "name": "upload: "+basename(ready_fname),
         "actions": [_upload(ready_fname, ready_fname+".complete", True)],
         "file_dep": complete_fnames+[sub_fname+".complete"],
         "targets": [ready_fname+".complete"]
-    }
+    })
+
+
+def upload_batch(studies, products_dir, keyfile, remote_srv, user,
+                 max_parallel=4, retries=3, retry_backoff=5, hash_workers=4,
+                 pool=None, metrics=None, port=22, backend=None,
+                 adaptive=True, max_rate=0):
+    """Upload many studies' sequence files and submissions, all through
+    one upload queue that takes files from each study in turn. Each
+    study's submission.xml goes up once its sequence files have, and
+    its submit.ready once that has, without waiting on other studies.
+
+    :param studies: List of dicts, one per study, as from
+    :py:func:`envi_sra.batch.load_batch`: its ``name``,
+    ``remote_path``, ``products_dir``, ``submission`` and ``ready``
+    files, the ``files`` to upload and whether it's ``sharded``.
+
+    :param products_dir: String; where the ledger for the whole batch
+    is, and the ``batch.complete`` marker once every study's up
+
+    Other options are as for :py:func:`upload`.
+
+    """
+    pool = pool or ssh.pool
+    metrics = metrics or Metrics()
+    backend = backend or transfer.AsperaBackend(remote_srv, user, keyfile)
+    manifest = Manifest(manifest_fname(products_dir), workers=hash_workers)
+    complete_fname = join(products_dir, "batch.complete")
+    connections = dict()
+
+    def _connect(d):
+        if d not in connections:
+            connections[d] = pool.connection(user, remote_srv, keyfile, d,
+                                             port=port, metrics=metrics)
+        return connections[d]
+
+    def _send(local_fname, dest):
+        manifest.mark_started(local_fname, dest)
+        return backend.upload(local_fname, dest)
+
+    controller = transfer.RateController(max_parallel, max_rate*MB,
+                                         adaptive, backend=backend)
+    scheduler = transfer.UploadScheduler(_send, max_parallel, retries,
+                                         retry_backoff,
+                                         done=manifest.mark_uploaded,
+                                         metrics=metrics,
+                                         failed=manifest.mark_failed,
+                                         controller=controller)
+
+    def _units(study):
+        common = dict(parent=study['remote_path'], group=study['name'],
+                      stats=seqstats.table_fname(study['products_dir']))
+        if study['sharded']:
+            with open(shard_index(study['submission'])) as f:
+                shards = json.load(f)
+            for shard in shards:
+                shard.update(common,
+                             dest=join(study['remote_path'], shard['name']))
+            return shards
+        with open(study['submission']) as f:
+            referenced = referenced_files(f.read())
+        return [dict(common, name=study['name'], dir=study['products_dir'],
+                     submission=study['submission'], ready=study['ready'],
+                     dest=study['remote_path'],
+                     files=[ f for f in study['files']
+                             if basename(f) in referenced ])]
+
+    def _upload_all():
+        units = [ u for study in studies for u in _units(study) ]
+        try:
+            sent = send_units(units, manifest, scheduler, _connect)
+        finally:
+            for c in connections.itervalues():
+                c.close()
+            connections.clear()
+        if not sent:
+            return False
+        open(complete_fname, 'w').close()
+
+    file_dep = list()
+    for study in studies:
+        file_dep.extend(study['files'])
+        file_dep.append(shard_index(study['submission']) if study['sharded']
+                        else study['submission'])
+    yield instrumented(metrics, {
+        "name": "upload: batch",
+        "actions": [_upload_all],
+        "file_dep": file_dep,
+        "targets": [complete_fname]
+    })
 
 
 def report(ready_complete_fname, user, remote_srv, remote_path,
-           keyfile):
+           keyfile, pool=None, poll_timeout=20*60, poll_interval=0.5,
+           poll_max_interval=30, poll_backoff=1.5, fetch="newest",
+           sharded=False, accessions="accessions.json", metrics=None,
+           port=22, backend=None, targets=None):
+    """Wait for NCBI to process the submission, then download and print
+    the report.
+
+    The remote directory's mtime is checked between polls, and it's
+    only listed again once that changes. The time between polls grows
+    by ``poll_backoff`` while nothing changes; once it reaches
+    ``poll_max_interval`` the directory is listed on every poll
+    regardless.
+
+    :keyword poll_timeout: Number; seconds to wait for a report
+
+    :keyword poll_interval: Number; seconds between the first polls
+
+    :keyword poll_max_interval: Number; the longest time between polls
+
+    :keyword poll_backoff: Number; how much to stretch the time between
+    polls each time the remote directory hasn't changed
+
+    :keyword fetch: String; ``newest`` to download only the most recent
+    report, ``all`` to download every new report in one batch.
+
+    :keyword sharded: Boolean; wait on the report for every shard in
+    ``shards.json``, all in the same polling loop. Each shard's reports
+    are saved to its own directory.
+
+    :keyword accessions: String; name of the file to write each
+    object's status, accession and error messages to, keyed by SPUID,
+    next to the report. A name ending in ``.tsv`` writes TSV instead of
+    JSON. See :py:func:`envi_sra.update.load_index`.
+
+    :keyword metrics: envi_sra.metrics.Metrics; record poll counts,
+    SSH round trips and download times here.
+
+    :keyword port: Integer; the submission server's SSH port
+
+    :keyword backend: What downloads reports when the server doesn't
+    offer SFTP; defaults to a :py:class:`envi_sra.transfer.AsperaBackend`.
+
+    :keyword targets: Callable; returns a (remote directory, local
+    directory, submission.xml, products directory) tuple for each
+    submission to wait on instead, e.g. every study in a batch, all in
+    the same polling loop.
+
+    """
     reports_dir = dirname(ready_complete_fname)
-    def _download():
-        c = ssh.SSHConnection(user, remote_srv, keyfile, remote_path)
-        for _ in range(60*20*2): # 20 minutes in half-seconds
-            report_fnames = [basename(n) for n in c.files()
-                             if re.search(r'report\.[\d.]*xml', n)
-                             and not exists(join(reports_dir, basename(n)))]
-            if report_fnames:
-                break
-            else:
-                time.sleep(.5)
+    index_fname = join(reports_dir, "shards.json")
+    pool = pool or ssh.pool
+    metrics = metrics or Metrics()
+    backend = backend or transfer.AsperaBackend(remote_srv, user, keyfile)
+    manifest = Manifest(manifest_fname(reports_dir))
+
+    def _targets():
+        if targets is not None:
+            return targets()
+        if not sharded:
+            return [(remote_path, reports_dir,
+                     join(reports_dir, "submission.xml"), reports_dir)]
+        with open(index_fname) as f:
+            return [ (join(remote_path, s['name']), s['dir'], s['submission'],
+                      reports_dir) for s in json.load(f) ]
+
+    def _accepted(local_dir, products_dir):
+        # the actions in a submission count as submitted, for
+        # incremental serialization, once NCBI's final report for it
+        # says it was accepted, with no errors
+        promote(join(local_dir, "fingerprints.json"),
+                submitted_fname(products_dir))
+
+    def _new_reports(c, local_dir):
+        return [basename(n) for n in c.files()
+                if re.search(r'report\.[\d.]*xml', n)
+                and not exists(join(local_dir, basename(n)))]
+
+    def _poll(targets):
+        deadline = time.time() + poll_timeout
+        interval = poll_interval
+        found = [ list() for _ in targets ]
+        last_mtimes = [ None for _ in targets ]
+        start, polls, listings = time.time(), 0, 0
+        def _done():
+            metrics.event("poll", polls=polls, listings=listings,
+                          seconds=time.time()-start,
+                          found=sum(1 for f in found if f))
+            return found
+        while True:
+            polls += 1
+            metrics.incr("report_polls_total")
+            changed = False
+            for i, (c, local_dir) in enumerate(targets):
+                if found[i]:
+                    continue
+                c.ensure_active()
+                mtime = c.mtime()
+                if mtime is None or mtime != last_mtimes[i] \
+                   or interval >= poll_max_interval:
+                    changed = changed or mtime != last_mtimes[i]
+                    last_mtimes[i] = mtime
+                    found[i] = _new_reports(c, local_dir)
+                    listings += 1
+                    metrics.incr("report_listings_total")
+            if all(found):
+                return _done()
+            if changed:
+                interval = poll_interval
+            if time.time() + interval > deadline:
+                return _done()
+            time.sleep(interval)
+            interval = min(interval*poll_backoff, poll_max_interval)
+
+    def _fetch(c, local_dir, report_fnames):
+        if c.mode == "sftp":
+            return c.get(report_fnames, local_dir)
         for n in report_fnames:
-            if exists(join(reports_dir, n)):
+            start = time.time()
+            ret = backend.download(join(c.remote_path, n), local_dir)
+            local = join(local_dir, basename(n))
+            metrics.transfer(n, local_dir,
+                             fsize(local) if exists(local) else 0,
+                             time.time()-start, ret)
+
+    def _report(targets, waiting):
+        timed_out = False
+        for (c, local_dir), (_, _, sub, products_dir), report_fnames in zip(
+                targets, waiting, _poll(targets)):
+            if not report_fnames:
+                print >> sys.stderr, ("Timed out waiting for report xml "
+                                      "files in "+c.remote_path)
+                timed_out = True
                 continue
-            asp.download_file(remote_srv, user, None, join(remote_path, n),
-                              reports_dir, keyfile=keyfile)
-        if not report_fnames:
-            print >> sys.stderr, "Timed out waiting for report xml files."
+            most_recent_report = max(report_fnames, key=reportnum)
+            if fetch == "all":
+                _fetch(c, local_dir, report_fnames)
+            else:
+                _fetch(c, local_dir, [most_recent_report])
+            report_fname = join(local_dir, most_recent_report)
+            submission_id, status = report_status(report_fname)
+            manifest.record_submission(sub, dest=c.remote_path,
+                                       state="reported",
+                                       submission_id=submission_id,
+                                       status=status, report=report_fname)
+            index_fname = join(local_dir, accessions) if accessions else None
+            ok = print_report(report_fname, index_fname) is not False
+            if ok and status == accepted_status:
+                _accepted(local_dir, products_dir)
+        if timed_out:
             return False
-        most_recent_report = max(report_fnames, key=reportnum)
-        print_report(join(reports_dir, most_recent_report))
 
-    yield {
+    def _download():
+        waiting = list()
+        for d, local_dir, sub, products_dir in _targets():
+            # NCBI's done with a submission once the ledger has a final
+            # report for it; show that without connecting
+            report_fname = manifest.reported(sub)
+            if report_fname:
+                index_fname = join(local_dir, accessions) if accessions \
+                              else None
+                print_report(report_fname, index_fname)
+            else:
+                waiting.append((d, local_dir, sub, products_dir))
+        targets = list()
+        try:
+            for d, local_dir, _, _ in waiting:
+                targets.append((pool.connection(user, remote_srv, keyfile, d,
+                                                port=port, metrics=metrics),
+                                local_dir))
+            return _report(targets, waiting)
+        finally:
+            for c, _ in targets:
+                c.close()
+
+    yield instrumented(metrics, {
         "name": "report:get_reports",
         "actions": [_download],
-        "file_dep": [ready_complete_fname],
+        "file_dep": [index_fname+".complete"
+                     if sharded and targets is None
+                     else ready_complete_fname],
         "uptodate": [False],
         "targets": [],
-    }
+    })
     
-
-
@@ -0,0 +1,428 @@
+"""Streaming submission.xml writer.
+
+Writes the same bytes as building the whole tree with
+:py:func:`envi_sra.serialize.to_xml`, running
+:py:func:`envi_sra.serialize.indent` over it and writing it out with
+ElementTree, but renders each BioSample and SRA ``Action`` from a
+prebuilt template and writes it out straight away.
+
+"""
+
+import os
+import re
+import json
+import hashlib
+import itertools
+from os.path import join
+from os.path import basename
+import xml.etree.ElementTree as ET
+from xml.etree.ElementTree import _escape_cdata, _escape_attrib
+from xml.sax.saxutils import unescape
+from multiprocessing import Pool
+
+from .serialize import indent
+from .serialize import reg_text
+from .serialize import reg_sample
+from .serialize import reqd_mims_keys
+from .serialize import _add_description
+from .serialize import _add_bioproject
+
+encoding = "us-ascii"
+CHUNK_SIZE = 500
+sep = "\n  "
+tail = "\n</Submission>\n"
+
+
+def text(v):
+    return _escape_cdata(v, encoding)
+
+def attr(v):
+    return _escape_attrib(v, encoding)
+
+def leaf(open_tag, close_tag, v):
+    """Mirror ElementTree's handling of empty text: ``<a />`` when v is
+    falsy, ``<a>v</a>`` otherwise"""
+    if v:
+        return open_tag + ">" + text(v) + close_tag
+    return open_tag + " />"
+
+
+def spuid(level, obj):
+    return leaf(" "*level*2 + '<SPUID spuid_namespace="hmp2"', "</SPUID>",
+                obj.id)
+
+
+def _nl(level):
+    return "\n" + "  "*level
+
+
+_mims_tags = [ (_nl(7)+'<Attribute attribute_name="%s"'%(attr(k)), k)
+               for k in reqd_mims_keys ]
+
+_biosample_tmpl = (
+    "<Action>"
+    + _nl(2) + '<AddData target_db="BioSample">'
+    + _nl(3) + '<Data content_type="xml">'
+    + _nl(4) + "<XmlContent>"
+    + _nl(5) + '<BioSample schema_version="2.0">'
+    + _nl(6) + "<SampleId>"
+    + "\n%(sample_spuid_7)s"
+    + _nl(6) + "</SampleId>"
+    + _nl(6) + "<Descriptor>"
+    + _nl(7) + "<Title>College campus dust sample</Title>"
+    + _nl(6) + "</Descriptor>"
+    + _nl(6) + '<Organism taxonomy_id="256318">'
+    + _nl(7) + "<OrganismName>Metagenome</OrganismName>"
+    + _nl(6) + "</Organism>"
+    + _nl(6) + "<Package>MIMS.me.built.4.0</Package>"
+    + _nl(6) + "<Attributes>"
+    + "%(attributes)s"
+    + _nl(6) + "</Attributes>"
+    + _nl(5) + "</BioSample>"
+    + _nl(4) + "</XmlContent>"
+    + _nl(3) + "</Data>"
+    + _nl(3) + "<Identifier>"
+    + "\n%(sample_spuid_4)s"
+    + _nl(3) + "</Identifier>"
+    + _nl(2) + "</AddData>"
+    + _nl(1) + "</Action>"
+)
+
+
+def biosample_action(st, sample):
+    sample = reg_sample(sample)
+    get = lambda v: sample.get(v, "missing")
+    attributes = "".join([ leaf(tag, "</Attribute>", get(k))
+                           for tag, k in _mims_tags ])
+    return _biosample_tmpl % {
+        "sample_spuid_7": spuid(7, sample),
+        "sample_spuid_4": spuid(4, sample),
+        "attributes": attributes,
+    }
+
+
+_sra_attr = dict(
+    (k, _nl(3)+'<Attribute name="%s"'%(k))
+    for k in ("instrument_model", "library_strategy", "library_source",
+              "library_selection", "library_layout",
+              "library_construction_protocol")
+)
+
+_sra_tmpl = (
+    "<Action>"
+    + _nl(2) + '<AddFiles target_db="SRA">'
+    + _nl(3) + '<File file_path="%(file_path)s">'
+    + _nl(4) + "<DataType>generic-data</DataType>"
+    + _nl(3) + "</File>"
+    + "%(attributes)s"
+    + _nl(3) + '<AttributeRefId name="BioProject">'
+    + _nl(4) + "<RefId>"
+    + "\n%(study_spuid)s"
+    + _nl(4) + "</RefId>"
+    + _nl(3) + "</AttributeRefId>"
+    + _nl(3) + '<AttributeRefId name="BioSample">'
+    + _nl(4) + "<RefId>"
+    + "\n%(sample_spuid)s"
+    + _nl(4) + "</RefId>"
+    + _nl(3) + "</AttributeRefId>"
+    + _nl(3) + "<Identifier>"
+    + "\n%(seq_spuid)s"
+    + _nl(3) + "</Identifier>"
+    + _nl(2) + "</AddFiles>"
+    + _nl(1) + "</Action>"
+)
+
+
+def sra_action(st, sample, seq):
+    attributes = [
+        ("instrument_model", seq.seq_model),
+        ("library_strategy", seq.lib_const),
+        ("library_source", "GENOMIC"),
+        ("library_selection", seq.lib_const),
+        ("library_layout", "FRAGMENT"),
+        ("library_construction_protocol", reg_text(seq.method)),
+    ]
+    return _sra_tmpl % {
+        "file_path": attr(basename(seq.path)),
+        "attributes": "".join([ leaf(_sra_attr[k], "</Attribute>", v)
+                                for k, v in attributes ]),
+        "study_spuid": spuid(5, st),
+        "sample_spuid": spuid(5, sample),
+        "seq_spuid": spuid(4, seq),
+    }
+
+
+def head(st, bioproject=True):
+    """Everything up to and including the BioProject action"""
+    root = ET.Element('Submission')
+    _add_description(root, st)
+    if bioproject:
+        _add_bioproject(root, st)
+    indent(root)
+    return ET.tostring(root)[:-len(tail)]
+
+
+def actions(st, samples_seqs):
+    for sample, seq in samples_seqs:
+        yield biosample_action(st, sample)
+        yield sra_action(st, sample, seq)
+
+
+# the study and chunks of (sample, seq) pairs being rendered, set
+# before the pool is forked so workers get them without pickling
+_window = None
+
+def _render(i):
+    st, chunks = _window
+    return [ (biosample_action(st, sample), sra_action(st, sample, seq))
+             for sample, seq in chunks[i] ]
+
+
+def rendered(st, samples_seqs, workers=1, chunk_size=CHUNK_SIZE):
+    """Yield (sample, seq, BioSample action, SRA action) for each pair
+    in ``samples_seqs``, in order. With ``workers`` over 1, the actions
+    are rendered in that many processes, ``chunk_size`` pairs to a job.
+
+    Samples are handed to the workers by forking a pool for every
+    ``8*workers`` jobs, which is much cheaper than pickling them; only
+    that many jobs' worth of pairs are held in memory at once."""
+    global _window
+    if workers < 2:
+        for sample, seq in samples_seqs:
+            yield (sample, seq, biosample_action(st, sample),
+                   sra_action(st, sample, seq))
+        return
+    samples_seqs = iter(samples_seqs)
+    chunks = iter(lambda: list(itertools.islice(samples_seqs, chunk_size)),
+                  [])
+    while True:
+        window = list(itertools.islice(chunks, 8*workers))
+        if not window:
+            break
+        _window = (st, window)
+        pool = Pool(min(workers, len(window)))
+        try:
+            results = pool.map(_render, range(len(window)), chunksize=1)
+        finally:
+            _window = None
+            pool.close()
+            pool.join()
+        for chunk, frags in itertools.izip(window, results):
+            for (sample, seq), (bs, sra) in itertools.izip(chunk, frags):
+                yield sample, seq, bs, sra
+
+
+def fingerprint(frag, md5=None):
+    h = hashlib.sha1(frag)
+    if md5:
+        h.update("\0"+md5)
+    return h.hexdigest()
+
+
+class Changes(object):
+    """Tracks which actions differ from the ones last submitted.
+
+    :param submitted: Dict; SPUID -> fingerprint of each action in
+    previous submissions.
+
+    :keyword md5: Callable; the md5 of the sequence file at the given
+    path, or None if there's none. An SRA action only names its file,
+    so without this a file that's changed but kept its name isn't
+    resubmitted.
+
+    Fingerprints of the actions that are new or changed are collected
+    in ``self.fingerprints``.
+
+    """
+
+    def __init__(self, submitted, md5=None):
+        self.submitted = submitted
+        self.md5 = md5
+        self.fingerprints = dict()
+
+    def take(self):
+        """Fingerprints collected since the last call"""
+        ret, self.fingerprints = self.fingerprints, dict()
+        return ret
+
+    def changed(self, key, frag, path=None):
+        """True if the action ``frag`` for ``key`` is new or changed. A
+        ``path`` is the file the action refers to; its contents count
+        as part of the action."""
+        md5 = self.md5(path) if path and self.md5 else None
+        fp = fingerprint(frag, md5)
+        if self.submitted.get(key) == fp:
+            return False
+        self.fingerprints[key] = fp
+        return True
+
+    def head(self, st):
+        full = head(st)
+        if self.changed(st.id, full):
+            return full
+        return head(st, bioproject=False)
+
+
+def write_xml(st, samples_seqs, fname, changes=None, workers=1):
+    """Write the submission for study ``st`` to ``fname``, consuming
+    ``samples_seqs`` lazily. With ``changes``, a :py:class:`Changes`,
+    only new or changed actions are written. With ``workers`` over 1,
+    actions are rendered in that many processes; see
+    :py:func:`rendered`."""
+    with open(fname, 'wb') as f:
+        f.write(changes.head(st) if changes else head(st))
+        for sample, seq, bs, sra in rendered(st, samples_seqs, workers):
+            for key, frag, path in ((sample.id, bs, None),
+                                    (seq.id, sra, seq.path)):
+                if changes and not changes.changed(key, frag, path):
+                    continue
+                f.write(sep)
+                f.write(frag)
+        f.write(tail)
+
+
+_file_path = re.compile(r'<File file_path="([^"]*)"')
+
+def referenced_files(submission):
+    """The set of file names the submission text ``submission`` refers
+    to, found in one pass"""
+    return set( unescape(m, {"&quot;": '"'})
+                for m in _file_path.findall(submission) )
+
+
+def shard_index(submission_fname):
+    """Where the list of shards goes for a sharded submission"""
+    return join(os.path.dirname(submission_fname), "shards.json")
+
+
+def fingerprints_fname(submission_fname):
+    """Where the fingerprints of the actions in ``submission_fname``
+    go until NCBI accepts them"""
+    return join(os.path.dirname(submission_fname), "fingerprints.json")
+
+
+def submitted_fname(products_dir):
+    return join(products_dir, "submitted.json")
+
+
+def load_fingerprints(fname):
+    if not os.path.exists(fname):
+        return dict()
+    with open(fname) as f:
+        return json.load(f)
+
+
+def dump_fingerprints(fingerprints, fname):
+    with open(fname+".part", 'w') as f:
+        json.dump(fingerprints, f, sort_keys=True)
+    os.rename(fname+".part", fname)
+
+
+def promote(pending_fname, submitted_fname):
+    """Add the fingerprints in ``pending_fname`` to those of the actions
+    already submitted"""
+    pending = load_fingerprints(pending_fname)
+    if not pending:
+        return
+    submitted = load_fingerprints(submitted_fname)
+    submitted.update(pending)
+    dump_fingerprints(submitted, submitted_fname)
+    os.remove(pending_fname)
+
+
+class _Shard(object):
+    def __init__(self, out_dir, num, st, changes=None):
+        self.name = "shard.%i"%(num)
+        self.dir = join(out_dir, self.name)
+        if not os.path.isdir(self.dir):
+            os.mkdir(self.dir)
+        self.submission = join(self.dir, "submission.xml")
+        self.changes = changes
+        self.ready = join(self.dir, "submit.ready")
+        self.files, self._paths = list(), set()
+        self.n_samples = 0
+        self.f = open(self.submission, 'wb')
+        # shards are processed in no particular order, so each has
+        # the BioProject its SRA actions refer to
+        h = changes.head(st) if changes else head(st)
+        self.f.write(h)
+        self.n_actions = h.count("<Action>")
+        self.n_bytes = len(h) + len(tail)
+
+    def full(self, frags, n_actions, max_actions, max_bytes):
+        if not self.n_samples:
+            return False
+        return (max_actions and self.n_actions + n_actions > max_actions) \
+            or (max_bytes and self.n_bytes + len(frags) > max_bytes)
+
+    def add(self, frags, path, n_actions=2):
+        self.f.write(frags)
+        self.n_actions += n_actions
+        self.n_bytes += len(frags)
+        self.n_samples += 1
+        if path and path not in self._paths:
+            # duplicates share a file, which is only listed once
+            self._paths.add(path)
+            self.files.append(path)
+
+    def discard(self):
+        self.f.close()
+        os.remove(self.submission)
+        if not os.listdir(self.dir):
+            os.rmdir(self.dir)
+
+    def close(self):
+        self.f.write(tail)
+        self.f.close()
+        if self.changes:
+            dump_fingerprints(self.changes.take(),
+                              fingerprints_fname(self.submission))
+        open(self.ready, 'w').close()
+        return {"name": self.name, "dir": self.dir,
+                "submission": self.submission, "ready": self.ready,
+                "files": self.files}
+
+
+def write_shards(st, samples_seqs, out_dir, max_actions=0, max_bytes=0,
+                 changes=None, workers=1):
+    """Split the submission for study ``st`` into size-bounded
+    submissions, each written with its submit.ready file to
+    ``out_dir/shard.N/``. A sample's BioSample and SRA actions always
+    go in the same shard. NCBI processes shards in no particular
+    order, so every shard has the BioProject action its SRA actions
+    refer to; with ``changes``, none has it once it's been accepted.
+
+    :keyword max_actions: Integer; most Actions to put in one shard,
+    0 for no limit
+
+    :keyword max_bytes: Integer; largest submission.xml to write, 0 for
+    no limit
+
+    :keyword changes: Changes; only write new or changed actions
+
+    :keyword workers: Integer; how many processes to render actions in
+
+    Returns a list of dicts, one per shard, naming its directory,
+    submission.xml, submit.ready and the sequence files it refers to.
+    The list is empty if, with ``changes``, nothing's new or changed.
+
+    """
+    shards, shard = list(), _Shard(out_dir, 0, st, changes)
+    for sample, seq, bs, sra in rendered(st, samples_seqs, workers):
+        if changes:
+            bs = bs if changes.changed(sample.id, bs) else None
+            sra = sra if changes.changed(seq.id, sra, seq.path) else None
+        frags = "".join(sep+frag for frag in (bs, sra) if frag)
+        if not frags:
+            continue
+        n_actions = frags.count(sep+"<Action>")
+        if shard.full(frags, n_actions, max_actions, max_bytes):
+            shards.append(shard.close())
+            shard = _Shard(out_dir, len(shards), st, changes)
+        shard.add(frags, seq.path if sra else None, n_actions)
+    if not shard.n_actions:
+        # nothing new or changed, not even the BioProject
+        shard.discard()
+        return shards
+    shards.append(shard.close())
+    return shards
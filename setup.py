@@ -18,7 +18,8 @@ setup(
     ],
     entry_points= {
         'anadama.pipeline': [
-            ".envi_sra = envi_sra.pipeline:ENVISRAPipeline"
+            ".envi_sra = envi_sra.pipeline:ENVISRAPipeline",
+            ".envi_sra_batch = envi_sra.pipeline:ENVISRABatchPipeline"
         ]
     }
 )
@@ -0,0 +1,102 @@
+import os
+import json
+
+import pytest
+
+from benchmarks.synth import make_study
+from envi_sra import batch
+
+
+def _options(workers=2):
+    return {
+        "batch": {"workers": workers},
+        "validate": {"enabled": True},
+        "check": {"enabled": True, "workers": 2},
+        "dedup": {"enabled": False},
+        "compress": {"format": None, "workers": 2, "level": 6},
+        "serialize": {"writer": "stream", "shard_actions": 0,
+                      "shard_bytes": 0, "ids": "digest",
+                      "incremental": False, "workers": 4,
+                      "profile": False},
+        "upload": {"keyfile": "key", "remote_srv": "127.0.0.1",
+                   "user": "test", "port": 22, "max_parallel": 2,
+                   "retries": 0, "retry_backoff": 0, "hash_workers": 2,
+                   "adaptive": True, "max_rate": 0},
+        "report": {"poll_timeout": 1, "poll_interval": 0.1,
+                   "poll_max_interval": 1, "poll_backoff": 1.5,
+                   "fetch": "newest", "accessions": "accessions.json"},
+    }
+
+
+def _entry(tmpdir, label, **kwargs):
+    study = make_study(str(tmpdir.join(label)), 2, n_reports=0)
+    rel = lambda p: os.path.relpath(p, str(tmpdir))
+    entry = dict((k, rel(study[k])) for k in batch.required[1:-1])
+    entry.update(name=label, remote_path=label,
+                 files_16s=[ rel(f) for f in study['files_16s'] ],
+                 files_wgs=[ rel(f) for f in study['files_wgs'] ])
+    entry.update(kwargs)
+    return entry, study
+
+
+def _write_batch(tmpdir, entries):
+    fname = tmpdir.join("batch.json")
+    fname.write(json.dumps(entries))
+    return str(fname)
+
+
+def test_load_batch(tmpdir):
+    a, study_a = _entry(tmpdir, "A")
+    b, study_b = _entry(tmpdir, "B", serialize={"shard_actions": 5})
+    # patterns are globbed, and markers left out
+    first = study_b['files_16s'][0]
+    open(first+".complete", 'w').close()
+    b['files_16s'] = [os.path.relpath(first, str(tmpdir))+"*"]
+    products = tmpdir.join("products")
+
+    studies = batch.load_batch(_write_batch(tmpdir, [a, b]), str(products))
+    assert [ s['name'] for s in studies ] == ["A", "B"]
+    assert studies[0]['study_json'] == study_a['study_json']
+    assert studies[0]['files_16s'] == study_a['files_16s']
+    assert studies[1]['files_16s'] == [first]
+    assert studies[0]['remote_path'] == "/submit/A/"
+    assert studies[0]['serialize'] == {}
+    assert studies[1]['serialize'] == {"shard_actions": 5}
+    for s in studies:
+        assert s['products_dir'] == str(products.join(s['name']))
+        assert os.path.isdir(s['products_dir'])
+        assert s['submission'] == os.path.join(s['products_dir'],
+                                               "submission.xml")
+        assert s['ready'] == os.path.join(s['products_dir'], "submit.ready")
+
+
+@pytest.mark.parametrize("change, message", [
+    (dict(seqinfo_wgs=""), "has no seqinfo_wgs"),
+    (dict(name="A"), "is in"),
+])
+def test_load_batch_rejects_bad_entries(tmpdir, change, message):
+    a, _ = _entry(tmpdir, "A")
+    b, _ = _entry(tmpdir, "B", **change)
+    with pytest.raises(ValueError) as e:
+        batch.load_batch(_write_batch(tmpdir, [a, b]),
+                         str(tmpdir.join("products")))
+    assert message in str(e.value)
+
+
+def test_configure_names_each_studys_tasks(tmpdir):
+    a, _ = _entry(tmpdir, "A")
+    b, _ = _entry(tmpdir, "B", serialize={"shard_actions": 5})
+    products = str(tmpdir.join("products"))
+    studies = batch.load_batch(_write_batch(tmpdir, [a, b]), products)
+    names = [ task['name']
+              for tasks in batch.configure(studies, products, _options())
+              for task in tasks ]
+
+    for study in ("A", "B"):
+        assert "validate: metadata [%s]"%(study) in names
+        assert "check: sequences [%s]"%(study) in names
+    assert "upload: batch" in names
+    assert "report:get_reports" in names
+    assert [ s['sharded'] for s in studies ] == [False, True]
+    assert studies[0]['files'] == studies[0]['files_16s'] + \
+        studies[0]['files_wgs']
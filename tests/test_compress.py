@@ -0,0 +1,50 @@
+import gzip
+
+import pytest
+
+from envi_sra.compress import renamer
+from envi_sra.compress import compress_all
+
+
+def _header_name(fname):
+    # FNAME follows the 10 byte header when FLG has 0x08 set
+    with open(fname, 'rb') as f:
+        head = f.read(512)
+    assert ord(head[3]) & 0x08
+    return head[10:head.index("\0", 10)]
+
+
+@pytest.mark.parametrize("fmt", ["gzip", "bgzip"])
+def test_same_names_from_different_directories(tmpdir, fmt):
+    a = tmpdir.mkdir("a").join("S1.fastq")
+    b = tmpdir.mkdir("b").join("S1.fastq")
+    a.write("@a\nAAAA\n+\nIIII\n")
+    b.write("@b\nCCCC\n+\nIIII\n")
+    cache = str(tmpdir.join("compressed"))
+    assert compress_all([str(a), str(b)], cache, fmt, workers=2)
+    rename = renamer(cache)
+    out_a, out_b = rename(str(a)), rename(str(b))
+    assert out_a != out_b
+    assert out_a.endswith("/S1.fastq.gz") and out_b.endswith("/S1.fastq.gz")
+    assert gzip.open(out_a).read() == a.read()
+    assert gzip.open(out_b).read() == b.read()
+    assert not list(tmpdir.join("compressed").visit("*.part"))
+
+
+def test_gzip_header_names_the_original_file(tmpdir):
+    seq = tmpdir.join("S1.fastq")
+    seq.write("@a\nAAAA\n+\nIIII\n")
+    cache = str(tmpdir.join("compressed"))
+    assert compress_all([str(seq)], cache, "gzip")
+    assert _header_name(renamer(cache)(str(seq))) == "S1.fastq"
+
+
+def test_compressed_files_are_left_alone(tmpdir):
+    seq = tmpdir.join("S1.fastq.gz")
+    f = gzip.open(str(seq), 'wb')
+    f.write("@a\nAAAA\n+\nIIII\n")
+    f.close()
+    cache = str(tmpdir.join("compressed"))
+    assert compress_all([str(seq)], cache, "gzip")
+    assert renamer(cache)(str(seq)) == str(seq)
+    assert not tmpdir.join("compressed").check()
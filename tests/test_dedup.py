@@ -0,0 +1,34 @@
+from envi_sra import dedup
+from envi_sra.compress import renamer
+from envi_sra.compress import compress_all
+
+
+def _write(d, name, text):
+    f = d.join(name)
+    f.write(text)
+    return str(f)
+
+
+def test_for_uploads_matches_by_path_not_name(tmpdir):
+    a, b = tmpdir.mkdir("a"), tmpdir.mkdir("b")
+    orig = _write(a, "S1.fastq", "@r\nACGT\n+\nIIII\n")
+    dup = _write(a, "S1_copy.fastq", "@r\nACGT\n+\nIIII\n")
+    other = _write(b, "S1_copy.fastq", "@r\nTTTT\n+\nIIII\n")
+    dups = dedup.find_duplicates([orig, dup, other])
+    assert dups == {dup: orig}
+
+    assert dedup.for_uploads([orig, dup, other], dups) == {dup: orig}
+    assert dedup.for_uploads([orig, other], dups) == {}
+
+
+def test_for_uploads_maps_compressed_copies(tmpdir):
+    a, b = tmpdir.mkdir("a"), tmpdir.mkdir("b")
+    orig = _write(a, "S1.fastq", "@r\nACGT\n+\nIIII\n")
+    dup = _write(b, "S1.fastq", "@r\nACGT\n+\nIIII\n")
+    cache = str(tmpdir.join("compressed"))
+    assert compress_all([orig, dup], cache, "gzip")
+    rename = renamer(cache)
+    dups = {dup: orig}
+    uploads = [rename(orig), rename(dup)]
+    assert dedup.for_uploads(uploads, dups, cache) == \
+        {rename(dup): rename(orig)}
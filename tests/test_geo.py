@@ -0,0 +1,27 @@
+import pytest
+
+from envi_sra import geo
+
+
+values = [
+    "0 0", "0.0 -0.0", "-0 180", "0 -180", "-90 -180", "90 180",
+    "42.37 -71.11", "-33.9,151.2", "33.9 S 151.2 E", "12 N 0 W",
+    "0.00 N 180.00 W", "1 2 3 4", (u"10", u"-20"), ["1.5", "2.5"],
+    (1.25, -2.5), "N 12, W 3",
+]
+
+
+@pytest.mark.parametrize("numpy", [True, False])
+def test_cardinal_many_matches_cardinal(monkeypatch, numpy):
+    if not numpy:
+        monkeypatch.setattr(geo, "numpy_or_none", lambda: None)
+    many = geo.cardinal_many(values + values[::-1])
+    assert many == [ geo._cardinal(v) for v in values + values[::-1] ]
+
+
+def test_cardinal_many_raises_like_cardinal():
+    with pytest.raises(ValueError) as many:
+        geo.cardinal_many(["0 0", "abc def"])
+    with pytest.raises(ValueError) as one:
+        geo._cardinal("abc def")
+    assert str(many.value) == str(one.value)
@@ -0,0 +1,62 @@
+import os
+
+from envi_sra.ledger import reconcile
+from envi_sra.manifest import Manifest
+from envi_sra.manifest import manifest_fname
+from envi_sra.ssh import RemoteFile
+
+
+class FakeConnection(object):
+    """Lists ``dirs``, a dict of remote directory -> {name: size}, with
+    None for a size making a subdirectory"""
+
+    def __init__(self, dirs):
+        self.dirs = dirs
+
+    def listdir(self, path):
+        if path.rstrip("/") not in self.dirs:
+            raise IOError(2, "No such file")
+        return [ RemoteFile(name, size or 0, None, size is None)
+                 for name, size in self.dirs[path.rstrip("/")].items() ]
+
+
+def _write(d, name, text):
+    f = d.join(name)
+    f.write(text)
+    return str(f)
+
+
+def test_reconcile_finds_files_in_shard_directories(tmpdir):
+    products = tmpdir.mkdir("products")
+    manifest = Manifest(manifest_fname(str(products)))
+    seqs = tmpdir.mkdir("seqs")
+    s1 = _write(seqs, "s1.fastq", "ACGT")
+    s2 = _write(seqs, "s2.fastq", "ACGTACGT")
+    s3 = _write(seqs, "s3.fastq", "AC")
+    gone = str(seqs.join("gone.fastq"))
+    conn = FakeConnection({
+        "/submit/Study": {"shard.0": None, "shard.1": None, "s3.fastq": 2},
+        "/submit/Study/shard.0": {"s1.fastq": 4},
+        "/submit/Study/shard.1": {"s2.fastq": 8},
+    })
+
+    counts = reconcile(manifest, conn, "/submit/Study/",
+                       [s1, s1+".complete", s2, s3, gone])
+    assert counts['found'] == 3
+    assert counts['missing'] == 1
+    assert manifest.is_uploaded(s1, "/submit/Study/shard.0")
+    assert manifest.is_uploaded(s2, "/submit/Study/shard.1")
+    assert manifest.is_uploaded(s3, "/submit/Study/")
+
+    # already in the ledger, so nothing more to find
+    counts = reconcile(manifest, conn, "/submit/Study/", [s1, s2, s3])
+    assert counts['found'] == 0 and counts['missing'] == 0
+
+    # gone from the server: forgotten, and its marker removed
+    del conn.dirs["/submit/Study/shard.1"]["s2.fastq"]
+    open(s2+".complete", 'w').close()
+    counts = reconcile(manifest, conn, "/submit/Study/", [s1, s2, s3])
+    assert counts['missing'] == 1
+    assert not manifest.is_uploaded(s2, "/submit/Study/shard.1")
+    assert not os.path.exists(s2+".complete")
+    manifest.close()
@@ -0,0 +1,116 @@
+import os
+
+import pytest
+
+from envi_sra.manifest import Manifest
+from envi_sra.manifest import md5sum
+
+
+def _write(d, name, text):
+    f = d.join(name)
+    f.write(text)
+    return str(f)
+
+
+def _manifest(tmpdir):
+    return Manifest(str(tmpdir.join("ledger.sqlite")), workers=2)
+
+
+def test_uploads_are_tracked_by_md5(tmpdir):
+    m = _manifest(tmpdir)
+    seq = _write(tmpdir, "S1.fastq", "@r\nACGT\n+\nIIII\n")
+    assert m.status(seq, "/submit/A") == "new"
+    m.mark_started(seq, "/submit/A")
+    assert not m.is_uploaded(seq, "/submit/A")
+    m.mark_uploaded(seq, "/submit/A")
+    assert m.is_uploaded(seq, "/submit/A")
+    assert not m.is_uploaded(seq, "/submit/B")
+    assert m.status(seq, "/submit/A") == "uploaded"
+    assert m.md5(seq) == md5sum(seq)
+
+    with open(seq, 'a') as f:
+        f.write("@s\nTTTT\n+\nIIII\n")
+    assert m.status(seq, "/submit/A") == "changed"
+    assert not m.is_uploaded(seq, "/submit/A")
+
+    m.mark_failed(seq, "/submit/A")
+    assert [ u[3] for u in m.uploads() ] == ["failed"]
+    m.forget(seq, "/submit/A")
+    assert m.uploads() == []
+    m.close()
+
+
+def test_touched_but_unchanged_file_counts_as_uploaded(tmpdir):
+    m = _manifest(tmpdir)
+    seq = _write(tmpdir, "S1.fastq", "@r\nACGT\n+\nIIII\n")
+    m.mark_uploaded(seq, "/submit/A")
+    st = os.stat(seq)
+    os.utime(seq, (st.st_atime, st.st_mtime+10))
+    assert m.is_uploaded(seq, "/submit/A")
+    m.close()
+
+
+def test_uploads_under_a_directory(tmpdir):
+    m = _manifest(tmpdir)
+    seq = _write(tmpdir, "S1.fastq", "@r\nACGT\n+\nIIII\n")
+    for dest in ("/submit/My_Study", "/submit/My_Study/shard.0",
+                 "/submit/MyXStudy/shard.0", "/submit/my_study/shard.1",
+                 "/submit/My_Study2", "/submit/My%Study/shard.0"):
+        m.mark_uploaded(seq, dest)
+    assert [ u[1] for u in m.uploads("/submit/My_Study/") ] == \
+        ["/submit/My_Study", "/submit/My_Study/shard.0"]
+    assert [ u[1] for u in m.uploads("/submit/My%Study") ] == \
+        ["/submit/My%Study/shard.0"]
+    assert len(m.uploads()) == 6
+    m.close()
+
+
+def test_submissions(tmpdir):
+    m = _manifest(tmpdir)
+    sub = _write(tmpdir, "submission.xml", "<Submission/>")
+    report = _write(tmpdir, "report.1.xml", "<SubmissionStatus/>")
+    m.serialized(sub)
+    assert m.submission(sub)['state'] == "serialized"
+    m.record_submission(sub, dest="/submit/A", state="submitted")
+    assert m.reported(sub) is None
+    m.record_submission(sub, state="reported", status="processing",
+                        report=report)
+    assert m.reported(sub) is None
+    m.record_submission(sub, status="processed-ok")
+    assert m.reported(sub) == report
+    assert m.submission(sub)['dest'] == "/submit/A"
+
+    # a new submission written to the same path starts over
+    with open(sub, 'w') as f:
+        f.write("<Submission><Action/></Submission>")
+    assert m.reported(sub) is None
+    m.serialized(sub)
+    assert m.submission(sub)['status'] is None
+    assert [ s['path'] for s in m.submissions() ] == [sub]
+    m.close()
+
+
+def test_refresh_hashes_only_changed_files(tmpdir, monkeypatch):
+    m = _manifest(tmpdir)
+    seqs = [ _write(tmpdir, "S%i.fastq"%(i), "@r\nACGT\n+\nIIII\n"*i)
+             for i in range(1, 4) ]
+    m.refresh(seqs)
+    hashed = list()
+    monkeypatch.setattr(m, "_hash", lambda p: hashed.append(p) or
+                        (p, os.stat(p).st_size, os.stat(p).st_mtime, "x"))
+    with open(seqs[1], 'a') as f:
+        f.write("@s\nTTTT\n+\nIIII\n")
+    m.refresh(seqs)
+    assert hashed == [seqs[1]]
+    m.close()
+
+
+def test_readonly_needs_an_existing_ledger(tmpdir):
+    fname = str(tmpdir.join("ledger.sqlite"))
+    with pytest.raises(IOError):
+        Manifest(fname, readonly=True)
+    assert not os.path.exists(fname)
+    Manifest(fname).close()
+    m = Manifest(fname, readonly=True)
+    assert m.uploads() == []
+    m.close()
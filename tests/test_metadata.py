@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+import io
+import json
+
+import pytest
+
+from envi_sra.metadata import iter_json_array
+from envi_sra.metadata import iter_json_lines
+from envi_sra.metadata import iter_qiime_mapping
+from envi_sra.metadata import iter_records
+from envi_sra.metadata import sniff
+
+
+arrays = [
+    '[]',
+    ' \n[ ]\n',
+    '[1.5, 2e3]',
+    '[12345678901234, 15000000000.0, "x"]',
+    '[-1, -0.25, 1E-3, 4e+2, true, false, null]',
+    '[{"a": [1, {"b": "c,]"}]}, "q\\"uote", {"r\\u00e9": "\xc3\xa9"}]',
+    '[ 1 ,\n2\t,3 ]',
+]
+
+
+@pytest.mark.parametrize("text", arrays)
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5, 8, 64*1024])
+def test_json_array_matches_json_loads(text, chunk_size):
+    got = list(iter_json_array(io.BytesIO(text), chunk_size=chunk_size))
+    assert got == json.loads(text)
+
+
+@pytest.mark.parametrize("text", [
+    '', '{"a": 1}', '[1, 2', '[1 2]', '[,1]', '[,,1, 2]', '[1,, 2]',
+    '[1,]', '[1.5, 2e]', '[tru]',
+])
+@pytest.mark.parametrize("chunk_size", [1, 4, 64*1024])
+def test_json_array_rejects_malformed(text, chunk_size):
+    with pytest.raises(ValueError):
+        list(iter_json_array(io.BytesIO(text), chunk_size=chunk_size))
+
+
+def test_json_array_yields_before_reading_everything():
+    f = io.BytesIO('[{"a": 1}, ' + '{"b": 2}, '*1000 + '{"c": 3}]')
+    recs = iter_json_array(f, chunk_size=16)
+    assert next(recs) == {"a": 1}
+    assert f.tell() < 64
+
+
+def test_json_lines_skips_blank_lines():
+    f = io.BytesIO('{"a": 1}\n\n  \n{"b": "\xc3\xa9"}\r\n')
+    assert list(iter_json_lines(f)) == [{"a": 1}, {"b": u"\xe9"}]
+
+
+def test_qiime_mapping_uses_the_first_header():
+    f = io.BytesIO("#SampleID\tBarcode\tsite\r\n"
+                   "#a comment\n"
+                   "\n"
+                   "s1\tACGT\tr\xc3\xa9f\r\n"
+                   "s2\tTTTT\t\n")
+    assert list(iter_qiime_mapping(f)) == [
+        {"SampleID": "s1", "Barcode": "ACGT", "site": u"r\xe9f"},
+        {"SampleID": "s2", "Barcode": "TTTT", "site": ""},
+    ]
+
+
+def test_qiime_mapping_needs_a_header():
+    with pytest.raises(ValueError):
+        list(iter_qiime_mapping(io.BytesIO("s1\tACGT\n")))
+
+
+@pytest.mark.parametrize("name, text, fmt", [
+    ("m.jsonl", '[1]', "jsonl"),
+    ("m.NDJSON", '', "jsonl"),
+    ("m.tsv", '[1]', "qiime"),
+    ("m.map", '', "qiime"),
+    ("m.json", '\n  [{"a": 1}]', "json"),
+    ("m", '{"a": 1}\n', "jsonl"),
+    ("m.dat", '#SampleID\n', "qiime"),
+])
+def test_sniff(tmpdir, name, text, fmt):
+    fname = tmpdir.join(name)
+    fname.write(text)
+    assert sniff(str(fname)) == fmt
+
+
+def test_sniff_gives_up(tmpdir):
+    fname = tmpdir.join("m.json")
+    fname.write("SampleID,site\n")
+    with pytest.raises(ValueError):
+        sniff(str(fname))
+
+
+def test_iter_records(tmpdir):
+    fname = tmpdir.join("m.json")
+    fname.write('[{"a": 1.5}, {"a": 2e3}]')
+    assert list(iter_records(str(fname))) == [{"a": 1.5}, {"a": 2000.0}]
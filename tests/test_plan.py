@@ -0,0 +1,85 @@
+import os
+import sys
+import sqlite3
+import subprocess
+import hashlib
+
+import pytest
+
+from benchmarks.synth import make_study
+from envi_sra.plan import plan
+from envi_sra.manifest import Manifest
+from envi_sra.manifest import manifest_fname
+
+
+def _plan(study, products, **kwargs):
+    return plan(study['study_json'], study['qiime_metadata'],
+                study['seqinfo_16s'], study['files_16s'],
+                study['wgs_metadata'], study['seqinfo_wgs'],
+                study['files_wgs'], products, "/submit/Study/", **kwargs)
+
+
+def _digest(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+
+def test_plan_finds_uploads_in_shard_directories(tmpdir):
+    study = make_study(str(tmpdir.join("study")), 6)
+    products = str(tmpdir.mkdir("products"))
+    manifest = Manifest(manifest_fname(products))
+    first = study['files_16s'][0]
+    manifest.mark_uploaded(first, "/submit/Study/shard.0")
+    manifest.close()
+    before = _digest(manifest_fname(products))
+
+    p = _plan(study, products, shard_actions=5)
+
+    assert len(p.shards) == 3
+    assert p.submission == os.path.join(products, "plan", "shards.json")
+    dests = dict( (os.path.basename(e.upload_name), e.dest)
+                  for e in p.files )
+    for shard in p.shards:
+        for f in shard['files']:
+            assert dests[os.path.basename(f)] == \
+                "/submit/Study/"+shard['name']
+    statuses = dict( (e.upload_name, e.status) for e in p.files )
+    assert statuses.pop(first) == "uploaded"
+    assert set(statuses.values()) == set(["pending"])
+    assert _digest(manifest_fname(products)) == before
+
+
+def test_plan_without_shards_uses_the_remote_path(tmpdir):
+    study = make_study(str(tmpdir.join("study")), 4)
+    products = str(tmpdir.mkdir("products"))
+    manifest = Manifest(manifest_fname(products))
+    manifest.mark_uploaded(study['files_16s'][0], "/submit/Study/")
+    manifest.close()
+
+    p = _plan(study, products)
+
+    assert p.shards == [] and p.submission.endswith("plan.xml")
+    assert set(e.dest for e in p.files) == set(["/submit/Study/"])
+    assert [ e.status for e in p.files ].count("uploaded") == 1
+
+
+def test_readonly_ledger_isnt_written(tmpdir):
+    fname = str(tmpdir.join("ledger.sqlite"))
+    Manifest(fname).close()
+    seq = tmpdir.join("a.fastq")
+    seq.write("@a\nACGT\n+\nIIII\n")
+    manifest = Manifest(fname, readonly=True)
+    assert manifest.known_md5(str(seq)) is None
+    assert manifest.status(str(seq), "/submit/") == "new"
+    with pytest.raises(sqlite3.OperationalError):
+        manifest.mark_uploaded(str(seq), "/submit/")
+    manifest.close()
+
+
+def test_importing_plan_loads_no_heavy_dependencies():
+    heavy = ("anadama.pipelines", "paramiko", "numpy")
+    code = ("import sys, envi_sra.plan; "
+            "print ' '.join(m for m in %r if m in sys.modules)"%(heavy,))
+    top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    loaded = subprocess.check_output([sys.executable, "-c", code], cwd=top)
+    assert loaded.split() == []
@@ -0,0 +1,77 @@
+import os
+import json
+
+import pytest
+
+from envi_sra import resolve as resolve_
+from envi_sra.resolve import digest
+from envi_sra.resolve import resolve
+from envi_sra.resolve import ResolveError
+from envi_sra.resolve import SampleResolver
+
+
+@pytest.fixture(autouse=True)
+def find_file(monkeypatch):
+    # the fuzzy matcher proper is anadama's; take the best scored
+    monkeypatch.setattr(resolve_, "find_file", lambda n, h: h[0])
+
+
+def test_exact_stem_beats_prefix():
+    r = SampleResolver(["/s/Dust.1.fastq", "/s/Dust.10.fastq"])
+    assert r.resolve_one("Dust.1") == ("/s/Dust.1.fastq", [])
+
+
+def test_prefix_of_several_files_is_ambiguous():
+    files = ["/s/WGS1_R1.fastq.gz", "/s/WGS1_R2.fastq.gz", "/s/WGS2_R1.fq"]
+    match, candidates = SampleResolver(files).resolve_one("WGS1")
+    assert match in files[:2] and sorted(candidates) == files[:2]
+
+
+def test_fuzzy_match_with_one_best_file():
+    files = ["/s/run1-sampleXY.fastq", "/s/run2-other.fastq"]
+    assert SampleResolver(files).resolve_one("sampleXY") == (files[0], [])
+
+
+def test_fuzzy_ties_are_ambiguous():
+    files = ["/s/run1-sampleXY.fastq", "/s/run2-sampleXY.fastq",
+             "/s/run3-other.fastq"]
+    match, candidates = SampleResolver(files).resolve_one("sampleXY")
+    assert match in files[:2] and sorted(candidates) == files[:2]
+
+
+def test_ids_shorter_than_k_match_by_substring():
+    files = ["/s/run_A1.fastq", "/s/run_B2.fastq", "/s/A1x_B.fastq"]
+    r = SampleResolver(files[:2])
+    assert r.resolve_one("B2") == ("/s/run_B2.fastq", [])
+    assert r.resolve_one("C3") == (None, [])
+    match, candidates = SampleResolver(files).resolve_one("a1")
+    assert sorted(candidates) == sorted([files[0], files[2]])
+
+
+def test_unmatched_samples_raise():
+    with pytest.raises(ResolveError) as e:
+        resolve(["S1", "S2"], ["/s/S1.fastq"])
+    assert "S2" in str(e.value)
+
+
+def test_cache_for_a_key_is_replaced(tmpdir):
+    cache_dir = str(tmpdir)
+    ids, files = ["S1", "S2"], ["/s/S1.fastq", "/s/S2.fastq"]
+    assert resolve(ids, files, cache_dir, key="/m/meta.tsv") == \
+        {"S1": "/s/S1.fastq", "S2": "/s/S2.fastq"}
+    cached = os.listdir(cache_dir)
+    assert len(cached) == 1
+
+    files = ["/t/S1.fastq", "/t/S2.fastq"]
+    assert resolve(ids, files, cache_dir, key="/m/meta.tsv")["S1"] == \
+        "/t/S1.fastq"
+    assert os.listdir(cache_dir) == cached
+    with open(os.path.join(cache_dir, cached[0])) as f:
+        assert json.load(f)['digest'] == digest(ids, files)
+
+
+def test_cache_is_reused(tmpdir, monkeypatch):
+    ids, files = ["S1"], ["/s/S1.fastq"]
+    resolve(ids, files, str(tmpdir), key="m")
+    monkeypatch.setattr(resolve_, "SampleResolver", None)
+    assert resolve(ids, files, str(tmpdir), key="m") == {"S1": files[0]}
@@ -0,0 +1,27 @@
+from envi_sra import seqstats
+from envi_sra.compress import renamer
+from envi_sra.compress import cache_dir
+
+
+def _write(d, name, text):
+    f = d.join(name)
+    f.write(text)
+    return str(f)
+
+
+def test_bad_uploads_match_by_path_not_name(tmpdir, monkeypatch):
+    products = tmpdir.mkdir("products")
+    table = seqstats.table_fname(str(products))
+    good = _write(tmpdir.mkdir("good"), "S1.fastq", "@r\nACGT\n+\nIIII\n")
+    bad = _write(tmpdir.mkdir("bad"), "S1.fastq", "@r\nACGT\n+\nII\n")
+    stats = seqstats.scan_all([good, bad], table, workers=1)
+    assert stats[bad]['error'] and not stats[good]['error']
+
+    rename = renamer(cache_dir(str(products)))
+    assert seqstats.bad_uploads([good, rename(good)], table) == []
+    found = seqstats.bad_uploads([bad, rename(bad)], table)
+    assert [ f for f, _ in found ] == [bad, rename(bad)]
+
+    monkeypatch.chdir(tmpdir)
+    assert [ f for f, _ in seqstats.bad_uploads(["bad/S1.fastq"], table) ] \
+        == ["bad/S1.fastq"]
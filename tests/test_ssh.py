@@ -0,0 +1,115 @@
+import os
+import warnings
+
+import pytest
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    standin = pytest.importorskip("benchmarks.standin")
+
+from envi_sra import ssh
+
+
+@pytest.fixture(scope="module")
+def server(tmpdir_factory):
+    root = tmpdir_factory.mktemp("root")
+    root.mkdir("submit")
+    keyfile = standin.client_key(str(root.join("key")))
+    s = standin.StandinServer(str(root)).start()
+    yield s, str(root), keyfile
+    s.stop()
+
+
+def _connect(server, path, **kwargs):
+    s, _, keyfile = server
+    return ssh.SSHConnection("test", "127.0.0.1", keyfile, path,
+                             port=s.port, **kwargs)
+
+
+@pytest.mark.parametrize("mode", ["sftp", "shell"])
+def test_remote_path_is_made_on_first_use(server, mode):
+    _, root, _ = server
+    study = os.path.join(root, "submit", "Lazy_"+mode)
+    c = _connect(server, "/submit/Lazy_%s/"%(mode), mode=mode)
+    try:
+        assert c.remote_path == "/submit/Lazy_"+mode
+        assert not os.path.exists(study)
+        assert c.files() == []
+        assert os.path.isdir(study)
+        with open(os.path.join(study, "a.fastq"), 'w') as f:
+            f.write("ACGT")
+        # listed when it's first asked for, not on connecting
+        assert c.file_cache == {c.remote_path+"/a.fastq": 4}
+        assert c.fsize("a.fastq") == 4
+    finally:
+        c.close()
+
+
+def test_reconnecting_closes_the_old_sftp_session(server):
+    c = _connect(server, "/submit/Reconnect/", mode="sftp")
+    try:
+        old = c.sftp
+        c.transport.close()
+        c.ensure_active()
+        assert c.sftp is not old
+        assert old.sock.closed
+        assert c.files() == []
+    finally:
+        c.close()
+
+
+def _open_channels(transport):
+    return [ c for c in transport._channels.values() if not c.closed ]
+
+
+def test_pooled_connections_share_one_sftp_session(server):
+    s, root, keyfile = server
+    os.mkdir(os.path.join(root, "submit", "Pooled"))
+    pool = ssh.ConnectionPool(keepalive=0)
+    try:
+        conns = [ pool.connection("test", "127.0.0.1", keyfile,
+                                  "/submit/Pooled/shard.%i"%(i),
+                                  port=s.port, mode="sftp")
+                  for i in range(15) ]
+        for c in conns:
+            assert c.files() == []
+        assert len(set(id(c.sftp) for c in conns)) == 1
+        shared, transport = conns[0].sftp, conns[0].transport
+        assert len(_open_channels(transport)) == 1
+        for c in conns:
+            c.close()
+        # still there for the next connection
+        c = pool.connection("test", "127.0.0.1", keyfile, "/submit/Pooled",
+                            port=s.port, mode="sftp")
+        assert c.sftp is shared and c.files()
+        c.close()
+    finally:
+        pool.close()
+
+
+def test_pooled_shell_connections_close_their_channels(server):
+    s, _, keyfile = server
+    pool = ssh.ConnectionPool(keepalive=0)
+    try:
+        for i in range(3):
+            c = pool.connection("test", "127.0.0.1", keyfile,
+                                "/submit/Shells", port=s.port, mode="shell")
+            c.files()
+            c.close()
+            assert _open_channels(c.transport) == []
+    finally:
+        pool.close()
+
+
+def test_reconnecting_without_a_pool_closes_the_old_transport(server,
+                                                               monkeypatch):
+    c = _connect(server, "/submit/Unpooled/", mode="sftp")
+    try:
+        old = c.transport
+        monkeypatch.setattr(ssh, "healthy", lambda t: t is not old)
+        c.ensure_active()
+        assert c.transport is not old
+        assert not old.is_active()
+        assert c.files() == []
+    finally:
+        c.close()
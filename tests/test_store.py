@@ -0,0 +1,65 @@
+import pytest
+
+from envi_sra.store import Seq
+from envi_sra.store import Layouts
+from envi_sra.store import SampleStore
+
+
+def test_sample_reads_and_writes_like_a_dict():
+    layouts = Layouts()
+    rec = {"SampleID": "S1", "lat_lon": "1 2", "site": "a"}
+    s = layouts.sample(rec, id="study:S1")
+    assert dict(s.items()) == rec
+    assert sorted(s) == sorted(rec) and len(s) == 3
+    assert s["site"] == "a" and s.get("site") == "a"
+    assert s.get("nope") is None and s.get("nope", "x") == "x"
+    assert "site" in s and "nope" not in s
+    with pytest.raises(KeyError):
+        s["nope"]
+
+    s["site"] = "b"
+    assert s["site"] == "b"
+    s["extra"] = "e"
+    assert s.keys()[-1] == "extra" and s["extra"] == "e"
+
+
+def test_samples_share_columns_until_one_gains_a_key():
+    layouts = Layouts()
+    a = layouts.sample({"x": 1, "y": 2})
+    b = layouts.sample({"x": 3, "y": 4})
+    assert a.columns is b.columns
+    a["z"] = 5
+    assert a.columns is not b.columns
+    assert "z" not in b and len(b) == 2
+    assert dict(b.items()) == {"x": 3, "y": 4}
+
+
+def test_store_finds_pairs_by_spuid():
+    store = SampleStore()
+    pairs = list()
+    for i in range(3):
+        s = store.layouts.sample({"SampleID": "S%i"%(i), "site": "same"},
+                                 id="sample:%i"%(i), intern=store.intern)
+        seq = Seq("/s/S%i.fastq"%(i), "Illumina", "AMPLICON", "kit",
+                  id="seq:%i"%(i))
+        store.add(s, seq)
+        pairs.append((s, seq))
+    assert len(store) == 3
+    assert list(store) == pairs
+    assert store[1] == pairs[1]
+    assert store.lookup("sample:2") == pairs[2]
+    assert store.lookup("seq:0") == pairs[0]
+    with pytest.raises(KeyError):
+        store.lookup("sample:9")
+    # one copy of each repeated value
+    values = [ s.values[s.columns["site"]] for s, _ in store ]
+    assert all(v is values[0] for v in values)
+
+
+def test_intern_leaves_other_values_alone():
+    store = SampleStore()
+    assert store.intern(1.5) == 1.5
+    assert store.intern(None) is None
+    a = "".join(["ab", "c"])
+    assert store.intern(a) is a
+    assert store.intern("".join(["a", "bc"])) is a
@@ -0,0 +1,149 @@
+import threading
+
+from envi_sra import transfer
+from envi_sra.transfer import AsperaBackend
+from envi_sra.transfer import fair_order
+from envi_sra.transfer import RateController
+from envi_sra.transfer import UploadScheduler
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+        self.lock = threading.Lock()
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        pass
+
+    def advance(self, seconds):
+        with self.lock:
+            self.now += seconds
+
+
+def _clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(transfer.time, "time", clock.time)
+    monkeypatch.setattr(transfer.time, "sleep", clock.sleep)
+    return clock
+
+
+def _files(tmpdir, sizes):
+    jobs = list()
+    for i, size in enumerate(sizes):
+        f = tmpdir.join("f%i.fastq"%(i))
+        f.write("A"*size)
+        jobs.append((str(f), str(f)+".complete", "/submit/"))
+    return jobs
+
+
+def _round(c, clock, nbytes, seconds, ok=True):
+    # one round of c.parallel uploads of nbytes each
+    n = c.parallel
+    for _ in range(n):
+        c.acquire()
+    clock.advance(seconds)
+    for _ in range(n):
+        c.release(nbytes, ok)
+
+
+def test_rounds_start_when_uploads_are_sent(monkeypatch, tmpdir):
+    clock = _clock(monkeypatch)
+    c = RateController(2, adaptive=False)
+    clock.advance(1000)
+    def send(local_fname, dest):
+        clock.advance(1)
+        return True
+    UploadScheduler(send, 2, controller=c,
+                    progress_interval=0).run(_files(tmpdir, [100, 100]))
+    # two files of 100 bytes, one after the other in a second each
+    assert c.throughput == 100
+
+
+def test_controller_adds_uploads_while_throughput_grows(monkeypatch):
+    clock = _clock(monkeypatch)
+    c = RateController(4, start=1)
+    c.start()
+    _round(c, clock, 100, 1)
+    assert c.parallel == 2
+    _round(c, clock, 100, 1)
+    assert c.parallel == 3
+    # the third didn't help; take it back
+    _round(c, clock, 66, 1)
+    assert c.parallel == 2
+
+
+def test_controller_cuts_uploads_on_failure(monkeypatch):
+    clock = _clock(monkeypatch)
+    c = RateController(8, start=4)
+    c.start()
+    c.acquire()
+    c.release(0, False)
+    assert c.parallel == 2
+
+
+def test_controller_splits_the_ceiling(monkeypatch):
+    _clock(monkeypatch)
+    class Backend(object):
+        rate = 0
+    backend = Backend()
+    c = RateController(4, ceiling=1000, start=2, backend=backend)
+    assert c.rate() == 500 and backend.rate == 500
+
+
+def test_scheduler_retries_and_marks_complete(monkeypatch, tmpdir):
+    _clock(monkeypatch)
+    jobs = _files(tmpdir, [10, 30, 20])
+    tries, done, failed = dict(), list(), list()
+    def send(local_fname, dest):
+        tries[local_fname] = tries.get(local_fname, 0)+1
+        # the largest file never goes; the next goes on its second try
+        return local_fname != jobs[1][0] and \
+            (local_fname != jobs[2][0] or tries[local_fname] > 1)
+    s = UploadScheduler(send, 2, retries=2, progress_interval=0,
+                        done=lambda f, d: done.append(f),
+                        failed=lambda f, d: failed.append(f))
+    assert s.run(jobs) is False
+    assert tries == {jobs[0][0]: 1, jobs[1][0]: 3, jobs[2][0]: 2}
+    assert sorted(done) == sorted([jobs[0][0], jobs[2][0]])
+    assert failed == [jobs[1][0]]
+    assert [ tmpdir.join("f%i.fastq.complete"%(i)).check()
+             for i in range(3) ] == [True, False, True]
+    assert s.left == 0 and s.remaining == 0
+
+
+def test_fair_order_takes_turns():
+    jobs = ["a1", "a2", "a3", "b1", "c1", "c2"]
+    assert fair_order(jobs, lambda j: j[0]) == \
+        ["a1", "b1", "c1", "a2", "c2", "a3"]
+
+
+class FakePopen(object):
+    argvs = list()
+    returncode = 0
+
+    def __init__(self, argv, **kwargs):
+        self.argvs.append(argv)
+
+    def communicate(self):
+        return "Session Stop  (Error: Disk write failed)\n", None
+
+
+def test_aspera_backend_sets_the_rate_without_dropping_encryption(
+        monkeypatch, capsys):
+    monkeypatch.setattr(transfer.subprocess, "Popen", FakePopen)
+    monkeypatch.setattr(FakePopen, "argvs", [])
+    backend = AsperaBackend("srv.example", "asp-hmp2", "/keys/key",
+                            ascp="/opt/ascp")
+    backend.rate = 2.5*transfer.MB
+    assert backend.upload("seqs/s1.fastq", "/submit/Study/")
+    assert FakePopen.argvs == [[
+        "/opt/ascp", "-d", "-k", "1", "-i", "/keys/key", "-l", "20971K",
+        "seqs/s1.fastq", "asp-hmp2@srv.example:/submit/Study/"]]
+    assert "-T" not in FakePopen.argvs[0]
+
+    monkeypatch.setattr(FakePopen, "returncode", 1)
+    assert not backend.upload("seqs/s1.fastq", "/submit/Study/")
+    assert "Disk write failed" in capsys.readouterr()[1]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from envi_sra.update import Accession
+from envi_sra.update import IndexWriter
+from envi_sra.update import load_index
+
+
+accs = [
+    Accession(u"study:sample:1", u"processed-ok", u"SAMN0001",
+              u"BioSample", []),
+    Accession(u"study:seq:1", u"processed-error", u"", u"SRA",
+              [u"Bad file | wrong format", u"line one\nline two",
+               u"tab\there", u"back\\slash", u"[not json", u"r\xe9sum\xe9"]),
+    Accession(u"study:seq:2", u"processed-error", u"", u"SRA", [u""]),
+]
+
+
+@pytest.mark.parametrize("ext", [".json", ".tsv"])
+def test_index_round_trips(tmpdir, ext):
+    fname = str(tmpdir.join("accessions"+ext))
+    writer = IndexWriter(fname)
+    for acc in accs + [accs[0]._replace(accession=u"SAMN0002")]:
+        writer.write(acc)
+    writer.close()
+    index = load_index(fname)
+    assert sorted(index) == sorted(a.spuid for a in accs)
+    assert index[u"study:sample:1"].accession == u"SAMN0002"
+    for acc in accs[1:]:
+        assert tuple(index[acc.spuid]) == tuple(acc)
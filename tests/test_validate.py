@@ -0,0 +1,71 @@
+import json
+import random
+import xml.etree.ElementTree as ET
+
+from benchmarks.synth import record
+from envi_sra.store import Seq
+from envi_sra.store import Layouts
+from envi_sra.workflows import Bag
+from envi_sra.serialize import to_xml
+from envi_sra.validate import validate
+from envi_sra.xmlstream import biosample_action
+
+
+def _metadata(tmpdir, n, changes={}):
+    rand = random.Random(0)
+    recs = [ record(rand, "Dust.%i"%(i), i) for i in range(n) ]
+    for (i, key), value in changes.items():
+        recs[i][key] = value
+    fname = str(tmpdir.join("metadata.json"))
+    with open(fname, 'w') as f:
+        json.dump(recs, f)
+    return fname, recs
+
+
+def _errors(errors):
+    return [ (rec, key, value) for _, rec, _, key, value, _ in errors ]
+
+
+def test_good_metadata_has_no_errors(tmpdir):
+    fname, _ = _metadata(tmpdir, 20)
+    assert validate([fname]) == []
+
+
+def test_each_bad_value_is_an_error(tmpdir):
+    fname, _ = _metadata(tmpdir, 6, {
+        (0, "lat_lon"): "95.0 10.0",
+        (1, "collection_date"): "2015-02-30",
+        (2, "light_type"): "moonlight",
+        (3, "air_temp"): "warm",
+        (4, "SampleID"): "Dust.0",
+        (5, "env_biome"): " ",
+    })
+    assert sorted(_errors(validate([fname]))) == [
+        (1, "lat_lon", "95.0 10.0"),
+        (2, "collection_date", "2015-02-30"),
+        (3, "light_type", "moonlight"),
+        (4, "air_temp", "warm"),
+        (5, "SampleID", "Dust.0"),
+        (6, "env_biome", " "),
+    ]
+
+
+def test_missing_values_pass_and_serialize(tmpdir):
+    fname, recs = _metadata(tmpdir, 3, {
+        (0, "lat_lon"): "not collected",
+        (1, "lat_lon"): "missing",
+        (2, "collection_date"): "not provided",
+    })
+    assert validate([fname]) == []
+
+    st = Bag()
+    st.name, st.description, st.id = "Study", "A study", "study"
+    def samples_seqs():
+        layouts = Layouts()
+        return [ (layouts.sample(rec, "sample%i"%(i)),
+                  Seq("s%i.fastq"%(i), "Illumina MiSeq", "AMPLICON",
+                      "method", "seq%i"%(i)))
+                 for i, rec in enumerate(recs) ]
+    text = ET.tostring(to_xml(st, samples_seqs()))
+    assert ">not collected<" in text and ">missing<" in text
+    assert ">not collected<" in biosample_action(st, samples_seqs()[0][0])
@@ -0,0 +1,225 @@
+import os
+import pstats
+import random
+import shutil
+
+from benchmarks.synth import make_study
+from benchmarks.synth import write_report
+from envi_sra import workflows
+from envi_sra.metrics import Metrics
+from envi_sra.workflows import instrumented
+from envi_sra.workflows import serialize
+from envi_sra.xmlstream import promote
+from envi_sra.xmlstream import submitted_fname
+
+
+def test_instrumented_times_each_action_on_its_own(tmpdir):
+    prof = str(tmpdir.join("serialize.prof"))
+    metrics = Metrics()
+    calls = list()
+
+    def _write_xml():
+        calls.append("write")
+
+    def _record():
+        calls.append("record")
+
+    task = instrumented(metrics, {"name": "serialize:xml: x",
+                                  "actions": [_write_xml, _record]}, prof)
+    for action in task['actions']:
+        action()
+
+    assert calls == ["write", "record"]
+    assert metrics.get("task_runs_total", task="serialize:xml: x") == 1
+    assert metrics.get("task_runs_total",
+                       task="serialize:xml: x (record)") == 1
+    record_prof = str(tmpdir.join("serialize.record.prof"))
+    assert os.path.exists(record_prof)
+    funcs = [ f[2] for f in pstats.Stats(prof).stats ]
+    assert "_write_xml" in funcs and "_record" not in funcs
+    funcs = [ f[2] for f in pstats.Stats(record_prof).stats ]
+    assert "_record" in funcs and "_write_xml" not in funcs
+
+
+def _serialize(study, products_dir, **kwargs):
+    kwargs.setdefault("incremental", True)
+    tasks = list(serialize(
+        study['study_json'], study['qiime_metadata'], study['seqinfo_16s'],
+        study['files_16s'], study['wgs_metadata'], study['seqinfo_wgs'],
+        study['files_wgs'], os.path.join(products_dir, "submission.xml"),
+        os.path.join(products_dir, "submit.ready"), products_dir,
+        **kwargs))
+    return [ a() for a in tasks[0]['actions'][:1] ][0]
+
+
+def _accept(products_dir, pending):
+    promote(pending, submitted_fname(products_dir))
+
+
+def test_incremental_writes_nothing_when_nothing_changed(tmpdir):
+    study = make_study(str(tmpdir.join("study")), 4, seqs=False)
+    products = str(tmpdir.mkdir("products"))
+    submission = os.path.join(products, "submission.xml")
+
+    assert _serialize(study, products) is not False
+    assert open(submission).read().count("<Action>") == 9
+    _accept(products, os.path.join(products, "fingerprints.json"))
+    os.remove(submission)
+
+    assert _serialize(study, products) is False
+    assert not os.path.exists(submission)
+    assert not os.path.exists(submission+".part")
+
+
+def test_incremental_shards_nothing_when_nothing_changed(tmpdir):
+    study = make_study(str(tmpdir.join("study")), 4, seqs=False)
+    products = str(tmpdir.mkdir("products"))
+    shard0 = os.path.join(products, "shard.0")
+
+    assert _serialize(study, products, shard_actions=4) is not False
+    for name in sorted(os.listdir(products)):
+        if name.startswith("shard."):
+            _accept(products, os.path.join(products, name,
+                                           "fingerprints.json"))
+    for name in os.listdir(shard0):
+        os.remove(os.path.join(shard0, name))
+    os.rmdir(shard0)
+
+    assert _serialize(study, products, shard_actions=4) is False
+    assert not os.path.exists(shard0)
+
+
+def test_incremental_resubmits_a_changed_sequence_file(tmpdir):
+    study = make_study(str(tmpdir.join("study")), 4)
+    products = str(tmpdir.mkdir("products"))
+    submission = os.path.join(products, "submission.xml")
+
+    assert _serialize(study, products) is not False
+    _accept(products, os.path.join(products, "fingerprints.json"))
+    with open(study['files_16s'][0], 'a') as f:
+        f.write("@extra\nACGT\n+\nIIII\n")
+
+    assert _serialize(study, products) is not False
+    xml = open(submission).read()
+    assert xml.count("<Action>") == 1
+    assert os.path.basename(study['files_16s'][0]) in xml
+
+
+class Clock(object):
+    """Stands in for the time module. ``events`` is a list of (time,
+    callable), each called once the clock's passed its time."""
+
+    def __init__(self, events=()):
+        self.now = 1000.0
+        self.sleeps = list()
+        self.events = sorted(events)
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+        while self.events and self.events[0][0] <= self.now-1000:
+            self.events.pop(0)[1]()
+
+
+class FakeConnection(object):
+    """A remote directory that's really local, with an mtime that only
+    changes when ``touch`` is called"""
+    mode = "sftp"
+
+    def __init__(self, remote_path, remote_dir):
+        self.remote_path = remote_path
+        self.remote_dir = remote_dir
+        self.stamp = 1
+        self.closed = False
+
+    def ensure_active(self):
+        pass
+
+    def mtime(self):
+        return self.stamp
+
+    def touch(self):
+        self.stamp += 1
+
+    def files(self):
+        return os.listdir(self.remote_dir)
+
+    def get(self, fnames, local_dir):
+        for n in fnames:
+            shutil.copy(os.path.join(self.remote_dir, n), local_dir)
+
+    def close(self):
+        self.closed = True
+
+
+class FakePool(object):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def connection(self, user, remote_srv, keyfile, remote_path, **kwargs):
+        assert remote_path == self.conn.remote_path
+        return self.conn
+
+
+def _report(tmpdir, monkeypatch, clock, conn, **kwargs):
+    monkeypatch.setattr(workflows, "time", clock)
+    products = tmpdir.join("products")
+    ready = products.join("submit.ready.complete")
+    ready.write("", ensure=True)
+    metrics = Metrics()
+    tasks = list(workflows.report(
+        str(ready), "user", "srv", conn.remote_path, "key",
+        pool=FakePool(conn), poll_interval=1, poll_backoff=2,
+        metrics=metrics, backend=object(), accessions=None, **kwargs))
+    ret = tasks[0]['actions'][0]()
+    return ret, metrics, str(products)
+
+
+def _arrives(conn, touch=True):
+    def _write():
+        write_report(os.path.join(conn.remote_dir, "report.1.xml"),
+                     "0123456789", [], 0, random.Random(0))
+        if touch:
+            conn.touch()
+    return _write
+
+
+def test_report_lists_once_the_directory_changes(tmpdir, monkeypatch):
+    conn = FakeConnection("/submit/S/", str(tmpdir.mkdir("remote")))
+    clock = Clock([(5, _arrives(conn))])
+    ret, metrics, products = _report(tmpdir, monkeypatch, clock, conn,
+                                     poll_max_interval=30)
+    assert ret is not False
+    assert clock.sleeps == [1, 2, 4]
+    # on the first poll, and once the mtime changes
+    assert metrics.get("report_polls_total") == 4
+    assert metrics.get("report_listings_total") == 2
+    assert os.path.exists(os.path.join(products, "report.1.xml"))
+    assert conn.closed
+
+
+def test_report_lists_every_poll_at_the_longest_interval(tmpdir,
+                                                         monkeypatch):
+    conn = FakeConnection("/submit/S/", str(tmpdir.mkdir("remote")))
+    # a report that doesn't change the directory's mtime
+    clock = Clock([(20, _arrives(conn, touch=False))])
+    ret, metrics, _ = _report(tmpdir, monkeypatch, clock, conn,
+                              poll_max_interval=8)
+    assert ret is not False
+    assert clock.sleeps == [1, 2, 4, 8, 8]
+    assert metrics.get("report_polls_total") == 6
+    # the first poll, then every poll once the interval's at its longest
+    assert metrics.get("report_listings_total") == 4
+
+
+def test_report_times_out(tmpdir, monkeypatch):
+    conn = FakeConnection("/submit/S/", str(tmpdir.mkdir("remote")))
+    clock = Clock()
+    ret, metrics, _ = _report(tmpdir, monkeypatch, clock, conn,
+                              poll_max_interval=8, poll_timeout=20)
+    assert ret is False
+    assert sum(clock.sleeps) <= 20
+    assert conn.closed
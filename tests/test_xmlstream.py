@@ -0,0 +1,141 @@
+import os
+import glob
+import json
+import itertools
+import xml.etree.ElementTree as ET
+
+import pytest
+
+from benchmarks.synth import make_study
+from envi_sra.workflows import Bag
+from envi_sra.workflows import id_schemes
+from envi_sra.workflows import iter_samples_seqs
+from envi_sra.serialize import indent
+from envi_sra.serialize import to_xml
+from envi_sra.xmlstream import Changes
+from envi_sra.xmlstream import fingerprint
+from envi_sra.xmlstream import write_xml
+from envi_sra.xmlstream import write_shards
+from envi_sra.xmlstream import referenced_files
+
+
+def test_changes_tracks_new_and_changed_actions():
+    changes = Changes({"a": fingerprint("<Action>a</Action>")})
+    assert not changes.changed("a", "<Action>a</Action>")
+    assert changes.changed("a", "<Action>A</Action>")
+    assert changes.changed("b", "<Action>b</Action>")
+    assert sorted(changes.take()) == ["a", "b"]
+    assert changes.take() == {}
+
+
+def test_changes_counts_the_file_an_action_uploads():
+    md5s = {"seqs/s1.fastq": "0"*32}
+    frag = '<Action><File file_path="s1.fastq"/></Action>'
+    changes = Changes({}, md5s.get)
+    assert changes.changed("s1", frag, "seqs/s1.fastq")
+    submitted = changes.take()
+
+    changes = Changes(submitted, md5s.get)
+    assert not changes.changed("s1", frag, "seqs/s1.fastq")
+    md5s["seqs/s1.fastq"] = "f"*32
+    assert changes.changed("s1", frag, "seqs/s1.fastq")
+
+
+def _study(tmpdir, n_samples, name="study"):
+    # rendering changes the samples; read them afresh for every pass
+    paths = make_study(str(tmpdir.join(name)), n_samples, seqs=False)
+    st = Bag()
+    st.name, st.description = "Study", "A study"
+    st.id = id_schemes["digest"](st.name)
+    samples_seqs = list(itertools.chain(
+        iter_samples_seqs(st, paths['qiime_metadata'], paths['seqinfo_16s'],
+                          paths['files_16s'], cache_dir=str(tmpdir)),
+        iter_samples_seqs(st, paths['wgs_metadata'], paths['seqinfo_wgs'],
+                          paths['files_wgs'], cache_dir=str(tmpdir))))
+    return st, samples_seqs
+
+
+def _awkward_study(tmpdir, n_samples, name):
+    st, samples_seqs = _study(tmpdir, n_samples, name)
+    st.name = u'Caf\xe9 <dust> & "air"'
+    st.description = u"  Dust\n from \u2603 &\tcampus  "
+    for i, (sample, seq) in enumerate(samples_seqs):
+        if i % 3 == 0:
+            sample['lat_lon'] = "not collected"
+        if i % 3 == 1:
+            sample['env_feature'] = u"caf\xe9 <&> 'q' \"dq\""
+        if i % 4 == 0:
+            sample['light_type'] = u""
+        seq.method = u"Illumina \u00b5 <kit> & more\n\n"
+    return st, samples_seqs
+
+
+@pytest.mark.parametrize("n_samples", [0, 7])
+@pytest.mark.parametrize("workers", [1, 3])
+def test_write_xml_matches_elementtree(tmpdir, n_samples, workers):
+    # rendering changes the samples; make them afresh for each writer
+    st, samples_seqs = _awkward_study(tmpdir, n_samples, "tree")
+    expected = str(tmpdir.join("expected.xml"))
+    xml = to_xml(st, samples_seqs)
+    indent(xml)
+    ET.ElementTree(xml).write(expected)
+
+    st, samples_seqs = _awkward_study(tmpdir, n_samples, "stream")
+    got = str(tmpdir.join("got.xml"))
+    write_xml(st, iter(samples_seqs), got, workers=workers)
+    assert open(got, 'rb').read() == open(expected, 'rb').read()
+
+
+def test_to_xml_takes_a_generator(tmpdir):
+    st, samples_seqs = _awkward_study(tmpdir, 4, "list")
+    expected = ET.tostring(to_xml(st, samples_seqs))
+    st, samples_seqs = _awkward_study(tmpdir, 4, "generator")
+    got = ET.tostring(to_xml(st, (pair for pair in samples_seqs)))
+    assert got == expected and got.count("<Action>") == 1+2*4
+
+
+def test_write_shards_bounds_shards_and_keeps_samples_whole(tmpdir):
+    st, samples_seqs = _study(tmpdir, 10)
+    out = str(tmpdir.mkdir("products"))
+    shards = write_shards(st, samples_seqs, out, max_actions=5)
+
+    assert [ s['name'] for s in shards ] == [ "shard.%i"%(i)
+                                              for i in range(5) ]
+    files = list()
+    for shard in shards:
+        xml = open(shard['submission']).read()
+        assert os.path.exists(shard['ready'])
+        # every shard can be processed first: each has the BioProject
+        assert xml.count('<AddData target_db="BioProject">') == 1
+        assert xml.count("<Action>") == 5
+        assert referenced_files(xml) == set(map(os.path.basename,
+                                                shard['files']))
+        files.extend(shard['files'])
+    assert files == [ seq.path for _, seq in samples_seqs ]
+
+
+def test_write_shards_with_changes_writes_only_whats_changed(tmpdir):
+    st, samples_seqs = _study(tmpdir, 6)
+    out = str(tmpdir.mkdir("products"))
+    changes = Changes({})
+    write_shards(st, samples_seqs, out, max_actions=5, changes=changes)
+    submitted = dict()
+    for fname in glob.glob(out+"/shard.*/fingerprints.json"):
+        submitted.update(json.load(open(fname)))
+    assert len(submitted) == 1+2*6
+
+    changes = Changes(submitted)
+    st, samples_seqs = _study(tmpdir, 6, "again")
+    sample, _ = samples_seqs[4]
+    sample['organism_count'] = "1234"
+    shards = write_shards(st, samples_seqs, out, max_actions=5,
+                          changes=changes)
+    assert len(shards) == 1
+    xml = open(shards[0]['submission']).read()
+    assert xml.count("<Action>") == 1 and "1234" in xml
+    assert 'target_db="BioProject"' not in xml
+
+
+    st, samples_seqs = _study(tmpdir, 6, "unchanged")
+    assert write_shards(st, samples_seqs, out, max_actions=5,
+                        changes=Changes(submitted)) == []